@@ -23,48 +23,118 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-from os.path import join, exists
+import logging
+import threading
+from os.path import join, exists, dirname
+from typing import Union, TYPE_CHECKING
 import pwem
+import pyworkflow as pw
 from pyworkflow import TOMO
-from scipion.install.funcs import VOID_TGZ
+from pyworkflow.utils import strToBoolean
 from membrain.constants import *
 
+if TYPE_CHECKING:
+    from membrain.utils.environment import ResolvedEnvironment
+
+logger = logging.getLogger(__name__)
+
 _logo = "icon.png"
 _references = ['lamm_membrain_2022', 'lamm_membrain_2024']
 __version__ = "3.1.5"
 
+# Scipion imports every plugin at startup and in each step subprocess, so the heavy modules (tomo, emlib, the
+# installer...) are only imported where they are used. Keep it that way: TestImportTime checks it.
+
+
 class Plugin(pwem.Plugin):
     _url = 'https://github.com/scipion-em/scipion-em-membrain'
     _processingField = [TOMO]
+    _envCache = None
+    _envLock = threading.Lock()
 
     @classmethod
     def _defineVariables(cls):
         """ Defines variables for this plugin. scipion3 config -p membrain will show them with current values"""
         cls._defineVar(MEMBRAIN_SEG_ENV_VAR, MEMBRAIN_SEG_ENV_DEFAULT)
         cls._defineVar(MEMBRAIN_SEG_ENV_ACTIVATION_VAR, MEMBRAIN_SEG_ENV_ACTIVATION_DEFAULT)
+        cls._defineVar(MEMBRAIN_SEG_ENV_RESOLVE_VAR, MEMBRAIN_SEG_ENV_RESOLVE_DEFAULT)
         cls._defineEmVar(MEMBRAIN_SEG_HOME, MEMBRAIN_SEG + '-' + MEMBRAIN_SEG_VERSION)
         cls._defineEmVar(MODEL_MODELS_HOME, MEMBRAIN_SEG_MODELS_DIR)
         cls._defineVar(MEMBRAIN_SEG_MODEL_VAR, MEMBRAIN_SEG_MODEL_NAME_DEFAULT)
+        cls._defineVar(MEMBRAIN_SEG_CACHE_DIR_VAR, MEMBRAIN_SEG_CACHE_DIR_DEFAULT)
+        cls._defineVar(MEMBRAIN_SEG_CACHE_SIZE_VAR, MEMBRAIN_SEG_CACHE_SIZE_DEFAULT)
 
     @classmethod
     def getMemBrainSegActivation(cls):
         return cls.getVar(MEMBRAIN_SEG_ENV_ACTIVATION_VAR)
 
+    @classmethod
+    def getMemBrainSegEnv(cls) -> Union['ResolvedEnvironment', None]:
+        """ Return the MemBrain-seg environment resolved once (see membrain.utils.environment), or None if it is
+        disabled or cannot be resolved, in which case the environment is activated by each command. """
+        if not strToBoolean(cls.getVar(MEMBRAIN_SEG_ENV_RESOLVE_VAR)):
+            return None
+        with cls._envLock:
+            if cls._envCache is None:
+                from membrain.utils.environment import EnvironmentCache
+                cls._envCache = EnvironmentCache(join(pw.Config.SCIPION_USER_DATA, MEMBRAIN_SEG_ENV_CACHE_FILE))
+        activationCmd = cls.getCondaActivationCmd() + " " + cls.getMemBrainSegActivation()
+        try:
+            return cls._envCache.get(activationCmd)
+        except RuntimeError as e:
+            logger.warning('%s\nThe environment will be activated for each job.' % e)
+            return None
+
+    @classmethod
+    def getMemBrainSegEnviron(cls) -> Union[dict, None]:
+        """ Return the variables the commands of getMemBrainSegCmd and getMemBrainSegWorkerCmd must be run with, or
+        None to run them with the ones of the current process. """
+        membrainEnv = cls.getMemBrainSegEnv()
+        return membrainEnv.getEnviron() if membrainEnv else None
+
     @classmethod
     def getMemBrainSegCmd(cls):
-        """ Return the full command to run a MemBrain program. """
+        """ Return the full command to run a MemBrain program. It must be run with the variables returned by
+        getMemBrainSegEnviron. """
+        membrainEnv = cls.getMemBrainSegEnv()
+        if membrainEnv:
+            return "CUDA_VISIBLE_DEVICES=%(GPU)s " + membrainEnv.membrain + " "
         cmd = cls.getCondaActivationCmd() + " "
         cmd += cls.getMemBrainSegActivation()
         cmd += " && CUDA_VISIBLE_DEVICES=%(GPU)s membrain "
         return cmd
 
+    @classmethod
+    def getMemBrainSegWorkerCmd(cls):
+        """ Return the full command to launch a persistent MemBrain-seg inference worker. It must be run with the
+        variables returned by getMemBrainSegEnviron. """
+        workerScript = join(dirname(__file__), 'scripts', MEMBRAIN_SEG_WORKER_SCRIPT)
+        membrainEnv = cls.getMemBrainSegEnv()
+        if membrainEnv:
+            return "CUDA_VISIBLE_DEVICES=%(GPU)s " + membrainEnv.python + " -u " + workerScript
+        cmd = cls.getCondaActivationCmd() + " "
+        cmd += cls.getMemBrainSegActivation()
+        cmd += " && CUDA_VISIBLE_DEVICES=%(GPU)s python -u " + workerScript
+        return cmd
+
     @classmethod
     def getMemBrainSegModelPath(cls):
         """ Return the current MemBrain-seg model defined by the environment variable """
         return join(cls.getVar(MODEL_MODELS_HOME), cls.getVar(MEMBRAIN_SEG_MODEL_VAR))
 
+    @classmethod
+    def getMemBrainSegCacheDir(cls):
+        """ Return the directory of the segmentation cache, or an empty string if the cache is disabled. """
+        return cls.getVar(MEMBRAIN_SEG_CACHE_DIR_VAR)
+
+    @classmethod
+    def getMemBrainSegCacheSize(cls):
+        """ Return the maximum size of the segmentation cache in bytes. """
+        return int(float(cls.getVar(MEMBRAIN_SEG_CACHE_SIZE_VAR)) * 1024 ** 3)
+
     @classmethod
     def defineBinaries(cls, env):
+        from scipion.install.funcs import VOID_TGZ
         ENV_CREATED = 'env-created'
         MEMBRAIN_SEG_INSTALLED = '%s_%s_installed' % (MEMBRAIN_SEG, MEMBRAIN_SEG_VERSION)
         MODEL_DOWNLOADED = 'model-downloaded'
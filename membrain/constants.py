@@ -37,6 +37,21 @@ MEMBRAIN_SEG_ENV_DEFAULT = f"membrain-seg-{MEMBRAIN_SEG_VERSION}"
 MEMBRAIN_SEG_ENV_ACTIVATION_VAR = "MEMBRAIN_SEG_ENV_ACTIVATION"
 MEMBRAIN_SEG_ENV_ACTIVATION_DEFAULT = "conda activate " + MEMBRAIN_SEG_ENV_DEFAULT
 
+# The environment is activated once and its executables launched directly with the variables it sets. Set it to False
+# to activate the environment for each job instead
+MEMBRAIN_SEG_ENV_RESOLVE_VAR = 'MEMBRAIN_SEG_ENV_RESOLVE'
+MEMBRAIN_SEG_ENV_RESOLVE_DEFAULT = 'True'
+MEMBRAIN_SEG_ENV_CACHE_FILE = 'membrain-seg-environments.json'
+
+# Persistent inference worker, executed inside the MemBrain-seg environment
+MEMBRAIN_SEG_WORKER_SCRIPT = 'membrain_seg_worker.py'
+
+# Segmentation cache shared by all the projects. It is disabled if no directory is set
+MEMBRAIN_SEG_CACHE_DIR_VAR = 'MEMBRAIN_SEG_CACHE_DIR'
+MEMBRAIN_SEG_CACHE_DIR_DEFAULT = ''
+MEMBRAIN_SEG_CACHE_SIZE_VAR = 'MEMBRAIN_SEG_CACHE_SIZE'  # In GB
+MEMBRAIN_SEG_CACHE_SIZE_DEFAULT = '100'
+
 # models
 MEMBRAIN_SEG_MODEL_VAR = 'MEMBRAIN_SEG_MODEL'
 MEMBRAIN_SEG_MODEL_NAME_DEFAULT = 'MemBrain_seg_v10_beta.ckpt'
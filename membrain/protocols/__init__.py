@@ -3,7 +3,28 @@
 # Module to declare protocols
 # Find documentation here: https://scipion-em.github.io/docs/docs/developer/creating-a-protocol
 # **************************************************************************
-from .protocol_membrain_seg import ProtMemBrainSeg
-from .protocol_membrain_skeletonize import ProtMemBrainSkeletonize
+# The protocol modules import tomo and emlib, so each one is only imported when its protocol is first accessed.
+# Scipion discovers the protocols listing the members of this module, which imports all of them.
+import importlib
 
+_PROTOCOL_MODULES = {
+    'ProtMemBrainSeg': 'protocol_membrain_seg',
+    'ProtMemBrainSkeletonize': 'protocol_membrain_skeletonize',
+    'ProtMemBrainThreshold': 'protocol_membrain_threshold',
+    'ProtMemBrainConnectedComponents': 'protocol_membrain_components',
+}
 
+__all__ = list(_PROTOCOL_MODULES)
+
+
+def __getattr__(name):
+    moduleName = _PROTOCOL_MODULES.get(name)
+    if moduleName is None:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    protocol = getattr(importlib.import_module(f'.{moduleName}', __name__), name)
+    globals()[name] = protocol  # Next accesses do not go through __getattr__
+    return protocol
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,549 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import abc
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple, Union
+
+from membrain import OUTPUT_TOMOMASK_NAME
+from membrain.readers import registerReaders
+from membrain.utils.output_writer import BatchWriter
+from membrain.utils.memory import GiB, HOST_MEMORY_FRACTION, getHostMemory, getGpuMemory
+from membrain.utils.perf import PERF_TRACE_FILE, PerfStats, PerfTrace, measure, runCommand
+from membrain.utils.scheduler import DeviceScheduler, Device
+from membrain.utils.threads import getAvailableCores, getJobThreads, splitCores, getThreadEnviron, pinCommand, \
+    formatCpuList
+from membrain.utils.blocks import createExecutor, getPoolThreads, DEFAULT_BLOCK_SIZE
+from pwem.objects import EMObject
+from pwem.protocols import EMProtocol
+from pyworkflow.object import String, Set, Float, Integer, Object, CsvList, Pointer
+from pyworkflow.protocol import GPU_LIST, StringParam, IntParam, FloatParam, BooleanParam, LEVEL_ADVANCED, Form, GE
+from pyworkflow.utils import prettyDelta, makePath
+from tomo.objects import Tomogram, TomoMask, SetOfTomoMasks, SetOfCoordinates3D
+
+# Seconds waited between two consecutive checks of an input set in streaming
+STREAMING_SLEEP_DEFAULT = 10
+
+# Outputs are registered in batches of up to this number of items or after this number of seconds
+OUTPUT_BATCH_SIZE = 50
+OUTPUT_BATCH_DELAY = 30
+
+# Attributes stored in the output items
+DEVICE_ATTR = '_membrainDevice'
+# Resources used to process the item, named after the fields of PerfStats
+PERF_ATTRS = {'wallTime': ('_membrainWallTime', Float),
+              'cpuTime': ('_membrainCpuTime', Float),
+              'peakRss': ('_membrainPeakRss', Integer),
+              'bytesRead': ('_membrainBytesRead', Integer),
+              'bytesWritten': ('_membrainBytesWritten', Integer)}
+# Statistics of the output volumes, for quality control (see membrain.utils.stats)
+MEMBRANE_FRACTION_ATTR = '_membrainMembraneFraction'
+BOUNDING_BOX_ATTR = '_membrainBoundingBox'
+N_COMPONENTS_ATTR = '_membrainNComponents'
+# Value of N_COMPONENTS_ATTR when the components have not been counted
+N_COMPONENTS_UNKNOWN = -1
+SCORES_HISTOGRAM_ATTR = '_membrainScoresHistogram'
+# Previews of the output volumes (see membrain.utils.preview)
+PREVIEWS_ATTR = '_membrainPreviews'
+THUMBNAILS_ATTR = '_membrainThumbnails'
+PREVIEWS_DIR = 'previews'
+# Phases of the trace whose records give the number of voxels of each tomogram processed
+PERF_VOXELS_FIELD = 'nVoxels'
+
+
+class ProtMemBrainBase(EMProtocol, metaclass=abc.ABCMeta):
+    """ Base class for the MemBrain protocols. It manages the pool of devices (GPUs and CPU workers) the tomograms
+    are distributed over. """
+    # Name of the param with the input set processed in streaming
+    _inputName = None
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # Registered on the first protocol created (also when a project is loaded), so its outputs can be read
+        registerReaders()
+        self.registeredTsIds = None
+        self.scheduler = None
+        self.schedulerLock = threading.Lock()
+        self.outputWriter = None
+        self.processPool = None
+        self.perfTrace = None
+        self.perfStats = {}
+        self.jobThreads = None
+        self.deviceCores = {}
+        # Not the scheduler lock, held by closeOutputStep while the outputs are committed
+        self.perfLock = threading.Lock()
+
+    # -------------------------- DEFINE param functions ----------------------
+    @staticmethod
+    def _defineDeviceParams(form):
+        form.addHidden(GPU_LIST, StringParam,
+                       default='0',
+                       expertLevel=LEVEL_ADVANCED,
+                       label='Choose GPU IDs',
+                       help='GPU devices to be used. Each GPU processes one tomogram at a time. If no GPU is found, '
+                            'MemBrain-seg will run on CPU using the number of threads specified (much slower)')
+
+        form.addParam('cpuSlots', IntParam,
+                      default=0,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Additional CPU workers',
+                      help='Number of tomograms that will be processed on CPU at the same time as the ones processed '
+                           'on the GPUs. The tomograms are sent to the GPUs first, largest first, and to the CPU '
+                           'workers only if all the GPUs are busy. The number of threads should be at least the number '
+                           'of GPUs plus the number of CPU workers plus two.')
+
+        form.addParam('threadsPerJob', IntParam,
+                      default=0,
+                      validators=[GE(0)],
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Threads per job',
+                      help='Threads used by each MemBrain-seg job (PyTorch, OpenMP and MKL thread pools). Use 0 to '
+                           'split the threads of the protocol evenly between its GPUs and CPU workers, so the jobs '
+                           'running at the same time do not compete for the same cores.')
+
+        form.addParam('pinJobs', BooleanParam,
+                      default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Pin the jobs to cores?',
+                      help='If set to Yes, the jobs of each GPU or CPU worker run only on their own cores (with '
+                           'taskset), taken from a single NUMA node when they fit in one, so their memory stays local '
+                           'and they are not moved between cores by the system.')
+
+        form.addParam('memoryBudget', FloatParam,
+                      default=0,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Host memory budget (GB)',
+                      help='The memory needed to segment each tomogram is estimated from its dimensions, and a '
+                           'tomogram waits for a free GPU or CPU worker until it fits in this budget along with the '
+                           'ones being processed, so large sets do not run out of memory halfway. A tomogram larger '
+                           'than the budget is processed alone. Use 0 to take %d%% of the memory of the machine, or '
+                           'of the limit of the job if it runs in a queue system.' % (HOST_MEMORY_FRACTION * 100))
+
+        form.addParam('gpuMemoryBudget', FloatParam,
+                      default=0,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='GPU memory budget (GB)',
+                      help='Memory of each GPU available for MemBrain-seg. It is used to check that the tomograms fit '
+                           'in the GPUs and, if requested, to reduce the sliding window size. Use 0 to take the memory '
+                           'of the smallest GPU used, as reported by nvidia-smi.')
+
+        # One thread is used to watch the input set and another one to register the outputs
+        form.addParallelSection(threads=3, mpi=0)
+
+    @staticmethod
+    def _defineSkeletonizeParams(form: Form, condition: str = 'True'):
+        form.addParam('skelProcesses', IntParam,
+                      default=4,
+                      condition=condition,
+                      label='Skeletonization processes',
+                      help='Number of processes used to skeletonize. Each tomo mask is divided into blocks that are '
+                           'skeletonized in parallel by these processes, shared by all the tomo masks.')
+
+        form.addParam('skelBlockSize', IntParam,
+                      default=DEFAULT_BLOCK_SIZE,
+                      condition=condition,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Skeletonization block size (voxels)',
+                      help='Size of the blocks the tomo masks are divided into. The result does not depend on it. '
+                           'Smaller blocks need less memory per process, but some extra computation.')
+
+    @staticmethod
+    def _defineBatchParams(form: Form):
+        form.addParam('batchSize', IntParam,
+                      default=1,
+                      validators=[GE(1)],
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Tomograms per step',
+                      help='Number of tomograms processed, one after the other, by each step, whose results are '
+                           'registered together. With thousands of tomograms, larger groups reduce the number of steps '
+                           'and the overhead of running them. The tomograms are grouped as they arrive to the input '
+                           'set, so in streaming the groups may be smaller. The steps still run in parallel, so use '
+                           'groups small enough to keep all the devices busy until the end.')
+
+    @staticmethod
+    def _defineCompressionParams(form: Form):
+        form.addParam('compressOutputs', BooleanParam,
+                      default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Compress the output files?',
+                      help='If set to Yes, the output volumes are compressed with gzip (.mrc.gz files). The '
+                           'segmentations are mostly background, so they usually become tens of times smaller, without '
+                           'any loss. The MemBrain protocols and the programs based on mrcfile read them directly, but '
+                           'other programs and viewers may not.')
+
+    @staticmethod
+    def _definePreviewParams(form: Form):
+        form.addParam('createPreviews', BooleanParam,
+                      default=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Create previews?',
+                      help='If set to Yes, each output volume gets a multiscale pyramid (the volume binned by 2, 4 and '
+                           '8) and PNG thumbnails of its central XY, XZ and YZ slices, in the directory extra/%s. '
+                           'Their files are stored in the output items, so viewers and reports can show the coarse '
+                           'levels first instead of loading the full volumes.' % PREVIEWS_DIR)
+
+    # -------------------------- INSERT steps functions -----------------------
+    def stepsGeneratorStep(self) -> None:
+        """ Insert the steps to process each item of the input set as they arrive to it, so the output of a protocol
+        still running can be consumed. It finishes once the input set is closed and all its items have been
+        considered. The protocols define how the items are stored (_addInputItem) and processed
+        (_insertBatchSteps). """
+        self._initialize()
+        knownTsIds = set()
+        closeSetStepDeps = []
+        inSet = self._getInputSet()
+        # An item is done only once registered in all the outputs requested
+        self.registeredTsIds = {outputName: self._getProcessedTsIds(outputName)
+                                for outputName in self._getOutputNames()}
+        processedTsIds = set.intersection(*self.registeredTsIds.values())
+        while True:
+            inStreamOpen = inSet.isStreamOpen()
+            with self._lock:
+                newItemDict = {tsId: item.clone() for item in inSet.iterItems()
+                               if (tsId := item.getTsId()) not in knownTsIds}
+
+            # Largest items first, so the devices and processes are kept busy until the end
+            newTsIds = []
+            for tsId in self._sortBySize(newItemDict):
+                knownTsIds.add(tsId)
+                self._addInputItem(tsId, newItemDict[tsId])
+                if tsId not in processedTsIds:  # Otherwise registered in a previous execution
+                    newTsIds.append(tsId)
+
+            for batch in self._getBatches(newTsIds):
+                closeSetStepDeps.append(self._insertBatchSteps(batch))
+
+            if not inStreamOpen and not newItemDict:
+                self.info('Input set closed.')
+                self._insertFunctionStep(self.closeOutputStep,
+                                         prerequisites=closeSetStepDeps,
+                                         needsGPU=False)
+                break
+            if inStreamOpen:
+                self._refreshStreaming(inSet)
+
+    def _initialize(self):
+        """ Reset the state kept by the steps of the current execution, before the first items are added. """
+        pass
+
+    @abc.abstractmethod
+    def _addInputItem(self, tsId: str, item: EMObject):
+        """ Keep an item of the input set, new in the current execution, for the steps that process it. """
+
+    @abc.abstractmethod
+    def _insertBatchSteps(self, tsIds: List[str]) -> int:
+        """ Insert the steps to process and register the given items of the input set.
+        :return: the id of the step registering them, which the closeOutputStep waits for.
+        """
+
+    # --------------------------- STEPS functions ----------------------------------
+    def closeOutputStep(self):
+        """ Register the pending output items and close the output sets. """
+        with self.schedulerLock:
+            if self.outputWriter is not None:
+                self.outputWriter.stop()
+                self.outputWriter = None
+            if self.processPool is not None:
+                self.processPool.shutdown()
+                self.processPool = None
+        self._closeOutputSet()
+
+    # --------------------------- UTILS functions ----------------------------------
+    def _createOutputSet(self, outputName: str) -> Set:
+        """ Get the given output set ready to append new items, creating it if it does not exist yet. """
+        outSet = getattr(self, outputName, None)
+        if outSet:
+            outSet.enableAppend()
+            return outSet
+        outSet = self._newOutputSet(outputName)
+        comment = self._getOutputComment(outputName)
+        if comment:
+            outSet.setObjComment(comment)
+        outSet.setStreamState(Set.STREAM_OPEN)
+
+        self._defineOutputs(**{outputName: outSet})
+        self._defineSourceRelation(self._getInputSet(retPointer=True), outSet)
+        return outSet
+
+    def _newOutputSet(self, outputName: str) -> Set:
+        """ New empty set for the given output: a set of tomo masks with the info of the input set, unless the protocol
+        generates other outputs. """
+        outTomoMasks = SetOfTomoMasks.create(self._getPath(),
+                                            template='tomomasks%s.sqlite',
+                                            suffix=self._getOutputSuffix(outputName))
+        outTomoMasks.copyInfo(self._getInputSet())
+        return outTomoMasks
+
+    @abc.abstractmethod
+    def _getOutputSuffix(self, outputName: str) -> str:
+        """ Suffix of the database of the given output. """
+
+    def _getOutputComment(self, outputName: str) -> Union[str, None]:
+        """ Comment describing the given output, if any. """
+        return None
+
+    def _getInputSet(self, retPointer: bool = False) -> Union[Set, Pointer]:
+        """ Input set processed in streaming, or its pointer. """
+        inSetPointer = getattr(self, self._inputName)
+        return inSetPointer if retPointer else inSetPointer.get()
+
+    def _getOutputNames(self) -> List[str]:
+        """ Names of the outputs requested. """
+        return [OUTPUT_TOMOMASK_NAME]
+
+    def _registerOutput(self, outputName: str, item: Union[EMObject, List[EMObject]]):
+        """ Queue an item, or a list of items committed together, to be appended to the given output set. The items are
+        registered in batches from a single thread (see BatchWriter), and all the pending ones in the
+        closeOutputStep. """
+        with self.schedulerLock:
+            if self.outputWriter is None:
+                self.outputWriter = BatchWriter(self._commitOutputs, OUTPUT_BATCH_SIZE, OUTPUT_BATCH_DELAY)
+        self.outputWriter.put((outputName, item))
+
+    def _commitOutputs(self, items: List[Tuple[str, Union[EMObject, List[EMObject]]]]):
+        """ Append a batch of items to their output sets, writing and storing each set once. """
+        with self._lock, measure() as measurement:
+            outSets = {}
+            for outputName, item in items:
+                if outputName not in outSets:
+                    outSets[outputName] = self._createOutputSet(outputName)
+                for obj in (item if isinstance(item, list) else [item]):
+                    outSets[outputName].append(obj)
+            for outSet in outSets.values():
+                outSet.write()
+            self._store(*outSets.values())
+        self._getPerfTrace().add('', 'commitOutputs', measurement.stats, nItems=len(items))
+
+    def _refreshStreaming(self, inSet: Set):
+        """ Wait and reload the input set, so its new items and its stream state are visible. """
+        time.sleep(self.getAttributeValue('streamingSleepOnWait', 0) or STREAMING_SLEEP_DEFAULT)
+        with self._lock:
+            inSet.loadAllProperties()
+
+    def _getScheduler(self) -> DeviceScheduler:
+        """ Device scheduler shared by all the steps of the current execution. """
+        with self.schedulerLock:
+            if self.scheduler is None:
+                gpus = self.getGpuList()
+                # With no GPUs at all, the tomograms are processed on CPU one by one as before
+                hostMemory = self._getHostMemoryBudget()
+                self.scheduler = DeviceScheduler(gpus, max(self.cpuSlots.get(), 0 if gpus else 1), hostMemory)
+                self.info('Processing devices: %s. Host memory budget: %.1f GB'
+                          % (', '.join(str(d) for d in self.scheduler.getDevices()), hostMemory / GiB))
+                self._assignThreads(self.scheduler.getDevices())
+        return self.scheduler
+
+    def _assignThreads(self, devices: List[Device]):
+        """ Split the threads of the protocol, and optionally the cores, between the jobs of the devices, which run at
+        the same time. """
+        nodes = getAvailableCores()
+        nCores = sum(len(node) for node in nodes)
+        self.jobThreads = self.threadsPerJob.get() or getJobThreads(min(self.numberOfThreads.get(), nCores),
+                                                                     len(devices))
+        if self.pinJobs.get():
+            if shutil.which('taskset'):
+                self.deviceCores = dict(zip((str(d) for d in devices), splitCores(nodes, len(devices), self.jobThreads)))
+            else:
+                self.warning('taskset was not found: the jobs will not be pinned to cores.')
+        self.info('Threads per job: %d.' % self.jobThreads)
+        for device, cores in self.deviceCores.items():
+            self.info('Jobs of %s pinned to cores %s.' % (device, formatCpuList(cores)))
+        self._getPerfTrace().add('', 'threads', PerfStats(), jobThreads=self.jobThreads,
+                                 cores={device: formatCpuList(cores) for device, cores in self.deviceCores.items()})
+
+    def _getJobCmd(self, cmd: str, device: Device) -> str:
+        """ Shell command to run a job on the given device, pinned to its cores if requested. """
+        self._getScheduler()
+        cores = self.deviceCores.get(str(device))
+        return pinCommand(cmd, cores) if cores else cmd
+
+    def _getJobEnviron(self, env: Union[dict, None]) -> dict:
+        """ Variables to run a job with, the given ones (or the ones of the current process if None) with its thread
+        pools limited to its share of threads. """
+        self._getScheduler()
+        return {**(os.environ if env is None else env), **getThreadEnviron(self.jobThreads)}
+
+    def _getHostMemoryBudget(self) -> int:
+        """ Host memory, in bytes, the jobs running at the same time can use. """
+        budget = self.memoryBudget.get()
+        return int(budget * GiB) if budget > 0 else int(getHostMemory() * HOST_MEMORY_FRACTION)
+
+    def _getGpuMemoryBudget(self) -> Union[int, None]:
+        """ Memory, in bytes, available in each GPU, or None if unknown. """
+        budget = self.gpuMemoryBudget.get()
+        if budget > 0:
+            return int(budget * GiB)
+        gpuMemory = getGpuMemory(self.getGpuList())
+        return min(gpuMemory.values()) if gpuMemory else None
+
+    def _runJobWithStats(self, program: str, args: str, env: dict = None) -> PerfStats:
+        """ Run a program as runJob does, without MPI, measuring the resources it uses. """
+        cmd = f'{program} {args}'
+        self.info(f'** Running command: {cmd}')
+        return runCommand(cmd, env=env)
+
+    def _getPerfTrace(self) -> PerfTrace:
+        """ Trace file of the resources used by the current execution, in the extra directory. """
+        with self.perfLock:
+            if self.perfTrace is None:
+                self.perfTrace = PerfTrace(self._getExtraPath(PERF_TRACE_FILE))
+        return self.perfTrace
+
+    def _addPerfStats(self, tsId: str, phase: str, stats: PerfStats, total: bool = True, **extra):
+        """ Record in the trace file the resources used by a phase of the processing of a tomogram.
+        :param total: if True, they are also added to the ones stored in its output items (see _setPerfStats). Use
+        False for the phases included in others or that are only waits.
+        :param extra: fields added to the record of the trace.
+        """
+        self._getPerfTrace().add(tsId, phase, stats, **extra)
+        if total:
+            with self.perfLock:
+                self.perfStats[tsId] = self.perfStats.get(tsId, PerfStats()).combine(stats)
+
+    def _setPerfStats(self, tomoMask: TomoMask, tsId: str):
+        """ Record in the output item the resources used to process it. """
+        stats = self.perfStats.get(tsId)
+        if stats is not None:
+            for field, (attrName, attrClass) in PERF_ATTRS.items():
+                setattr(tomoMask, attrName, attrClass(getattr(stats, field)))
+
+    def _getPreviewPrefix(self, name: str) -> str:
+        """ Prefix of the previews of an output volume (see PreviewScanner). """
+        makePath(self._getExtraPath(PREVIEWS_DIR))
+        return self._getExtraPath(PREVIEWS_DIR, name)
+
+    @staticmethod
+    def _getPreviewAttrs(previews: Dict[str, List[str]]) -> Dict[str, Object]:
+        """ Attributes of an output item with the files of its previews, as returned by PreviewScanner. """
+        attrs = {}
+        for attrName, key in [(PREVIEWS_ATTR, 'levels'), (THUMBNAILS_ATTR, 'thumbnails')]:
+            attrs[attrName] = CsvList(pType=str)
+            attrs[attrName].set(previews[key])
+        return attrs
+
+    def _getTraceRecords(self, phase: str) -> List[dict]:
+        """ Records of the given phase in the trace file. """
+        traceFile = self._getExtraPath(PERF_TRACE_FILE)
+        if not os.path.exists(traceFile):
+            return []
+        with open(traceFile) as f:
+            return [record for record in map(json.loads, f) if record['phase'] == phase]
+
+    def _getThreadsSummary(self) -> List[str]:
+        """ Threads and cores of each job, from the last record of the trace file. """
+        records = self._getTraceRecords('threads')
+        if not records:
+            return []
+        jobThreads = records[-1]['jobThreads']
+        summary = 'Each job used %d thread%s' % (jobThreads, '' if jobThreads == 1 else 's')
+        cores = records[-1]['cores']
+        if cores:
+            summary += ', pinned to cores %s' % ', '.join(f'{cpus} ({device})' for device, cpus in cores.items())
+        return [summary + '.']
+
+    def _getProcessPoolSummary(self) -> List[str]:
+        """ Processes and threads of the pool working on blocks of volumes, from the last record of the trace file. """
+        records = self._getTraceRecords('processPool')
+        if not records:
+            return []
+        nProcs, nThreads = records[-1]['nProcs'], records[-1]['processThreads']
+        return ['The blocks were processed by %d process%s of %d thread%s.'
+                % (nProcs, '' if nProcs == 1 else 'es', nThreads, '' if nThreads == 1 else 's')]
+
+    def _getPerfSummary(self) -> List[str]:
+        """ Aggregate throughput of the protocol, from the records of its trace file with the number of voxels of each
+        tomogram processed. """
+        traceFile = self._getExtraPath(PERF_TRACE_FILE)
+        if not os.path.exists(traceFile):
+            return []
+        nVoxels = {}
+        with open(traceFile) as f:
+            for line in f:
+                record = json.loads(line)
+                if PERF_VOXELS_FIELD in record:
+                    nVoxels[record['tsId']] = record[PERF_VOXELS_FIELD]
+        elapsed = self.getElapsedTime().total_seconds()
+        if not nVoxels or elapsed <= 0:
+            return []
+        return ['Throughput: %.1f tomograms/hour, %.2f Mvoxels/s (%d tomograms in %s).'
+                % (len(nVoxels) * 3600 / elapsed, sum(nVoxels.values()) / elapsed / 1e6, len(nVoxels),
+                   prettyDelta(self.getElapsedTime()))]
+
+    def _getProcessPool(self, nProcs: int) -> ProcessPoolExecutor:
+        """ Pool of processes shared by all the steps of the current execution that work on blocks of volumes. """
+        with self.schedulerLock:
+            if self.processPool is None:
+                nThreads = getPoolThreads(nProcs)
+                self.processPool = createExecutor(nProcs, nThreads)
+                self.info('Block processes: %d, with %d threads each.' % (nProcs, nThreads))
+                self._getPerfTrace().add('', 'processPool', PerfStats(), nProcs=nProcs, processThreads=nThreads)
+        return self.processPool
+
+    @staticmethod
+    def _getIndexedOutputNames(nOutputs: int, baseName: str = OUTPUT_TOMOMASK_NAME) -> List[str]:
+        """ Names of the outputs generated from a list of values, one output per value: baseName for a single value,
+        and baseName_1, baseName_2... otherwise. """
+        if nOutputs == 1:
+            return [baseName]
+        return [f'{baseName}_{i + 1}' for i in range(nOutputs)]
+
+    def _getProcessedTsIds(self, outputName: str = OUTPUT_TOMOMASK_NAME) -> set:
+        """ The tsIds already registered in the given output, when the protocol is resumed. """
+        outSet = getattr(self, outputName, None)
+        if not outSet:
+            return set()
+        if isinstance(outSet, SetOfCoordinates3D):
+            return set(outSet.getTSIds())
+        return {item.getTsId() for item in outSet}
+
+    def _getBatches(self, tsIds: List[str]) -> List[List[str]]:
+        """ Split the given tsIds, keeping their order, into the groups processed by each step. """
+        batchSize = max(self.getAttributeValue('batchSize', 1) or 1, 1)
+        return [tsIds[i:i + batchSize] for i in range(0, len(tsIds), batchSize)]
+
+    @staticmethod
+    def _sortBySize(tomoDict: Dict[str, Tomogram]) -> List[str]:
+        """ Return the keys of the given dict of tomograms sorted by decreasing number of voxels. """
+        sizes = {}
+        for tsId, tomo in tomoDict.items():
+            x, y, z = tomo.getDim() or (0, 0, 0)
+            sizes[tsId] = x * y * z
+        return DeviceScheduler.sortBySize(sizes)
+
+    def _setDevice(self, tomoMask: TomoMask, *jobIds: str):
+        """ Record in the output item the devices used to process it, by the given jobs of the scheduler. """
+        devices = []
+        for jobId in jobIds:
+            device = self._getScheduler().getAssignment(jobId)
+            if device is not None and str(device) not in devices:
+                devices.append(str(device))
+        # Set even without devices (results retrieved from the cache), as all the items of a set need the same
+        # attributes
+        setattr(tomoMask, DEVICE_ATTR, String(', '.join(devices) or None))
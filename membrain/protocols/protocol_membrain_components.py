@@ -0,0 +1,207 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+from typing import Union, List
+
+from membrain import OUTPUT_TOMOMASK_NAME
+from membrain.protocols.protocol_base import ProtMemBrainBase, N_COMPONENTS_ATTR
+from membrain.utils.blocks import DEFAULT_BLOCK_SIZE
+from membrain.utils.components import labelComponentsFile, countComponentsFile
+from pyworkflow import BETA
+from pyworkflow.object import Pointer, Integer
+from pyworkflow.protocol import STEPS_PARALLEL, PointerParam, NumericListParam, IntParam, LEVEL_ADVANCED, \
+    ProtStreamingBase
+from pyworkflow.utils import Message, getFloatListFromValues
+from tomo.objects import SetOfTomoMasks, TomoMask
+
+# Inputs
+IN_TOMO_MASKS = 'inTomoMasks'
+
+# Suffixes
+SUFFIX_COMPONENTS = 'cc'
+
+
+class ProtMemBrainConnectedComponents(ProtMemBrainBase, ProtStreamingBase):
+    """
+    Label the connected components of the membrane segmentations, removing the ones smaller than a given size, as
+    the option --store-connected-components of 'membrain segment' does. Each tomo mask is labelled by blocks in
+    parallel, without loading it whole in memory, and several size thresholds can be applied at once.
+    """
+
+    _label = 'tomomask connected components'
+    _possibleOutputs = {OUTPUT_TOMOMASK_NAME: 'SetOfTomoMasks'}
+    _devStatus = BETA
+    _inputName = IN_TOMO_MASKS
+    stepsExecutionMode = STEPS_PARALLEL
+
+    @classmethod
+    def worksInStreaming(cls):
+        return True
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.tomoMaskDict = None
+        self.nComponents = {}
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam(IN_TOMO_MASKS, PointerParam,
+                      pointerClass='SetOfTomoMasks',
+                      allowsNull=False,
+                      label='Input tomo masks (segmentations)')
+
+        form.addParam('sizeThresholds', NumericListParam,
+                      default='0',
+                      label='Minimum component sizes (voxels)',
+                      help='Connected components with fewer voxels than this are removed, as with the parameter '
+                           '--connected-component-thres of MemBrain-seg. Use 0 to keep all of them. Several sizes '
+                           'separated by spaces can be given, generating one output for each of them, named '
+                           'tomoMasks_1, tomoMasks_2... in the same order. With a single size, the output is named '
+                           'tomoMasks.')
+
+        form.addParam('ccProcesses', IntParam,
+                      default=4,
+                      label='Labelling processes',
+                      help='Number of processes used to label the components. Each tomo mask is divided into blocks '
+                           'that are labelled in parallel by these processes, shared by all the tomo masks.')
+
+        form.addParam('ccBlockSize', IntParam,
+                      default=DEFAULT_BLOCK_SIZE,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Labelling block size (voxels)',
+                      help='Size of the blocks the tomo masks are divided into. The result does not depend on it.')
+
+        self._defineBatchParams(form)
+        # One thread is used to watch the input set and another one to register the outputs
+        form.addParallelSection(threads=3, mpi=0)
+        self._defineStreamingParams(form)
+
+    # -------------------------- INSERT steps functions -----------------------
+    def _initialize(self):
+        self.tomoMaskDict = {}
+
+    def _addInputItem(self, tomoId: str, tomoMask: TomoMask):
+        self.tomoMaskDict[tomoId] = tomoMask
+
+    def _insertBatchSteps(self, tomoIds: List[str]) -> int:
+        ccId = self._insertFunctionStep(self._labelComponentsStep,
+                                        *tomoIds,
+                                        prerequisites=[],
+                                        needsGPU=False)
+        return self._insertFunctionStep(self._createOutputStep,
+                                        *tomoIds,
+                                        prerequisites=ccId,
+                                        needsGPU=False)
+
+    def _labelComponentsStep(self, *tomoIds: str):
+        """ Label the connected components of the given tomo masks, one after the other. """
+        for tomoId in tomoIds:
+            self._labelComponents(tomoId)
+
+    def _labelComponents(self, tomoId: str):
+        tomoMask = self.tomoMaskDict[tomoId]
+        self.info(f'Labelling the connected components of {tomoId}')
+        self.nComponents[tomoId] = labelComponentsFile(
+            tomoMask.getFileName(),
+            {size: self._getOutFileNameScipion(tomoId, size) for size in self._getSizeThresholds()},
+            samplingRate=tomoMask.getSamplingRate(),
+            blockSize=self.ccBlockSize.get(),
+            executor=self._getProcessPool(self.ccProcesses.get()))
+
+    def _createOutputStep(self, *tomoIds: str):
+        """ Register the results of the given tomo masks. """
+        for tomoId in tomoIds:
+            self._createOutput(tomoId)
+
+    def _createOutput(self, tomoId: str):
+        inTomoMask = self.tomoMaskDict[tomoId]
+        nComponents = self.nComponents.pop(tomoId, {})
+        for outputName, size in zip(self._getOutputNames(), self._getSizeThresholds()):
+            # When resuming, the item may be already registered in some outputs
+            if tomoId in self.registeredTsIds[outputName]:
+                continue
+            outFile = self._getOutFileNameScipion(tomoId, size)
+            if size not in nComponents:  # Labelled by a previous execution
+                nComponents[size] = countComponentsFile(outFile, blockSize=self.ccBlockSize.get(),
+                                                        executor=self._getProcessPool(self.ccProcesses.get()))
+            tomoMask = TomoMask()
+            tomoMask.copyInfo(inTomoMask)
+            tomoMask.setFileName(outFile)
+            tomoMask.setVolName(inTomoMask.getVolName())
+            setattr(tomoMask, N_COMPONENTS_ATTR, Integer(nComponents[size]))
+            self._registerOutput(outputName, tomoMask)
+
+    # --------------------------- UTILS functions ----------------------------------
+    def _getInTomoMasks(self, retPointer: bool = False) -> Union[SetOfTomoMasks, Pointer]:
+        inTomoMasksPointer = getattr(self, IN_TOMO_MASKS)
+        return inTomoMasksPointer if retPointer else inTomoMasksPointer.get()
+
+    def _getSizeThresholds(self) -> List[int]:
+        return [int(size) for size in getFloatListFromValues(self.sizeThresholds.get())]
+
+    def _getOutputNames(self) -> List[str]:
+        """ Names of the outputs, in the same order as the size thresholds. """
+        return self._getIndexedOutputNames(len(self._getSizeThresholds()))
+
+    def _getOutputSuffix(self, outputName: str) -> str:
+        return f'_{SUFFIX_COMPONENTS}{self._getOutputSize(outputName)}'
+
+    def _getOutputComment(self, outputName: str) -> str:
+        return f'Minimum component size: {self._getOutputSize(outputName)} voxels'
+
+    def _getOutputSize(self, outputName: str) -> int:
+        return self._getSizeThresholds()[self._getOutputNames().index(outputName)]
+
+    def _getOutFileNameScipion(self, tomoId: str, size: int) -> str:
+        return self._getExtraPath(f'{tomoId}_{SUFFIX_COMPONENTS}{size}.mrc')
+
+    # --------------------------- INFO functions -----------------------------------
+    def _validate(self):
+        errors = []
+        self._validateThreads(errors)
+        try:
+            sizes = self._getSizeThresholds()
+        except ValueError:
+            sizes = None
+        if not sizes:
+            errors.append('At least one numeric minimum component size is required.')
+        elif len(set(sizes)) != len(sizes):
+            errors.append('The minimum component sizes must be different.')
+        elif min(sizes) < 0:
+            errors.append('The minimum component sizes cannot be negative.')
+        if self.ccBlockSize.get() < 1:
+            errors.append('The block size must be positive.')
+        return errors
+
+    def _summary(self):
+        summary = []
+        for outputName, size in zip(self._getOutputNames(), self._getSizeThresholds()):
+            outSet = getattr(self, outputName, None)
+            if outSet:
+                summary.append(f'{outputName}: {outSet.getSize()} tomograms labelled, removing the components '
+                               f'smaller than {size} voxels.')
+        summary.extend(self._getProcessPoolSummary())
+        return summary
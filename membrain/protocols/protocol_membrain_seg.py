@@ -28,31 +28,86 @@
 """
 A protocol to segment membranes in tomograms using MemBrain-seg.
 """
-from os.path import basename
-from typing import Union
+import os
+import shutil
+import threading
+import time
+from os.path import basename, realpath, join
+from typing import Union, List, Dict, Tuple, NamedTuple
+
+import mrcfile
 
 from membrain import Plugin, OUTPUT_TOMOMASK_NAME
-from pwem.protocols import EMProtocol
+from membrain.constants import MEMBRAIN_SEG_VERSION
+from membrain.protocols.protocol_base import ProtMemBrainBase, MEMBRANE_FRACTION_ATTR, BOUNDING_BOX_ATTR, \
+    N_COMPONENTS_ATTR, N_COMPONENTS_UNKNOWN, SCORES_HISTOGRAM_ATTR
+from membrain.protocols.protocol_membrain_skeletonize import SUFFIX_SKEL
+from membrain.scripts.membrain_seg_worker import BACKEND_PYTORCH, BACKEND_TORCHSCRIPT, BACKEND_TORCHSCRIPT_BF16
+from membrain.utils.agreement import measureAgreement
+from membrain.utils.blocks import Block
+from membrain.utils.cache import SegmentationCache
+from membrain.utils.components import labelComponentsFile, countComponentsFile
+from membrain.utils.encoding import SCORES_ENCODINGS, SCORES_FLOAT32, COMPRESSED_EXT, encodeScores, \
+    compressFile
+from membrain.utils.memory import GiB, MIN_WINDOW_SIZE, estimateMemory, chooseWindowSize
+from membrain.utils.perf import PerfStats, measure
+from membrain.utils.region import detectSlabFile, getMaskRegion, intersectRegions, getRegionShape
+from membrain.utils.rescale import MEMBRAIN_SEG_SAMPLING_RATE, getBinFactor, getBinnedShape, binFile, upsampleFile
+from membrain.utils.scheduler import Device, GPU, CPU
+from membrain.utils.skeletonize import skeletonizeFile
+from membrain.utils.staging import ScratchStager
+from membrain.utils.preview import PREVIEW_MASK, PREVIEW_SCORES, PreviewScanner
+from membrain.utils.stats import SegmentationStats, SegmentationStatsScanner, ScoresHistogramScanner, scanFile
+from membrain.utils.threshold import thresholdFile
+from membrain.utils.tiling import getTiles, countTiles, stitchTiles
+from membrain.utils.worker import MemBrainSegWorker
 from pyworkflow import BETA
-from pyworkflow.object import Set, Pointer
-from pyworkflow.protocol import PointerParam, BooleanParam, IntParam, FloatParam, StringParam, LEVEL_ADVANCED
+from pyworkflow.object import Pointer, Object, Float, Integer, CsvList
+from pyworkflow.protocol import PointerParam, BooleanParam, IntParam, FloatParam, StringParam, EnumParam, \
+    LEVEL_ADVANCED, ProtStreamingBase
 from pyworkflow.utils import *
-from tomo.objects import SetOfTomoMasks, TomoMask, SetOfTomograms
+from tomo.objects import TomoMask, SetOfTomograms, Tomogram
 from pyworkflow.protocol.constants import STEPS_PARALLEL
-from pyworkflow.protocol import GPU_LIST
 
 # Inputs
 IN_TOMOS = 'inTomograms'
+IN_REGION_MASKS = 'inRegionMasks'
 
 # Suffixes
 SUFFIX_SEG = 'segmented'
 SUFFIX_SCORES = 'scores'
+SUFFIX_INPUT = 'input'  # Tomogram binned or cropped before being segmented
+SUFFIX_TILE = 'tile'
+
+# Inference backends on CPU (see membrain_seg_worker.py)
+CPU_BACKEND_PYTORCH = 0
+CPU_BACKENDS = ['PyTorch', 'TorchScript', 'TorchScript bfloat16']
+CPU_BACKEND_NAMES = [BACKEND_PYTORCH, BACKEND_TORCHSCRIPT, BACKEND_TORCHSCRIPT_BF16]
+# Agreement with the PyTorch model below which the check of the CPU backend warns
+BACKEND_CHECK_MIN_DICE = 0.99
 
 # Outputs
 OUTPUT_TOMOPROBMAP_NAME = 'tomoProbMaps'
+OUTPUT_TOMOSKEL_NAME = 'tomoSkeletons'
+OUTPUT_SUFFIXES = {OUTPUT_TOMOMASK_NAME: SUFFIX_SEG,
+                   OUTPUT_TOMOPROBMAP_NAME: SUFFIX_SCORES,
+                   OUTPUT_TOMOSKEL_NAME: SUFFIX_SKEL}
+
+
+class TileJob(NamedTuple):
+    """ A tomogram prepared to be segmented by tiles. """
+    inputFile: str  # Tomogram, or its binned or cropped version, the tiles are extracted from
+    tmpDir: str  # Directory of the tiles and their results
+    shape: Tuple[int, int, int]  # Shape of the input file
+    fullShape: Tuple[int, int, int]  # Shape of the tomogram
+    region: Union[Block, None]
+    binFactor: int
 
+    def getTiles(self, tileSize: int, overlap: int) -> List[Block]:
+        return getTiles(self.shape, tileSize, overlap)
 
-class ProtMemBrainSeg(EMProtocol):
+
+class ProtMemBrainSeg(ProtMemBrainBase, ProtStreamingBase):
     """
     Segment membranes in tomograms using MemBrain-seg.
 
@@ -62,13 +117,32 @@ class ProtMemBrainSeg(EMProtocol):
 
     _label = 'tomogram membrane segmentation'
     _possibleOutputs = {OUTPUT_TOMOMASK_NAME: 'SetOfTomoMasks',
-                        OUTPUT_TOMOPROBMAP_NAME: 'SetOfTomoMasks'}
+                        OUTPUT_TOMOPROBMAP_NAME: 'SetOfTomoMasks',
+                        OUTPUT_TOMOSKEL_NAME: 'SetOfTomoMasks'}
     _devStatus = BETA
+    _inputName = IN_TOMOS
     stepsExecutionMode = STEPS_PARALLEL
 
+    @classmethod
+    def worksInStreaming(cls):
+        return True
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.tomoDict = None
+        self.sourceDict = None
+        self.dataDict = None
+        self.runSteps = None
+        self.segCache = None
+        self.segWorkers = {}
+        self.segWorkersLock = threading.Lock()
+        self.stager = None
+        self.windowSizes = {}
+        self.regionMaskFiles = None
+        self.tileJobs = {}
+        self.cpuBackendChecked = False
+        self.outputAttrs = {}
+        self.scanLocks = {}
 
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -87,6 +161,40 @@ class ProtMemBrainSeg(EMProtocol):
                       allowsNull=False,
                       label='Input tomograms')
 
+        form.addParam('rescale', BooleanParam,
+                      default=False,
+                      label='Bin the tomograms to the pixel size of the model?',
+                      help='MemBrain-seg is trained on tomograms of about 10 Å/px. If set to Yes, the tomograms with a '
+                           'smaller pixel size are binned by an integer factor, averaging blocks of voxels, to the '
+                           'closest pixel size to the one given below before being segmented, and the outputs are '
+                           'upsampled back to the size of the tomograms. Binning by 2 means 8 times fewer voxels to '
+                           'segment. The outputs have the same geometry as the input tomograms, but their detail is '
+                           'the one of the binned tomograms.')
+
+        form.addParam('targetSamplingRate', FloatParam,
+                      default=MEMBRAIN_SEG_SAMPLING_RATE,
+                      condition='rescale',
+                      label='Pixel size of the model (Å/px)',
+                      help='Pixel size the tomograms are binned to, approximately, before being segmented.')
+
+        form.addParam('detectSlab', BooleanParam,
+                      default=False,
+                      label='Segment only the specimen slab?',
+                      help='If set to Yes, the slices of each tomogram containing the specimen are detected from their '
+                           'variance, and only them, with a margin, are segmented. The empty space above and below '
+                           'the specimen, often more than half of the slices of cryo-FIB lamellae, is left as '
+                           'background in the outputs. If no clear slab is found, the whole tomogram is segmented.')
+
+        form.addParam(IN_REGION_MASKS, PointerParam,
+                      pointerClass='SetOfTomoMasks',
+                      allowsNull=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Masks of the regions to segment (opt.)',
+                      help='If given, only the bounding box of the non-zero voxels of the mask of each tomogram (the '
+                           'one with the same tsId), with a margin, is segmented, and the rest of the outputs is left '
+                           'as background. The masks can have a different size than the tomograms, e.g. binned. '
+                           'Tomograms without mask are segmented whole.')
+
         form.addParam('segmentationThreshold', FloatParam,
                       default=0.0,
                       expertLevel=LEVEL_ADVANCED,
@@ -99,12 +207,116 @@ class ProtMemBrainSeg(EMProtocol):
                       label='Sliding window size',
                       help='Sliding window size used for inference. Smaller values than 160 consume less GPU, but also lead to worse segmentation results!')
 
+        form.addParam('autoWindowSize', BooleanParam,
+                      default=False,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Reduce the window size to fit in the GPU?',
+                      help='If set to Yes, the GPU memory needed by each tomogram is estimated from its dimensions, and '
+                           'the sliding window size is reduced for the tomograms that would not fit in the GPU memory '
+                           'with the size given above (see the parameter GPU memory budget). The window size used for '
+                           'each tomogram is reported in the log.')
+
+        form.addParam('tileSize', IntParam,
+                      default=0,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Tile size (voxels)',
+                      help='If positive, the tomograms larger than this along any axis (once binned) are split into '
+                           'overlapping cubic tiles of this size, segmented as independent steps that can run at the '
+                           'same time on different GPUs or CPU workers. The score maps of the tiles are blended in the '
+                           'overlaps and thresholded to get the segmentation, so a single huge tomogram can use all '
+                           'the devices and needs less memory per job. Use 0 to segment the tomograms whole.')
+
+        form.addParam('tileOverlap', IntParam,
+                      default=64,
+                      condition='tileSize > 0',
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Tile overlap (voxels)',
+                      help='Minimum overlap between neighbouring tiles, at most half the tile size. The predictions '
+                           'near the borders of a tile lack context, so the outer quarter of each overlap is taken '
+                           'from the other tile, and the scores are blended linearly in the middle half.')
+
         form.addParam('additionalArgs', StringParam,
                       default="",
                       expertLevel=LEVEL_ADVANCED,
                       label='Additional options',
                       help='You can enter additional command line options to MemBrain here.')
 
+        form.addParam('useWorker', BooleanParam,
+                      default=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Keep the model loaded between tomograms?',
+                      help='If set to Yes, a persistent MemBrain-seg process is launched for each GPU or CPU worker '
+                           'used by the protocol. It loads the model once and segments all the tomograms assigned to '
+                           'that device, '
+                           'avoiding the environment activation and the model loading for each tomogram. If set to '
+                           'No, the membrain program is executed for each tomogram.')
+
+        form.addParam('cpuBackend', EnumParam,
+                      choices=CPU_BACKENDS,
+                      default=CPU_BACKEND_PYTORCH,
+                      condition='useWorker',
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Inference backend on CPU',
+                      help='Model used by the CPU workers. TorchScript runs the model exported once to TorchScript, '
+                           'frozen and optimized for inference (fused layers and oneDNN kernels), and saved next to '
+                           'the checkpoint for later runs. TorchScript bfloat16 also halves the precision of the '
+                           'weights and activations, which is faster on CPUs with native bfloat16 support (AVX512-BF16 '
+                           'or AMX) but may change a few voxels of the segmentations. The GPUs always use the PyTorch '
+                           'model.')
+
+        form.addParam('checkCpuBackend', BooleanParam,
+                      default=True,
+                      condition='useWorker and cpuBackend != 0',
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Check the CPU backend?',
+                      help='If set to Yes, a crop of the first tomogram segmented on CPU is segmented with both the '
+                           'PyTorch model and the chosen backend, and their agreement (Dice coefficient of the '
+                           'segmentations and differences of the scores) and times are reported in the log and the '
+                           'summary.')
+
+        form.addParam('useCache', BooleanParam,
+                      default=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Use the segmentation cache?',
+                      help='If the segmentation cache is enabled (variable MEMBRAIN_SEG_CACHE_DIR of the plugin '
+                           'configuration), tomograms already segmented with the same model and parameters, in this or '
+                           'any other project, are not segmented again: their results are retrieved from the cache. '
+                           'The new results are added to the cache.')
+
+        form.addParam('scratchDir', StringParam,
+                      default='',
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Local scratch directory',
+                      help='Directory on a local disk of the processing machine (e.g. /tmp or /scratch). If set, the '
+                           'tomograms are copied there before being segmented, prefetching the next ones while the '
+                           'current ones are processed, and the results are written there and copied back to the '
+                           'project in background. The results are registered only once their copy has been '
+                           'verified. This avoids many workers reading and writing big files on a shared network '
+                           'filesystem at the same time. Leave it empty to read and write the files in place.')
+
+        form.addParam('scratchPrefetch', IntParam,
+                      default=1,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Tomograms prefetched per device',
+                      help='Number of tomograms staged in the scratch directory in advance for each GPU or CPU '
+                           'worker, besides the one being processed.')
+
+        self._defineCompressionParams(form)
+
+        form.addParam('computeStats', BooleanParam,
+                      default=True,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Store quality statistics?',
+                      help='If set to Yes, the fraction of membrane voxels, the bounding box of the membranes and the '
+                           'number of connected components of each segmentation, and the histogram of membrane '
+                           'probabilities of each probability map, are computed when the outputs are registered and '
+                           'stored in the output items. The sets can then be sorted and filtered by them without '
+                           'opening the volumes. The components are counted only if they are labelled or counting '
+                           'them is requested (see the connected components analysis); otherwise, their number is '
+                           'stored as %d.' % N_COMPONENTS_UNKNOWN)
+
+        self._definePreviewParams(form)
+
         form.addSection(label='Connected components analysis')
         form.addParam('storeConnectedComponents', BooleanParam,
                       default=False,
@@ -116,6 +328,15 @@ class ProtMemBrainSeg(EMProtocol):
                       label='Threshold for connected components',
                       help='Components smaller than this size (in voxels) will be removed from the segmentation. A negative value disables this parameter.')
 
+        form.addParam('countComponents', BooleanParam,
+                      default=False,
+                      condition='computeStats and not storeConnectedComponents',
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Count the connected components?',
+                      help='If set to Yes, the connected components of the segmentations are counted for the quality '
+                           'statistics even if they are not labelled. This takes an extra pass over each segmentation, '
+                           'labelling it by blocks.')
+
         form.addSection(label='Test-time augmentation (TTA)')
         form.addParam('testTimeAugmentation', BooleanParam,
                       default=True,
@@ -127,136 +348,751 @@ class ProtMemBrainSeg(EMProtocol):
                       label='Output probability maps?',
                       help='Stores probability maps obtained from 8-fold test-time augmentation in addition to the segmentations.')
 
-        form.addHidden(GPU_LIST, StringParam,
-                       default='0',
-                       expertLevel=LEVEL_ADVANCED,
-                       label='Choose GPU IDs',
-                       help='GPU device to be used. If no GPU is found, MemBrain-seg will run on CPU using the number of threads specified (much slower)')
+        form.addParam('scoresEncoding', EnumParam,
+                      choices=SCORES_ENCODINGS,
+                      default=SCORES_FLOAT32,
+                      condition='storeProbabilities',
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Probability maps data type',
+                      help='float16 halves the size of the probability maps with a negligible precision loss. int8 '
+                           'divides it by 4, quantizing the scores in 255 levels: the scale to recover them is stored in '
+                           'the MRC header and applied by the re-threshold protocol, but other programs will read the '
+                           'quantized values.')
+
+        form.addSection(label='Skeletonization')
+        form.addParam('doSkeletonize', BooleanParam,
+                      default=False,
+                      label='Skeletonize the segmentations?',
+                      help='If set to Yes, each segmentation is skeletonized right after it is computed, in the same '
+                           'step, and the skeletons are registered as an additional output. It is equivalent to '
+                           'running the protocol "tomomask skeletonize" on the segmentations, but the segmentations '
+                           'are read back while they are still in the disk cache (or in the local scratch directory) '
+                           'and no second protocol has to go through all the tomograms.')
+        self._defineSkeletonizeParams(form, condition='doSkeletonize')
 
-        form.addParallelSection(threads=1, mpi=0)
+        self._defineBatchParams(form)
+        self._defineDeviceParams(form)
+        self._defineStreamingParams(form)
 
     # -------------------------- INSERT steps functions -----------------------
-    def _insertAllSteps(self):
-        deps = []
-        self._initialize()
-        for tomoId in self.tomoDict.keys():
-            mbId = self._insertFunctionStep(self.runMemBrainSeg,
-                                            tomoId,
-                                            prerequisites=[],
-                                            needsGPU=True)
-            cOutId = self._insertFunctionStep(self.createOutputStep,
-                                              tomoId,
-                                              prerequisites=mbId,
-                                              needsGPU=False)
-            deps.append(cOutId)
-        self._insertFunctionStep(self._closeOutputSet,
-                                 prerequisites=deps,
-                                 needsGPU=False)
+    def _addInputItem(self, tomoId: str, tomo: Tomogram):
+        self.tomoDict[tomoId] = tomo
+        self._getSourceId(tomoId)
 
+    def _insertBatchSteps(self, tomoIds: List[str]) -> int:
+        # Tomograms pointing to data already segmented in this run get their results from it
+        sourceIds = [tomoId for tomoId in tomoIds if self.sourceDict[tomoId] == tomoId]
+        # The tiled tomograms get their own steps, one for each tile
+        for tomoId in [tomoId for tomoId in sourceIds if self._isTiled(self.tomoDict[tomoId])]:
+            self.runSteps[tomoId] = self._insertTileSteps(tomoId)
+            sourceIds.remove(tomoId)
+        if sourceIds:
+            if self._getStager():
+                for tomoId in sourceIds:
+                    self.stager.add(tomoId, self.tomoDict[tomoId].getFileName())
+            runId = self._insertFunctionStep(self.runMemBrainSeg,
+                                             *sourceIds,
+                                             prerequisites=[],
+                                             needsGPU=False)
+            self.runSteps.update({tomoId: runId for tomoId in sourceIds})
+        runIds = {self.runSteps[sourceId] for tomoId in tomoIds
+                  if (sourceId := self.sourceDict[tomoId]) in self.runSteps}
+        return self._insertFunctionStep(self.createOutputStep,
+                                        *tomoIds,
+                                        prerequisites=sorted(runIds),
+                                        needsGPU=False)
+
+    def _insertTileSteps(self, tomoId: str) -> int:
+        """ Insert the steps to segment a tomogram by tiles. The tiles are segmented by independent steps, in
+        parallel, on the devices available. The number of tile steps is the number of tiles of the whole tomogram: if
+        only a region is segmented, the ones left over do nothing.
+        :return: the id of the step that stitches the tiles.
+        """
+        prepareId = self._insertFunctionStep(self.prepareTilesStep,
+                                             tomoId,
+                                             prerequisites=[],
+                                             needsGPU=False)
+        tileIds = [self._insertFunctionStep(self.segmentTileStep,
+                                            tomoId, tileIndex,
+                                            prerequisites=prepareId,
+                                            needsGPU=False)
+                   for tileIndex in range(self._getNTiles(self.tomoDict[tomoId]))]
+        return self._insertFunctionStep(self.stitchTilesStep,
+                                        tomoId,
+                                        prerequisites=tileIds,
+                                        needsGPU=False)
 
     def _initialize(self):
-        self.tomoDict = {tomo.getTsId(): tomo.clone() for tomo in self._getInTomos()}
+        self.tomoDict = {}
+        self.sourceDict = {}
+        self.dataDict = {}
+        self.runSteps = {}
+        self.tileJobs = {}
 
-    def runMemBrainSeg(self, tomoId: str):
+    def _getSourceId(self, tomoId: str) -> str:
+        """ Map a tomogram to the first one pointing to the same data (e.g. links to the same file). """
+        dataKey = realpath(self.tomoDict[tomoId].getFileName())
+        self.sourceDict[tomoId] = self.dataDict.setdefault(dataKey, tomoId)
+        return self.sourceDict[tomoId]
+
+    def runMemBrainSeg(self, *tomoIds: str):
+        """ Segment the given tomograms, one after the other. """
+        for tomoId in tomoIds:
+            self._segment(tomoId)
+
+    def _segment(self, tomoId: str):
         tomo = self.tomoDict[tomoId]
         tomoFile = tomo.getFileName()
+        nVoxels = self._getNVoxels(tomo)
+        outFiles = {suffix: self._getOutFileNameScipion(tomoId, suffix) for suffix in self._getOutSuffixes()}
+        stager = self._getStager()
+
+        if self._retrieveFromCache(tomoId, outFiles):
+            if stager:
+                stager.releaseInput(tomoId)
+            return
+
+        if stager:
+            tomoFile = stager.getInput(tomoId)
+            outDir = stager.getOutputDir(tomoId)
+        else:
+            outDir = self._getExtraPath()
+        region = self._getRegion(tomo, tomoFile, outDir)
+        binFactor = self._getBinFactor(tomo)
+        prepared = region is not None or binFactor > 1
+        if prepared:
+            # Binned and cropped by the CPU before waiting for the device
+            inputFile = join(outDir, f'{removeBaseExt(tomoFile)}_{SUFFIX_INPUT}.mrc')
+            with measure() as measurement:
+                shape = binFile(tomoFile, inputFile, binFactor, tomo.getSamplingRate(), region=region)
+            self._addPerfStats(tomoId, 'prepareInput', measurement.stats, binFactor=binFactor)
+            tomoFile = inputFile
+        args = self._getMemBrainSegArgs(tomoFile, outDir, self._getWindowSize(tomoId), binFactor)
+        self._runOnDevice(tomoId, tomoId, args, tomoFile, nVoxels=nVoxels)
+        if prepared:
+            os.remove(tomoFile)
+
+        if stager:
+            stager.releaseInput(tomoId)
+            localFiles = {suffix: self._getOutFileNameMembrain(tomoFile, suffix, outDir) for suffix in outFiles}
+            if prepared:
+                self._restoreOutputs(tomo, localFiles, binFactor, shape, region)
+            if self.doSkeletonize.get():
+                localFiles[SUFFIX_SKEL] = join(outDir, f'{tomoId}_{SUFFIX_SKEL}.mrc')
+                self._skeletonize(tomo, localFiles[SUFFIX_SEG], localFiles[SUFFIX_SKEL])
+            # The results are copied back while the device goes on with the next tomogram. They are registered and
+            # stored in the cache in the createOutputStep, once the copy has been verified
+            stager.copyBack(tomoId, {localFile: self._getOutFileNameScipion(tomoId, suffix)
+                                     for suffix, localFile in self._encodeOutputs(tomoId, localFiles).items()})
+            return
+
+        plainFiles = {suffix: self._getOutFileNameScipion(tomoId, suffix, encoded=False) for suffix in outFiles}
+        with measure() as measurement:
+            for suffix, plainFile in plainFiles.items():
+                membrainOutFile = self._getOutFileNameMembrain(tomoFile, suffix, outDir)
+                if membrainOutFile != plainFile:
+                    moveFile(membrainOutFile, plainFile)
+        self._addPerfStats(tomoId, 'moveFiles', measurement.stats)
+        if prepared:
+            self._restoreOutputs(tomo, plainFiles, binFactor, shape, region)
+
+        if self.doSkeletonize.get():
+            plainFiles[SUFFIX_SKEL] = self._getOutFileNameScipion(tomoId, SUFFIX_SKEL, encoded=False)
+            self._skeletonize(tomo, plainFiles[SUFFIX_SEG], plainFiles[SUFFIX_SKEL])
+        self._encodeOutputs(tomoId, plainFiles)
+
+        if self._getSegCache():
+            self._getSegCache().put(self._getCacheKey(tomoId), outFiles)
+
+    def _runOnDevice(self, jobId: str, tomoId: str, args: str, inputFile: str, **extra):
+        """ Run 'membrain segment' with the given arguments on the first device available, in the persistent worker of
+        the device or as a new process.
+        :param jobId: id of the job for the scheduler: the tomogram, or one of its tiles.
+        :param inputFile: tomogram segmented by the job.
+        :param extra: fields added to the record of the segmentation in the trace file.
+        """
+        t0 = time.time()
+        with self._getScheduler().device(jobId, self._getHostMemoryNeeds(tomoId)) as device:
+            self._addPerfStats(tomoId, 'deviceWait', PerfStats(time.time() - t0), total=False)
+            self.info(f'Segmenting {jobId} on {device}')
+            if self.useWorker.get():
+                worker = self._getSegWorker(device)
+                backend = None if device.isGpu() else self._getCpuBackend()
+                if backend and self._claimCpuBackendCheck():
+                    self._checkCpuBackend(worker, backend, tomoId, inputFile)
+                output, workerStats = worker.run(args, backend)
+                self.info(output)
+                if 'startTime' in workerStats:
+                    self._addPerfStats(tomoId, 'workerStart', PerfStats(workerStats['startTime']), device=str(device))
+                if workerStats.get('modelLoadTime'):
+                    # Included in the segmentation
+                    self._addPerfStats(tomoId, 'modelLoad', PerfStats(workerStats['modelLoadTime']), total=False)
+                stats = PerfStats(**{field: workerStats.get(field, 0) for field in PerfStats._fields})
+            else:
+                stats = self._runJobWithStats(
+                    self._getJobCmd(Plugin.getMemBrainSegCmd() % {'GPU': device.getCudaVisibleDevices()}, device),
+                    args, env=self._getJobEnviron(Plugin.getMemBrainSegEnviron()))
+            self._addPerfStats(tomoId, 'segment', stats, device=str(device), **extra)
+
+    def _checkCpuBackend(self, worker: MemBrainSegWorker, backend: str, tomoId: str, inputFile: str):
+        """ Segment a central crop of a tomogram, of the size of the sliding window, with the PyTorch model and with
+        the given CPU backend, and report their agreement and times. """
+        checkDir = self._getTmpPath('cpuBackendCheck')
+        makePath(checkDir)
+        windowSize = self._getWindowSize(tomoId)
+        with mrcfile.mmap(inputFile, mode='r', permissive=True) as mrc:
+            shape = mrc.data.shape
+            samplingRate = float(mrc.voxel_size.x)
+        crop = tuple(slice(max((size - windowSize) // 2, 0), min(max((size - windowSize) // 2, 0) + windowSize, size))
+                     for size in shape)
+        cropFile = join(checkDir, f'{tomoId}_crop.mrc')
+        binFile(inputFile, cropFile, 1, samplingRate, region=crop)
+
+        # The score maps are compared too if test-time augmentation is used, as they are only stored then
+        suffixes = [SUFFIX_SEG, SUFFIX_SCORES] if self.testTimeAugmentation else [SUFFIX_SEG]
+        outFiles = {}
+        times = {}
+        for name in (BACKEND_PYTORCH, backend):
+            outDir = join(checkDir, name)
+            makePath(outDir)
+            _, stats = worker.run(self._getMemBrainSegArgs(cropFile, outDir, windowSize, tiled=True), name)
+            # Without the export or loading of the model
+            times[name] = stats.get('wallTime', 0) - stats.get('modelLoadTime', 0)
+            outFiles[name] = {suffix: self._getOutFileNameMembrain(cropFile, suffix, outDir) for suffix in suffixes}
+        refFiles, backendFiles = outFiles[BACKEND_PYTORCH], outFiles[backend]
+        agreement = measureAgreement(refFiles[SUFFIX_SEG], backendFiles[SUFFIX_SEG],
+                                     refFiles.get(SUFFIX_SCORES), backendFiles.get(SUFFIX_SCORES))
+        shutil.rmtree(checkDir)
+
+        self._addPerfStats(tomoId, 'cpuBackendCheck', PerfStats(times[backend]), total=False, backend=backend,
+                           referenceTime=times[BACKEND_PYTORCH], cropShape=[s.stop - s.start for s in crop],
+                           **agreement)
+        message = self._getCpuBackendCheckMessage(backend, agreement, times[BACKEND_PYTORCH], times[backend])
+        if agreement['dice'] < BACKEND_CHECK_MIN_DICE:
+            self.warning(message)
+        else:
+            self.info(message)
 
+    @staticmethod
+    def _getCpuBackendCheckMessage(backend: str, agreement: Dict[str, float], referenceTime: float,
+                                   backendTime: float) -> str:
+        message = ('CPU backend %s compared with PyTorch: Dice %.4f, %.3f%% of the voxels agree'
+                   % (backend, agreement['dice'], 100 * agreement['voxelAgreement']))
+        if 'maxScoreDiff' in agreement:
+            message += ', scores differ %.2g at most (%.2g on average)' % (agreement['maxScoreDiff'],
+                                                                          agreement['meanScoreDiff'])
+        return message + '; %.1f s instead of %.1f s.' % (backendTime, referenceTime)
+
+    def _retrieveFromCache(self, tomoId: str, outFiles: Dict[str, str]) -> bool:
+        """ Get the results of a tomogram, {suffix: file}, from the segmentation cache, skeletonizing them if
+        requested.
+        :return: True if they were in the cache.
+        """
+        cache = self._getSegCache()
+        if not cache:
+            return False
+        with measure() as measurement:
+            cacheHit = cache.get(self._getCacheKey(tomoId), outFiles)
+        if not cacheHit:
+            return False
+        tomo = self.tomoDict[tomoId]
+        self._addPerfStats(tomoId, 'cacheGet', measurement.stats, nVoxels=self._getNVoxels(tomo))
+        self.info(f'Segmentation of {tomoId} retrieved from the cache.')
+        if self.doSkeletonize.get():
+            skelFile = self._getOutFileNameScipion(tomoId, SUFFIX_SKEL, encoded=False)
+            self._skeletonize(tomo, outFiles[SUFFIX_SEG], skelFile)
+            self._encodeOutputs(tomoId, {SUFFIX_SKEL: skelFile})
+        return True
+
+    def prepareTilesStep(self, tomoId: str):
+        """ Get a tomogram ready to be segmented by tiles: binned or cropped to its region if needed. """
+        tomo = self.tomoDict[tomoId]
+        outFiles = {suffix: self._getOutFileNameScipion(tomoId, suffix) for suffix in self._getOutSuffixes()}
+        if self._retrieveFromCache(tomoId, outFiles):
+            self.tileJobs[tomoId] = None
+            return
+        tmpDir = self._getTmpPath(f'{tomoId}_{SUFFIX_TILE}s')
+        makePath(tmpDir)
+        tomoFile = tomo.getFileName()
+        region = self._getRegion(tomo, tomoFile, tmpDir)
+        binFactor = self._getBinFactor(tomo)
+        x, y, z = tomo.getDim()
+        shape = fullShape = (z, y, x)
+        if region is not None or binFactor > 1:
+            inputFile = join(tmpDir, f'{tomoId}_{SUFFIX_INPUT}.mrc')
+            with measure() as measurement:
+                binFile(tomoFile, inputFile, binFactor, tomo.getSamplingRate(), region=region)
+            self._addPerfStats(tomoId, 'prepareInput', measurement.stats, binFactor=binFactor)
+            tomoFile = inputFile
+            with mrcfile.mmap(inputFile, mode='r', permissive=True) as mrc:
+                shape = mrc.data.shape
+        job = TileJob(tomoFile, tmpDir, shape, fullShape, region, binFactor)
+        self.info(f'Segmenting {tomoId} in {len(job.getTiles(self.tileSize.get(), self.tileOverlap.get()))} tiles')
+        self.tileJobs[tomoId] = job
+
+    def segmentTileStep(self, tomoId: str, tileIndex: int):
+        """ Segment a tile of a tomogram, keeping its score map to be stitched. """
+        job = self.tileJobs[tomoId]
+        if job is None:  # Retrieved from the cache
+            return
+        tiles = job.getTiles(self.tileSize.get(), self.tileOverlap.get())
+        if tileIndex >= len(tiles):  # Only a region of the tomogram is segmented
+            return
+        tile = tiles[tileIndex]
+        tileFile = self._getTileFileName(job, tomoId, tileIndex)
+        samplingRate = self.tomoDict[tomoId].getSamplingRate() * job.binFactor
+        with measure() as measurement:
+            binFile(job.inputFile, tileFile, 1, samplingRate, region=tile)
+        self._addPerfStats(tomoId, 'prepareTile', measurement.stats, tile=tileIndex)
+        args = self._getMemBrainSegArgs(tileFile, job.tmpDir, self._getWindowSize(tomoId), job.binFactor, tiled=True)
+        self._runOnDevice(f'{tomoId}_{SUFFIX_TILE}{tileIndex}', tomoId, args, tileFile, tile=tileIndex)
+        os.remove(tileFile)
+        os.remove(self._getOutFileNameMembrain(tileFile, SUFFIX_SEG, job.tmpDir))
+
+    def stitchTilesStep(self, tomoId: str):
+        """ Blend the score maps of the tiles of a tomogram and threshold them, as 'membrain segment' does, then
+        process the results like those of a whole tomogram. """
+        job = self.tileJobs.pop(tomoId)
+        if job is None:  # Retrieved from the cache
+            return
+        tomo = self.tomoDict[tomoId]
+        samplingRate = tomo.getSamplingRate() * job.binFactor
+        tiles = job.getTiles(self.tileSize.get(), self.tileOverlap.get())
+        plainFiles = {suffix: self._getOutFileNameScipion(tomoId, suffix, encoded=False)
+                      for suffix in self._getOutSuffixes()}
+        scoresFile = plainFiles.get(SUFFIX_SCORES, join(job.tmpDir, f'{tomoId}_{SUFFIX_SCORES}.mrc'))
+        segFile = plainFiles[SUFFIX_SEG]
+        with measure() as measurement:
+            stitchTiles([self._getOutFileNameMembrain(self._getTileFileName(job, tomoId, i), SUFFIX_SCORES, job.tmpDir)
+                         for i in range(len(tiles))],
+                        job.shape, self.tileSize.get(), self.tileOverlap.get(), scoresFile, samplingRate)
+            thresholdFile(scoresFile, {self.segmentationThreshold.get(): segFile})
+            if self.storeConnectedComponents.get():
+                ccFile = join(job.tmpDir, f'{tomoId}_cc.mrc')
+                labelComponentsFile(segFile, {self._getComponentsThreshold(job.binFactor): ccFile},
+                                    executor=self._getProcessPool(self.skelProcesses.get()))
+                moveFile(ccFile, segFile)
+        self._addPerfStats(tomoId, 'stitch', measurement.stats, nVoxels=self._getNVoxels(tomo), nTiles=len(tiles))
+        if job.region is not None or job.binFactor > 1:
+            self._restoreOutputs(tomo, plainFiles, job.binFactor, job.fullShape, job.region)
+        shutil.rmtree(job.tmpDir)
+
+        if self.doSkeletonize.get():
+            plainFiles[SUFFIX_SKEL] = self._getOutFileNameScipion(tomoId, SUFFIX_SKEL, encoded=False)
+            self._skeletonize(tomo, plainFiles[SUFFIX_SEG], plainFiles[SUFFIX_SKEL])
+        self._encodeOutputs(tomoId, plainFiles)
+
+        if self._getSegCache():
+            self._getSegCache().put(self._getCacheKey(tomoId),
+                                    {suffix: self._getOutFileNameScipion(tomoId, suffix)
+                                     for suffix in self._getOutSuffixes()})
+
+    def _getRegion(self, tomo: Tomogram, tomoFile: str, tmpDir: str) -> Union[Block, None]:
+        """ Region of a tomogram to segment, from its mask and its specimen slab. None to segment it whole. """
+        tomoId = tomo.getTsId()
+        region = None
+        with measure() as measurement:
+            maskFile = self._getRegionMaskFile(tomoId)
+            if maskFile:
+                x, y, z = tomo.getDim()
+                region = getMaskRegion(maskFile, (z, y, x), tmpDir)
+                if region is None:
+                    self.warning(f'The mask of {tomoId} is empty, so it is segmented whole.')
+            if self.detectSlab.get():
+                slab = detectSlabFile(tomoFile)
+                if slab is None:
+                    self.info(f'No specimen slab detected in {tomoId}, so all its slices are segmented.')
+                elif region is None or min(getRegionShape(intersectRegions(region, slab))) > 0:
+                    region = intersectRegions(region, slab)
+        if region is not None:
+            self.info(f'Segmenting the region z {region[0].start}-{region[0].stop}, y {region[1].start}-'
+                      f'{region[1].stop}, x {region[2].start}-{region[2].stop} of {tomoId}')
+            self._addPerfStats(tomoId, 'detectRegion', measurement.stats, regionShape=getRegionShape(region))
+        return region
+
+    def _restoreOutputs(self, tomo: Tomogram, outFiles: Dict[str, str], binFactor: int, shape: Tuple[int, ...],
+                        region: Union[Block, None]):
+        """ Bring the outputs computed on a binned or cropped tomogram, {suffix: file}, back to its original grid,
+        in place, filling the voxels outside the region with background. """
+        with measure() as measurement:
+            for suffix, outFile in outFiles.items():
+                background = 0
+                if suffix == SUFFIX_SCORES and region is not None:
+                    with mrcfile.mmap(outFile, mode='r', permissive=True) as mrc:
+                        background = float(mrc.data.min())
+                upsampleFile(outFile, outFile, binFactor, shape, tomo.getSamplingRate(), region=region,
+                             background=background)
+        self._addPerfStats(tomo.getTsId(), 'restoreOutputs', measurement.stats)
+
+    def _skeletonize(self, tomo: Tomogram, segFile: str, skelFile: str):
+        """ Skeletonize a segmentation just computed, while it is still in the disk cache. """
+        self.info(f'Skeletonizing {tomo.getTsId()}')
+        with measure() as measurement:
+            skeletonizeFile(segFile, skelFile,
+                            samplingRate=tomo.getSamplingRate(),
+                            blockSize=self.skelBlockSize.get(),
+                            executor=self._getProcessPool(self.skelProcesses.get()))
+        # The CPU time and I/O of the skeletonization processes are not included
+        self._addPerfStats(tomo.getTsId(), 'skeletonize', measurement.stats)
+
+    def _encodeOutputs(self, tomoId: str, outFiles: Dict[str, str]) -> Dict[str, str]:
+        """ Apply the chosen encoding to the given output files of a tomogram, {suffix: file}, in place.
+        :return: the resulting files, whose names change if they are compressed.
+        """
+        encodedFiles = {}
+        with measure() as measurement:
+            for suffix, outFile in outFiles.items():
+                if suffix == SUFFIX_SCORES and self.scoresEncoding.get() != SCORES_FLOAT32:
+                    encodeScores(outFile, outFile, self.scoresEncoding.get())
+                encodedFiles[suffix] = compressFile(outFile) if self.compressOutputs.get() else outFile
+        if self.compressOutputs.get() or (SUFFIX_SCORES in outFiles and self.scoresEncoding.get() != SCORES_FLOAT32):
+            self._addPerfStats(tomoId, 'encode', measurement.stats)
+        return encodedFiles
+
+    def _getMemBrainSegArgs(self, tomoFile: str, outDir: str, windowSize: int, binFactor: int = 1,
+                            tiled: bool = False) -> str:
+        """ Arguments of 'membrain segment'. The tiles only need the score maps: their connected components are
+        labelled once stitched. """
         # Arguments to the membrain command defined in the plugin initialization:
         args = ' segment '
         args += ' --ckpt-path ' + Plugin.getMemBrainSegModelPath()
         args += ' --tomogram-path ' + tomoFile
-        args += ' --out-folder ' + self._getExtraPath()
+        args += ' --out-folder ' + outDir
         args += ' --segmentation-threshold ' + str(self.segmentationThreshold)
-        args += ' --sliding-window-size ' + str(self.slidingWindowSize)
+        args += ' --sliding-window-size ' + str(windowSize)
 
         if self.testTimeAugmentation:
             args += ' --test-time-augmentation'
 
-            if self.storeProbabilities:
+            if self.storeProbabilities or tiled:
                 args += ' --store-probabilities '
 
         else:
             args += ' --no-test-time-augmentation'
 
-        if self.storeConnectedComponents:
+        if self.storeConnectedComponents and not tiled:
             args += ' --store-connected-components '
 
             if self.connectedComponentsThreshold > 0:
-                args += ' --connected-component-thres ' + \
-                    str(self.connectedComponentsThreshold)
-            
+                args += ' --connected-component-thres ' + str(self._getComponentsThreshold(binFactor))
+
         args += " " + self.additionalArgs.get()
+        return args
+
+    # Output stuff is the same as in TomoSegMemTV protocol:
+    def createOutputStep(self, *tomoIds: str):
+        """ Register the results of the given tomograms. """
+        for tomoId in tomoIds:
+            self._createOutput(tomoId)
 
-        self.runJob(Plugin.getMemBrainSegCmd(), args)
+    def _createOutput(self, tomoId: str):
+        t0 = time.time()
+        sourceId = self.sourceDict[tomoId]
+        # The tiled tomograms are not staged
+        if self.stager and not self._isTiled(self.tomoDict[sourceId]):
+            self.stager.waitCopyBack(sourceId)
+            cache = self._getSegCache()
+            if cache and sourceId == tomoId:
+                cache.put(self._getCacheKey(tomoId), {suffix: self._getOutFileNameScipion(tomoId, suffix)
+                                                      for suffix in self._getOutSuffixes()})
+        if sourceId != tomoId:
+            for suffix in self._getOutSuffixes() + ([SUFFIX_SKEL] if self.doSkeletonize.get() else []):
+                createLink(self._getOutFileNameScipion(sourceId, suffix), self._getOutFileNameScipion(tomoId, suffix))
 
-        outputFile = self._getOutFileNameMembrain(tomoFile)
-        newOutputFile = self._getOutFileNameScipion(tomoId, SUFFIX_SEG)
-        moveFile(outputFile, newOutputFile)
+        if self.computeStats.get() or self.createPreviews.get():
+            # The tomograms sharing the results of another one may be registered at the same time as it
+            with self._getScanLock(sourceId):
+                if sourceId not in self.outputAttrs:
+                    self.outputAttrs[sourceId] = self._scanOutputs(sourceId)
 
-    # Output stuff is the same as in TomoSegMemTV protocol:
-    def createOutputStep(self, tomoId: str):
-        with self._lock:
-            outTomoSegs = self._createOutputSet()
-            inTomo = self.tomoDict[tomoId]
-            inTomoFileName = inTomo.getFileName()
+        inTomo = self.tomoDict[tomoId]
+        for outputName in self._getOutputNames():
+            # When resuming, the tomogram may be already registered in some outputs
+            if tomoId in self.registeredTsIds[outputName]:
+                continue
             tomoMask = TomoMask()
             tomoMask.copyInfo(inTomo)
-            tomoMask.setFileName(self._getOutFileNameScipion(tomoId, SUFFIX_SEG))
-            tomoMask.setVolName(inTomoFileName)
-            outTomoSegs.append(tomoMask)
-            outTomoSegs.write()
-            self._store(outTomoSegs)
-
-            if self.storeProbabilities:
-                # We do the same thing again for the probability maps, if they exist:
-                outTomoProbs = self._createOutputSet(isProbablityMap=True)
-                tomoMask = TomoMask()
-                tomoMask.copyInfo(inTomo)
-                tomoMask.setFileName(self._getOutFileNameScipion(tomoId, SUFFIX_SCORES))
-                tomoMask.setVolName(inTomoFileName)
-                outTomoProbs.append(tomoMask)
-                outTomoProbs.write()
-                self._store(outTomoProbs)
+            tomoMask.setFileName(self._getOutFileNameScipion(tomoId, OUTPUT_SUFFIXES[outputName]))
+            tomoMask.setVolName(inTomo.getFileName())
+            self._setDevice(tomoMask, *self._getJobIds(sourceId))
+            self._setPerfStats(tomoMask, sourceId)
+            for attrName, attr in self.outputAttrs.get(sourceId, {}).get(outputName, {}).items():
+                setattr(tomoMask, attrName, attr)
+            self._registerOutput(outputName, tomoMask)
+        self._addPerfStats(tomoId, 'createOutput', PerfStats(time.time() - t0), total=False)
+
+    def _getScanLock(self, tomoId: str) -> threading.Lock:
+        """ Lock that lets only one thread scan the results of a tomogram, writing its previews. """
+        with self._lock:
+            return self.scanLocks.setdefault(tomoId, threading.Lock())
+
+    def _scanOutputs(self, tomoId: str) -> Dict[str, Dict[str, Object]]:
+        """ Quality statistics and previews of the results of a tomogram, reading each output file once, as
+        {output name: {attribute name: attribute}}. """
+        outputAttrs = {}
+        with measure() as measurement:
+            for outputName in self._getOutputNames():
+                suffix = OUTPUT_SUFFIXES[outputName]
+                outFile = self._getOutFileNameScipion(tomoId, suffix)
+                scanners = []
+                if self.computeStats.get() and outputName == OUTPUT_TOMOMASK_NAME:
+                    scanners.append(SegmentationStatsScanner())
+                elif self.computeStats.get() and outputName == OUTPUT_TOMOPROBMAP_NAME:
+                    scanners.append(ScoresHistogramScanner())
+                if self.createPreviews.get():
+                    scanners.append(PreviewScanner(self._getPreviewPrefix(f'{tomoId}_{suffix}'),
+                                                   PREVIEW_SCORES if suffix == SUFFIX_SCORES else PREVIEW_MASK))
+                if not scanners:
+                    continue
+                results = scanFile(outFile, scanners)
+                attrs = outputAttrs[outputName] = {}
+                if self.createPreviews.get():
+                    attrs.update(self._getPreviewAttrs(results.pop()))
+                if not results:
+                    continue
+                if outputName == OUTPUT_TOMOMASK_NAME:
+                    attrs.update(self._getSegmentationStatsAttrs(outFile, results[0]))
+                else:
+                    attrs[SCORES_HISTOGRAM_ATTR] = CsvList(pType=int)
+                    attrs[SCORES_HISTOGRAM_ATTR].set(results[0])
+        self._addPerfStats(tomoId, 'scanOutputs', measurement.stats)
+        return outputAttrs
+
+    def _getSegmentationStatsAttrs(self, segFile: str, segStats: SegmentationStats) -> Dict[str, Object]:
+        if self.storeConnectedComponents.get():
+            # Already labelled when the segmentation was created
+            nComponents = segStats.nLabels
+        elif self.countComponents.get():
+            nComponents = countComponentsFile(segFile, executor=self._getProcessPool(self.skelProcesses.get()))
+        else:
+            nComponents = N_COMPONENTS_UNKNOWN
+        # The bounding box is empty for the segmentations without membranes, as all the items of a set need the same
+        # attributes
+        boundingBox = CsvList(pType=int)
+        boundingBox.set(list(segStats.boundingBox or []))
+        return {MEMBRANE_FRACTION_ATTR: Float(segStats.membraneFraction),
+                N_COMPONENTS_ATTR: Integer(nComponents),
+                BOUNDING_BOX_ATTR: boundingBox}
+
+    def closeOutputStep(self):
+        super().closeOutputStep()
+        with self.segWorkersLock:
+            for worker in self.segWorkers.values():
+                worker.stop()
+            self.segWorkers.clear()
+        if self.stager:
+            self.stager.close()
+            self.stager = None
 
     # --------------------------- UTILS functions ----------------------------------
+    def _getSegWorker(self, device: Device) -> MemBrainSegWorker:
+        """ Get the inference worker attached to the given device, creating it if needed. """
+        with self.segWorkersLock:
+            worker = self.segWorkers.get(str(device))
+            if worker is None:
+                launchCmd = Plugin.getMemBrainSegWorkerCmd() % {'GPU': device.getCudaVisibleDevices()}
+                worker = MemBrainSegWorker(self._getJobCmd(launchCmd, device),
+                                           self._getLogsPath(f'membrain_seg_worker_{device.kind}{device.index}.log'),
+                                           env=self._getJobEnviron(Plugin.getMemBrainSegEnviron()))
+                self.segWorkers[str(device)] = worker
+        return worker
+
+    def _getCpuBackend(self) -> Union[str, None]:
+        """ Backend of the CPU workers, or None for the PyTorch model, as the membrain executable. """
+        if not self.useWorker.get() or self.cpuBackend.get() == CPU_BACKEND_PYTORCH:
+            return None
+        return CPU_BACKEND_NAMES[self.cpuBackend.get()]
+
+    def _claimCpuBackendCheck(self) -> bool:
+        """ True for the first job that should check the CPU backend, so it is checked only once. """
+        if not self.checkCpuBackend.get():
+            return False
+        with self.segWorkersLock:
+            claimed = not self.cpuBackendChecked
+            self.cpuBackendChecked = True
+        return claimed
+
+    def _getStager(self) -> Union[ScratchStager, None]:
+        """ Stager of the files in the local scratch directory, or None if it is not used. """
+        scratchDir = self.scratchDir.get()
+        if not scratchDir:
+            return None
+        with self.segWorkersLock:
+            if self.stager is None:
+                nDevices = len(self._getScheduler().getDevices())
+                self.stager = ScratchStager(scratchDir, maxStaged=nDevices * (1 + max(self.scratchPrefetch.get(), 0)))
+        return self.stager
+
+    def _getSegCache(self) -> Union[SegmentationCache, None]:
+        """ Segmentation cache, or None if it is not used. """
+        cacheDir = Plugin.getMemBrainSegCacheDir()
+        if not (self.useCache.get() and cacheDir):
+            return None
+        with self.segWorkersLock:
+            if self.segCache is None:
+                self.segCache = SegmentationCache(cacheDir, Plugin.getMemBrainSegCacheSize())
+        return self.segCache
+
+    def _getCacheKey(self, tomoId: str) -> str:
+        return self._getSegCache().getKey(self.tomoDict[tomoId].getFileName(), Plugin.getMemBrainSegModelPath(),
+                                          self._getCacheParams(tomoId))
+
+    def _getCacheParams(self, tomoId: str) -> dict:
+        """ Everything but the tomogram and the model that determines the segmentation result. """
+        params = {'version': MEMBRAIN_SEG_VERSION,
+                  'segmentationThreshold': self.segmentationThreshold.get(),
+                  'slidingWindowSize': self._getWindowSize(tomoId),
+                  'testTimeAugmentation': self.testTimeAugmentation.get(),
+                  'storeProbabilities': self.storeProbabilities.get(),
+                  'storeConnectedComponents': self.storeConnectedComponents.get(),
+                  'additionalArgs': self.additionalArgs.get().split()}
+        if self.storeConnectedComponents.get() and self.connectedComponentsThreshold.get() > 0:
+            params['connectedComponentsThreshold'] = self.connectedComponentsThreshold.get()
+        # The cached files are the encoded ones
+        if self.storeProbabilities.get() and self.scoresEncoding.get() != SCORES_FLOAT32:
+            params['scoresEncoding'] = self.scoresEncoding.get()
+        if self.compressOutputs.get():
+            params['compressOutputs'] = True
+        binFactor = self._getBinFactor(self.tomoDict[tomoId])
+        if binFactor > 1:
+            params['binFactor'] = binFactor
+        if self.detectSlab.get():
+            params['detectSlab'] = True
+        if self._getCpuBackend():
+            params['cpuBackend'] = self._getCpuBackend()
+        if self._isTiled(self.tomoDict[tomoId]):
+            params['tileSize'] = self.tileSize.get()
+            params['tileOverlap'] = self.tileOverlap.get()
+        maskFile = self._getRegionMaskFile(tomoId)
+        if maskFile:
+            params['regionMask'] = self._getSegCache().getFileHash(maskFile)
+        return params
+
+    def _getRegionMaskFile(self, tomoId: str) -> Union[str, None]:
+        """ File of the mask of the region to segment of a tomogram, if any. """
+        inMasks = getattr(self, IN_REGION_MASKS).get()
+        if inMasks is None:
+            return None
+        with self._lock:
+            # Reloaded if the tomogram is not found, as the masks may be arriving in streaming
+            if self.regionMaskFiles is None or tomoId not in self.regionMaskFiles:
+                inMasks.loadAllProperties()
+                self.regionMaskFiles = {mask.getTsId(): mask.getFileName() for mask in inMasks.iterItems()}
+        return self.regionMaskFiles.get(tomoId)
+
+    def _getBinFactor(self, tomo: Tomogram) -> int:
+        """ Factor a tomogram is binned by before being segmented, 1 if it is not binned. """
+        if not self.rescale.get():
+            return 1
+        return getBinFactor(tomo.getSamplingRate(), self.targetSamplingRate.get())
+
+    def _getNVoxels(self, tomo: Tomogram) -> int:
+        """ Number of voxels segmented by MemBrain-seg for a tomogram, once binned. """
+        x, y, z = getBinnedShape(tomo.getDim() or (0, 0, 0), self._getBinFactor(tomo))
+        return x * y * z
+
+    def _getJobVoxels(self, tomo: Tomogram) -> int:
+        """ Number of voxels segmented by each MemBrain-seg job of a tomogram: the whole tomogram or a tile. """
+        x, y, z = getBinnedShape(tomo.getDim() or (0, 0, 0), self._getBinFactor(tomo))
+        if self.tileSize.get() > 0:
+            x, y, z = (min(n, self.tileSize.get()) for n in (x, y, z))
+        return x * y * z
+
+    def _getNTiles(self, tomo: Tomogram) -> int:
+        """ Number of tiles of a tomogram, once binned, 1 if it is not tiled. """
+        if self.tileSize.get() <= 0:
+            return 1
+        x, y, z = getBinnedShape(tomo.getDim() or (0, 0, 0), self._getBinFactor(tomo))
+        return countTiles((z, y, x), self.tileSize.get(), self.tileOverlap.get())
+
+    def _isTiled(self, tomo: Tomogram) -> bool:
+        return self._getNTiles(tomo) > 1
+
+    def _getJobIds(self, tomoId: str) -> List[str]:
+        """ Ids of the jobs of a tomogram for the scheduler: the tomogram or each of its tiles. """
+        tomo = self.tomoDict[tomoId]
+        if not self._isTiled(tomo):
+            return [tomoId]
+        return [f'{tomoId}_{SUFFIX_TILE}{tileIndex}' for tileIndex in range(self._getNTiles(tomo))]
+
+    @staticmethod
+    def _getTileFileName(job: TileJob, tomoId: str, tileIndex: int) -> str:
+        return join(job.tmpDir, f'{tomoId}_{SUFFIX_TILE}{tileIndex}.mrc')
+
+    def _getComponentsThreshold(self, binFactor: int) -> int:
+        """ Minimum size of the connected components in voxels of the segmented tomogram, given in voxels of the
+        original one. 0 to keep all of them. """
+        if self.connectedComponentsThreshold.get() <= 0:
+            return 0
+        return max(round(self.connectedComponentsThreshold.get() / binFactor ** 3), 1)
+
+    def _getWindowSize(self, tomoId: str) -> int:
+        """ Sliding window size used for a tomogram: the one requested, unless it has to be reduced to fit in the
+        GPU memory. """
+        if not self.autoWindowSize.get():
+            return self.slidingWindowSize.get()
+        with self.segWorkersLock:
+            if tomoId not in self.windowSizes:
+                windowSize = self.slidingWindowSize.get()
+                gpuMemory = self._getGpuMemoryBudget()
+                if gpuMemory is None:
+                    self.info('The GPU memory is unknown, so the window size of %s is not reduced.' % tomoId)
+                else:
+                    nVoxels = self._getJobVoxels(self.tomoDict[tomoId])
+                    windowSize = chooseWindowSize(nVoxels, windowSize, gpuMemory)
+                    if windowSize is None:
+                        windowSize = MIN_WINDOW_SIZE
+                        self.warning('%s is not expected to fit in %.1f GB of GPU memory even with the smallest '
+                                     'window size.' % (tomoId, gpuMemory / GiB))
+                    elif windowSize != self.slidingWindowSize.get():
+                        self.info('Sliding window size reduced to %d for %s to fit in %.1f GB of GPU memory.'
+                                  % (windowSize, tomoId, gpuMemory / GiB))
+                self.windowSizes[tomoId] = windowSize
+            return self.windowSizes[tomoId]
+
+    def _getHostMemoryNeeds(self, tomoId: str) -> Dict[str, int]:
+        """ Estimated host memory needed to segment a tomogram, or one of its tiles, on a GPU and on a CPU worker. """
+        nVoxels = self._getJobVoxels(self.tomoDict[tomoId])
+        windowSize = self._getWindowSize(tomoId)
+        return {GPU: estimateMemory(nVoxels, windowSize, onGpu=True).host,
+                CPU: estimateMemory(nVoxels, windowSize, onGpu=False).host}
+
+    def _getOutputNames(self) -> List[str]:
+        outputNames = [OUTPUT_TOMOMASK_NAME]
+        if self.storeProbabilities.get():
+            outputNames.append(OUTPUT_TOMOPROBMAP_NAME)
+        if self.doSkeletonize.get():
+            outputNames.append(OUTPUT_TOMOSKEL_NAME)
+        return outputNames
+
+    def _getOutSuffixes(self) -> List[str]:
+        return [SUFFIX_SEG, SUFFIX_SCORES] if self.storeProbabilities.get() else [SUFFIX_SEG]
+
     def _getInTomos(self, retPointer: bool = False) -> Union[SetOfTomograms, Pointer]:
         inTomosPointer = getattr(self, IN_TOMOS)
         return inTomosPointer if retPointer else inTomosPointer.get()
 
-    def _createOutputSet(self, isProbablityMap: bool = False) -> SetOfTomoMasks:
-        if isProbablityMap:
-            outName = OUTPUT_TOMOPROBMAP_NAME
-            suffix = SUFFIX_SCORES
-        else:
-            outName = OUTPUT_TOMOMASK_NAME
-            suffix = SUFFIX_SEG
-        outTomoMasks = getattr(self, outName, None)
-        if outTomoMasks:
-            outTomoMasks.enableAppend()
-        else:
-            outTomoMasks = SetOfTomoMasks.create(self._getPath(),
-                                                template='tomomasks%s.sqlite',
-                                                suffix=suffix)
-            inTomoSet = self._getInTomos()
-            outTomoMasks.copyInfo(inTomoSet)
-            outTomoMasks.setStreamState(Set.STREAM_OPEN)
-
-            self._defineOutputs(**{outName: outTomoMasks})
-            self._defineSourceRelation(self._getInTomos(retPointer=True), outTomoMasks)
-
-        return outTomoMasks
+    def _getOutputSuffix(self, outputName: str) -> str:
+        return OUTPUT_SUFFIXES[outputName]
 
-    def _getOutFileNameMembrain(self, tomoFileName: str) -> str:
+    def _getOutFileNameMembrain(self, tomoFileName: str, suffix: str = SUFFIX_SEG, outDir: str = None) -> str:
         tomoBaseName = removeBaseExt(tomoFileName)
+        outDir = outDir or self._getExtraPath()
+        if suffix == SUFFIX_SCORES:
+            # MemBrain-seg does not add the model name to the probability maps
+            return join(outDir, f'{tomoBaseName}_{SUFFIX_SCORES}.mrc')
         modelBaseName = basename(Plugin.getMemBrainSegModelPath())
-        return self._getExtraPath(f'{tomoBaseName}_{modelBaseName}_{SUFFIX_SEG}.mrc')
+        return join(outDir, f'{tomoBaseName}_{modelBaseName}_{suffix}.mrc')
 
-    def _getOutFileNameScipion(self, tomoId: str, suffix: str) -> str:
-        return self._getExtraPath(f'{tomoId}_{suffix}.mrc')
+    def _getOutFileNameScipion(self, tomoId: str, suffix: str, encoded: bool = True) -> str:
+        """ Name of an output file. If not encoded, the name it has before being compressed. """
+        ext = '.mrc' + (COMPRESSED_EXT if encoded and self.compressOutputs.get() else '')
+        return self._getExtraPath(f'{tomoId}_{suffix}{ext}')
 
     # --------------------------- INFO functions -----------------------------------
     def _validate(self):
         errors = []
+        self._validateThreads(errors)
 
         if not self.testTimeAugmentation and self.storeProbabilities:
             errors.append(
@@ -268,8 +1104,46 @@ class ProtMemBrainSeg(EMProtocol):
 
         if self.slidingWindowSize.get() % 32 != 0:
             errors.append('Sliding window size must be multiple of 32.')
+
+        if self.rescale.get() and not self.targetSamplingRate.get() > 0:
+            errors.append('The pixel size of the model must be positive.')
+
+        if self.tileSize.get() > 0:
+            if not 0 <= 2 * self.tileOverlap.get() <= self.tileSize.get():
+                errors.append('The tile overlap must be between 0 and half the tile size.')
+            if not self.testTimeAugmentation:
+                errors.append('Test-time augmentation must be enabled to segment by tiles, as the score maps of the '
+                              'tiles are blended.')
         return errors
 
+    def _warnings(self):
+        """ Check that the largest tomogram of the input set fits in the memory budgets. """
+        warnings = []
+        inTomos = self._getInTomos()
+        maxVoxels = max((self._getJobVoxels(tomo) for tomo in inTomos.iterItems()), default=0) if inTomos else 0
+        if not maxVoxels:
+            return warnings
+        windowSize = self.slidingWindowSize.get()
+        hostBudget = self._getHostMemoryBudget()
+        hostNeeded = estimateMemory(maxVoxels, windowSize, onGpu=bool(self.getGpuList())).host
+        if hostNeeded > hostBudget:
+            warnings.append('The largest tomogram is expected to need %.1f GB of host memory, more than the budget of '
+                            '%.1f GB. It will be processed alone, but it may still run out of memory.'
+                            % (hostNeeded / GiB, hostBudget / GiB))
+        gpuBudget = self._getGpuMemoryBudget() if self.getGpuList() else None
+        if gpuBudget is not None and not self.autoWindowSize.get():
+            gpuNeeded = estimateMemory(maxVoxels, windowSize).device
+            if gpuNeeded > gpuBudget:
+                warnings.append('The largest tomogram is expected to need %.1f GB of GPU memory with a sliding window '
+                                'size of %d, more than the %.1f GB available. Consider reducing the window size or '
+                                'letting the protocol reduce it.' % (gpuNeeded / GiB, windowSize, gpuBudget / GiB))
+        return warnings
+
+    def _getCpuBackendCheckSummary(self) -> List[str]:
+        """ Result of the check of the CPU backend, from its record in the trace file. """
+        return [self._getCpuBackendCheckMessage(record['backend'], record, record['referenceTime'], record['wallTime'])
+                for record in self._getTraceRecords('cpuBackendCheck')[:1]]
+
     def _citations(self):
 
         cites = ['lamm_membrain_2024']
@@ -281,8 +1155,17 @@ class ProtMemBrainSeg(EMProtocol):
         nTomos = self.inTomograms.get().getSize()
         summary.append('%d tomograms segmented using MemBrain-seg.' % nTomos)
 
+        if self.rescale:
+            summary.append('The tomograms were binned to about %.1f Å/px before being segmented, and the outputs '
+                           'upsampled to their original size.' % self.targetSamplingRate.get())
+
         summary.append(
             'A sliding window of size %d was used for prediction.' % self.slidingWindowSize)
+        if self.autoWindowSize:
+            summary.append('The window size was reduced for the tomograms that did not fit in the GPU memory.')
+        if self.tileSize.get() > 0:
+            summary.append('The tomograms larger than %d voxels were segmented by tiles overlapping at least %d '
+                           'voxels.' % (self.tileSize.get(), self.tileOverlap.get()))
 
         if self.testTimeAugmentation:
             summary.append(
@@ -303,4 +1186,14 @@ class ProtMemBrainSeg(EMProtocol):
             summary.append('The threshold size for connected components was %d.' %
                            self.connectedComponentsThreshold)
 
+        if self.doSkeletonize:
+            summary.append('The segmentations were skeletonized.')
+
+        if self._getCpuBackend():
+            summary.append('The CPU workers used the %s backend.' % CPU_BACKENDS[self.cpuBackend.get()])
+            summary.extend(self._getCpuBackendCheckSummary())
+
+        summary.extend(self._getThreadsSummary())
+        summary.extend(self._getProcessPoolSummary())
+        summary.extend(self._getPerfSummary())
         return summary
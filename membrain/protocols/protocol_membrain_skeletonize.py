@@ -23,15 +23,22 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
-from typing import Union
-from membrain import Plugin, OUTPUT_TOMOMASK_NAME
-from pwem.convert.headers import setMRCSamplingRate
-from pwem.protocols import EMProtocol
+import os
+from typing import Union, List, Dict
+
+from membrain import OUTPUT_TOMOMASK_NAME
+from membrain.protocols.protocol_base import ProtMemBrainBase
+from membrain.utils.encoding import COMPRESSED_EXT, compressFile, removeCompressedExt
+from membrain.utils.preview import PreviewScanner
+from membrain.utils.skeletonize import skeletonizeFile
+from membrain.utils.sparse import SPARSE_EXT, writeSparse, readSparse, subsample
+from membrain.utils.stats import scanFile
 from pyworkflow import BETA
-from pyworkflow.object import Pointer, Set
-from pyworkflow.protocol import STEPS_PARALLEL, PointerParam, GPU_LIST, StringParam, LEVEL_ADVANCED
+from pyworkflow.object import Pointer
+from pyworkflow.protocol import STEPS_PARALLEL, PointerParam, EnumParam, IntParam, GE, ProtStreamingBase
 from pyworkflow.utils import Message, removeBaseExt
-from tomo.objects import SetOfTomoMasks, TomoMask
+from tomo.constants import SCIPION, BOTTOM_LEFT_CORNER
+from tomo.objects import SetOfTomoMasks, TomoMask, SetOfCoordinates3D, Coordinate3D
 
 # Inputs
 IN_TOMO_MASKS = 'inTomoMasks'
@@ -39,24 +46,41 @@ IN_TOMO_MASKS = 'inTomoMasks'
 # Suffixes
 SUFFIX_SKEL = 'skel'
 
+# Outputs
+OUTPUT_COORDINATES_NAME = 'coordinates'
+
+# Output formats
+SKEL_VOLUMES = 0
+SKEL_COORDINATES = 1
+SKEL_BOTH = 2
+SKEL_FORMATS = ['Tomo masks', 'Coordinates', 'Both']
+
 
-class ProtMemBrainSkeletonize(EMProtocol):
+class ProtMemBrainSkeletonize(ProtMemBrainBase, ProtStreamingBase):
     """
     Generate a skeletonized version of the membrane segmentations, similar to the output of tomosegmemtv (
-    https://github.com/anmartinezs/pyseg_system/tree/master/code/tomosegmemtv)
+    https://github.com/anmartinezs/pyseg_system/tree/master/code/tomosegmemtv). The skeletons are computed within
+    Scipion with the same method as 'membrain skeletonize', on CPU and in parallel.
 
     More info:
         https://teamtomo.org/membrain-seg/Usage/Segmentation/
     """
 
     _label = 'tomomask skeletonize'
-    _possibleOutputs = {OUTPUT_TOMOMASK_NAME: 'SetOfTomoMasks'}
+    _possibleOutputs = {OUTPUT_TOMOMASK_NAME: 'SetOfTomoMasks',
+                        OUTPUT_COORDINATES_NAME: 'SetOfCoordinates3D'}
     _devStatus = BETA
+    _inputName = IN_TOMO_MASKS
     stepsExecutionMode = STEPS_PARALLEL
 
+    @classmethod
+    def worksInStreaming(cls):
+        return True
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.tomoMaskDict = None
+        self.previews = {}
 
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -65,76 +89,183 @@ class ProtMemBrainSkeletonize(EMProtocol):
                       pointerClass='SetOfTomoMasks',
                       allowsNull=False,
                       label='Input tomo masks (segmentations)')
-        form.addHidden(GPU_LIST, StringParam,
-                       default='0',
-                       expertLevel=LEVEL_ADVANCED,
-                       label='Choose GPU IDs',
-                       help='GPU device to be used. If no GPU is found, MemBrain-seg will run on CPU using the number of threads specified (much slower)')
 
-        form.addParallelSection(threads=1, mpi=0)
+        form.addParam('skelFormat', EnumParam,
+                      choices=SKEL_FORMATS,
+                      default=SKEL_VOLUMES,
+                      label='Output skeletons as',
+                      help='Tomo masks: volumes with the skeletons, like the input segmentations.\n'
+                           'Coordinates: the voxels of the skeletons are stored in a compact file for each tomo mask '
+                           '(extra/*_skel.npz, usually hundreds of times smaller than the volumes), with the label '
+                           'of the input segmentation at each voxel, e.g. its connected component. They are registered '
+                           'as a set of 3D coordinates, with the label as the group of each coordinate, that can be '
+                           'used by the protocols working with coordinates. The volumes can be recovered with '
+                           '"python -m membrain.utils.sparse file.npz file.mrc".\n'
+                           'Both: both outputs.')
 
-    # -------------------------- INSERT steps functions -----------------------
-    def _insertAllSteps(self):
-        deps = []
-        self._initialize()
-        for tomoId in self.tomoMaskDict.keys():
-            mbId = self._insertFunctionStep(self._runMembrainSkel,
-                                            tomoId,
-                                            prerequisites=[],
-                                            needsGPU=True)
-            cOutId = self._insertFunctionStep(self._createOutputStep,
-                                              tomoId,
-                                              prerequisites=mbId,
-                                              needsGPU=False)
-            deps.append(cOutId)
-        self._insertFunctionStep(self._closeOutputSet,
-                                 prerequisites=deps,
-                                 needsGPU=False)
+        form.addParam('coordinatesSpacing', IntParam,
+                      default=4,
+                      validators=[GE(1)],
+                      condition=f'skelFormat != {SKEL_VOLUMES}',
+                      label='Coordinates spacing (voxels)',
+                      help='A skeleton has from thousands to millions of voxels, too many to register them all as '
+                           'coordinates. One coordinate is registered for each cube of this size (in voxels of the '
+                           'tomo masks) containing any voxel of the skeleton. Use 1 to register all of them. The '
+                           'compact files always store all the voxels.')
+
+        self._defineSkeletonizeParams(form)
+        self._defineCompressionParams(form)
+        self._definePreviewParams(form)
 
+        self._defineBatchParams(form)
+        # One thread is used to watch the input set and another one to register the outputs
+        form.addParallelSection(threads=3, mpi=0)
+        self._defineStreamingParams(form)
+
+    # -------------------------- INSERT steps functions -----------------------
     def _initialize(self):
-        self.tomoMaskDict = {tomoMask.getTsId(): tomoMask.clone() for tomoMask in self._getInTomoMasks()}
+        self.tomoMaskDict = {}
+
+    def _addInputItem(self, tomoId: str, tomoMask: TomoMask):
+        self.tomoMaskDict[tomoId] = tomoMask
+
+    def _insertBatchSteps(self, tomoIds: List[str]) -> int:
+        mbId = self._insertFunctionStep(self._skeletonizeStep,
+                                        *tomoIds,
+                                        prerequisites=[],
+                                        needsGPU=False)
+        return self._insertFunctionStep(self._createOutputStep,
+                                        *tomoIds,
+                                        prerequisites=mbId,
+                                        needsGPU=False)
+
+    def _skeletonizeStep(self, *tomoIds: str):
+        """ Skeletonize the given tomo masks, one after the other. """
+        for tomoId in tomoIds:
+            self._skeletonize(tomoId)
 
-    def _runMembrainSkel(self, tomoId: str):
+    def _skeletonize(self, tomoId: str):
         tomoMask = self.tomoMaskDict[tomoId]
-        args = f'skeletonize --label-path {tomoMask.getFileName()} --out-folder {self._getExtraPath()}'
-        self.runJob(Plugin.getMemBrainSegCmd(), args)
+        self.info(f'Skeletonizing {tomoId}')
+        skelFile = self._getOutFileNameScipion(tomoMask.getFileName(), encoded=False)
+        skeletonizeFile(tomoMask.getFileName(),
+                        skelFile,
+                        samplingRate=tomoMask.getSamplingRate(),
+                        blockSize=self.skelBlockSize.get(),
+                        executor=self._getProcessPool(self.skelProcesses.get()))
+        if self._hasCoordinates():
+            nVoxels = writeSparse(skelFile,
+                                  self._getSparseFileName(tomoMask.getFileName()),
+                                  labelsFile=tomoMask.getFileName(),
+                                  voxelSize=tomoMask.getSamplingRate())
+            self.info(f'{nVoxels} skeleton voxels of {tomoId} stored as coordinates')
+        if not self._hasVolumes():
+            os.remove(skelFile)
+            return
+        if self.createPreviews.get():
+            # Read while the skeleton is still in the page cache and not compressed
+            self.previews[tomoId] = self._createPreviews(tomoMask, skelFile)
+        if self.compressOutputs.get():
+            compressFile(skelFile)
 
-    def _createOutputStep(self, tomoId: str):
+    def _createOutputStep(self, *tomoIds: str):
+        """ Register the results of the given tomo masks. """
+        for tomoId in tomoIds:
+            self._createOutput(tomoId)
+
+    def _createOutput(self, tomoId: str):
         inTomoMask = self.tomoMaskDict[tomoId]
-        outFilename = self._getOutFileNameScipion(inTomoMask.getFileName())
-        setMRCSamplingRate(outFilename, inTomoMask.getSamplingRate())
-        outTomoSegs = self._createOutputSet()
-        inTomoFileName = inTomoMask.getVolName()
-        tomoMask = TomoMask()
-        tomoMask.copyInfo(inTomoMask)
-        tomoMask.setFileName(outFilename)
-        tomoMask.setVolName(inTomoFileName)
-        outTomoSegs.append(tomoMask)
-        outTomoSegs.write()
-        self._store(outTomoSegs)
+        # When resuming, the tomo mask may be already registered in some outputs
+        if self._hasVolumes() and tomoId not in self.registeredTsIds[OUTPUT_TOMOMASK_NAME]:
+            outFilename = self._getOutFileNameScipion(inTomoMask.getFileName())
+            inTomoFileName = inTomoMask.getVolName()
+            tomoMask = TomoMask()
+            tomoMask.copyInfo(inTomoMask)
+            tomoMask.setFileName(outFilename)
+            tomoMask.setVolName(inTomoFileName)
+            if self.createPreviews.get():
+                if tomoId not in self.previews:  # Skeletonized by a previous execution
+                    self.previews[tomoId] = self._createPreviews(inTomoMask, outFilename)
+                for attrName, attr in self._getPreviewAttrs(self.previews.pop(tomoId)).items():
+                    setattr(tomoMask, attrName, attr)
+            self._registerOutput(OUTPUT_TOMOMASK_NAME, tomoMask)
+        if self._hasCoordinates() and tomoId not in self.registeredTsIds[OUTPUT_COORDINATES_NAME]:
+            self._registerOutput(OUTPUT_COORDINATES_NAME, self._getCoordinates(inTomoMask))
+
+    def _createPreviews(self, tomoMask: TomoMask, skelFile: str) -> Dict[str, List[str]]:
+        """ Previews of the skeleton of a tomo mask, read from the given file, compressed or not. """
+        prefix = self._getPreviewPrefix(removeBaseExt(self._getOutFileNameScipion(tomoMask.getFileName(),
+                                                                                  encoded=False)))
+        return scanFile(skelFile, [PreviewScanner(prefix)])[0]
+
+    def _getCoordinates(self, tomoMask: TomoMask) -> List[Coordinate3D]:
+        """ Coordinates of the skeleton of a tomo mask, subsampled with the coordinates spacing. All of them are
+        registered together. """
+        sparse = readSparse(self._getSparseFileName(tomoMask.getFileName()))
+        indices = subsample(sparse.coords, self.coordinatesSpacing.get())
+        # The voxel coordinates are referred to the bottom left corner. The offset to the origin of Scipion is computed
+        # once, as it reads the dimensions of the tomo mask
+        refCoord = Coordinate3D()
+        refCoord.setVolume(tomoMask)
+        refCoord.setPosition(0, 0, 0, BOTTOM_LEFT_CORNER)
+        offset = refCoord.getPosition(SCIPION)
+        coordinates = []
+        for (z, y, x), label in zip(sparse.coords[indices].tolist(), sparse.labels[indices].tolist()):
+            coord = Coordinate3D()
+            coord.setVolume(tomoMask)
+            coord.setPosition(x + offset[0], y + offset[1], z + offset[2], SCIPION)
+            coord.setGroupId(int(label))
+            coord.setBoxSize(self.coordinatesSpacing.get())
+            coordinates.append(coord)
+        return coordinates
 
     # --------------------------- UTILS functions ----------------------------------
     def _getInTomoMasks(self, retPointer: bool = False) -> Union[SetOfTomoMasks, Pointer]:
         inTomoMasksPointer = getattr(self, IN_TOMO_MASKS)
         return inTomoMasksPointer if retPointer else inTomoMasksPointer.get()
 
-    def _createOutputSet(self) -> SetOfTomoMasks:
-        outTomoMasks = getattr(self, OUTPUT_TOMOMASK_NAME, None)
-        if outTomoMasks:
-            outTomoMasks.enableAppend()
-        else:
-            outTomoMasks = SetOfTomoMasks.create(self._getPath(),
-                                                template='tomomasks%s.sqlite',
-                                                suffix=SUFFIX_SKEL)
-            inTomoSet = self._getInTomoMasks()
-            outTomoMasks.copyInfo(inTomoSet)
-            outTomoMasks.setStreamState(Set.STREAM_OPEN)
+    def _hasVolumes(self) -> bool:
+        return self.skelFormat.get() != SKEL_COORDINATES
+
+    def _hasCoordinates(self) -> bool:
+        return self.skelFormat.get() != SKEL_VOLUMES
 
-            self._defineOutputs(**{OUTPUT_TOMOMASK_NAME: outTomoMasks})
-            self._defineSourceRelation(self._getInTomoMasks(retPointer=True), outTomoMasks)
+    def _getOutputNames(self) -> List[str]:
+        return ([OUTPUT_TOMOMASK_NAME] if self._hasVolumes() else []) + \
+            ([OUTPUT_COORDINATES_NAME] if self._hasCoordinates() else [])
 
-        return outTomoMasks
+    def _getOutputSuffix(self, outputName: str) -> str:
+        return SUFFIX_SKEL
 
-    def _getOutFileNameScipion(self, tomoMaskFName: str) -> str:
-        return self._getExtraPath(f'{removeBaseExt(tomoMaskFName)}_{SUFFIX_SKEL}.mrc')
+    def _newOutputSet(self, outputName: str) -> Union[SetOfTomoMasks, SetOfCoordinates3D]:
+        if outputName != OUTPUT_COORDINATES_NAME:
+            return super()._newOutputSet(outputName)
+        outCoords = SetOfCoordinates3D.create(self._getPath(),
+                                              template='coordinates%s.sqlite',
+                                              suffix=SUFFIX_SKEL)
+        outCoords.setSamplingRate(self._getInTomoMasks().getSamplingRate())
+        outCoords.setBoxSize(self.coordinatesSpacing.get())
+        outCoords.setPrecedents(self._getInTomoMasks(retPointer=True))
+        return outCoords
 
+    def _getSparseFileName(self, tomoMaskFName: str) -> str:
+        return self._getExtraPath(f'{removeBaseExt(removeCompressedExt(tomoMaskFName))}_{SUFFIX_SKEL}{SPARSE_EXT}')
+
+    def _getOutFileNameScipion(self, tomoMaskFName: str, encoded: bool = True) -> str:
+        """ Name of an output file. If not encoded, the name it has before being compressed. """
+        ext = '.mrc' + (COMPRESSED_EXT if encoded and self.compressOutputs.get() else '')
+        return self._getExtraPath(f'{removeBaseExt(removeCompressedExt(tomoMaskFName))}_{SUFFIX_SKEL}{ext}')
+
+
+    # --------------------------- INFO functions -----------------------------------
+    def _summary(self):
+        summary = []
+        outTomoMasks = getattr(self, OUTPUT_TOMOMASK_NAME, None)
+        if outTomoMasks:
+            summary.append(f'{OUTPUT_TOMOMASK_NAME}: {outTomoMasks.getSize()} tomo masks skeletonized.')
+        outCoords = getattr(self, OUTPUT_COORDINATES_NAME, None)
+        if outCoords:
+            summary.append(f'{OUTPUT_COORDINATES_NAME}: {outCoords.getSize()} coordinates of the skeletons, one per '
+                           f'cube of {self.coordinatesSpacing.get()} voxels.')
+        summary.extend(self._getProcessPoolSummary())
+        return summary
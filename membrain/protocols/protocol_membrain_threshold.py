@@ -0,0 +1,178 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+from typing import Union, List
+
+from membrain import OUTPUT_TOMOMASK_NAME
+from membrain.protocols.protocol_base import ProtMemBrainBase
+from membrain.utils.threshold import thresholdFile
+from pyworkflow import BETA
+from pyworkflow.object import Pointer
+from pyworkflow.protocol import STEPS_PARALLEL, PointerParam, NumericListParam, ProtStreamingBase
+from pyworkflow.utils import Message, getFloatListFromValues
+from tomo.objects import SetOfTomoMasks, TomoMask
+
+# Inputs
+IN_TOMO_PROB_MAPS = 'inTomoProbMaps'
+
+# Suffixes
+SUFFIX_THRESHOLD = 'thr'
+
+
+class ProtMemBrainThreshold(ProtMemBrainBase, ProtStreamingBase):
+    """
+    Segment the membranes again from the probability maps stored by a previous MemBrain-seg segmentation, with one
+    or several new thresholds. No inference is done, so it takes a few seconds per tomogram.
+    """
+
+    _label = 'tomomask re-threshold'
+    _possibleOutputs = {OUTPUT_TOMOMASK_NAME: 'SetOfTomoMasks'}
+    _devStatus = BETA
+    _inputName = IN_TOMO_PROB_MAPS
+    stepsExecutionMode = STEPS_PARALLEL
+
+    @classmethod
+    def worksInStreaming(cls):
+        return True
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.tomoMaskDict = None
+
+    # -------------------------- DEFINE param functions ----------------------
+    def _defineParams(self, form):
+        form.addSection(label=Message.LABEL_INPUT)
+        form.addParam(IN_TOMO_PROB_MAPS, PointerParam,
+                      pointerClass='SetOfTomoMasks',
+                      allowsNull=False,
+                      label='Input probability maps',
+                      help='Probability maps (scores) generated by the MemBrain-seg segmentation protocol with the '
+                           'option "Output probability maps?" set to Yes.')
+
+        form.addParam('thresholds', NumericListParam,
+                      default='0.0',
+                      label='Thresholds for segmentation',
+                      help='Only voxels with a membrane score higher than the threshold will be segmented, as with the '
+                           'parameter "Threshold for segmentation" of the segmentation protocol. Several thresholds '
+                           'separated by spaces can be given, generating one output for each of them, named '
+                           'tomoMasks_1, tomoMasks_2... in the same order. With a single threshold, the output is '
+                           'named tomoMasks.')
+
+        self._defineBatchParams(form)
+        # One thread is used to watch the input set and another one to register the outputs
+        form.addParallelSection(threads=3, mpi=0)
+        self._defineStreamingParams(form)
+
+    # -------------------------- INSERT steps functions -----------------------
+    def _initialize(self):
+        self.tomoMaskDict = {}
+
+    def _addInputItem(self, tomoId: str, tomoMask: TomoMask):
+        self.tomoMaskDict[tomoId] = tomoMask
+
+    def _insertBatchSteps(self, tomoIds: List[str]) -> int:
+        thId = self._insertFunctionStep(self._thresholdStep,
+                                        *tomoIds,
+                                        prerequisites=[],
+                                        needsGPU=False)
+        return self._insertFunctionStep(self._createOutputStep,
+                                        *tomoIds,
+                                        prerequisites=thId,
+                                        needsGPU=False)
+
+    def _thresholdStep(self, *tomoIds: str):
+        """ Threshold the given tomo masks, one after the other. """
+        for tomoId in tomoIds:
+            self._threshold(tomoId)
+
+    def _threshold(self, tomoId: str):
+        probMap = self.tomoMaskDict[tomoId]
+        self.info(f'Thresholding {tomoId}')
+        thresholdFile(probMap.getFileName(),
+                      {threshold: self._getOutFileNameScipion(tomoId, threshold) for threshold in self._getThresholds()},
+                      samplingRate=probMap.getSamplingRate())
+
+    def _createOutputStep(self, *tomoIds: str):
+        """ Register the results of the given tomo masks. """
+        for tomoId in tomoIds:
+            self._createOutput(tomoId)
+
+    def _createOutput(self, tomoId: str):
+        probMap = self.tomoMaskDict[tomoId]
+        for outputName, threshold in zip(self._getOutputNames(), self._getThresholds()):
+            # When resuming, the item may be already registered in some outputs
+            if tomoId in self.registeredTsIds[outputName]:
+                continue
+            tomoMask = TomoMask()
+            tomoMask.copyInfo(probMap)
+            tomoMask.setFileName(self._getOutFileNameScipion(tomoId, threshold))
+            tomoMask.setVolName(probMap.getVolName())
+            self._registerOutput(outputName, tomoMask)
+
+    # --------------------------- UTILS functions ----------------------------------
+    def _getInProbMaps(self, retPointer: bool = False) -> Union[SetOfTomoMasks, Pointer]:
+        inProbMapsPointer = getattr(self, IN_TOMO_PROB_MAPS)
+        return inProbMapsPointer if retPointer else inProbMapsPointer.get()
+
+    def _getThresholds(self) -> List[float]:
+        return getFloatListFromValues(self.thresholds.get())
+
+    def _getOutputNames(self) -> List[str]:
+        """ Names of the outputs, in the same order as the thresholds. """
+        return self._getIndexedOutputNames(len(self._getThresholds()))
+
+    def _getOutputSuffix(self, outputName: str) -> str:
+        return f'_{SUFFIX_THRESHOLD}{self._getOutputThreshold(outputName):g}'
+
+    def _getOutputComment(self, outputName: str) -> str:
+        return f'Threshold: {self._getOutputThreshold(outputName):g}'
+
+    def _getOutputThreshold(self, outputName: str) -> float:
+        return self._getThresholds()[self._getOutputNames().index(outputName)]
+
+    def _getOutFileNameScipion(self, tomoId: str, threshold: float) -> str:
+        return self._getExtraPath(f'{tomoId}_{SUFFIX_THRESHOLD}{threshold:g}.mrc')
+
+    # --------------------------- INFO functions -----------------------------------
+    def _validate(self):
+        errors = []
+        self._validateThreads(errors)
+        try:
+            thresholds = self._getThresholds()
+        except ValueError:
+            thresholds = None
+        if not thresholds:
+            errors.append('At least one numeric threshold is required.')
+        elif len(set(thresholds)) != len(thresholds):
+            errors.append('The thresholds must be different.')
+        return errors
+
+    def _summary(self):
+        summary = []
+        for outputName, threshold in zip(self._getOutputNames(), self._getThresholds()):
+            outSet = getattr(self, outputName, None)
+            if outSet:
+                summary.append(f'{outputName}: {outSet.getSize()} tomograms segmented with threshold {threshold:g}.')
+        return summary
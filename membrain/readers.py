@@ -0,0 +1,77 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Image reader for the compressed MRC files (.mrc.gz) that the MemBrain protocols can generate, so Scipion can get their
+dimensions and display them like any other MRC file.
+"""
+import logging
+from typing import Tuple
+
+logger = logging.getLogger(__name__)
+
+_registered = False
+
+
+def _createReaderClass(ImageReader):
+    """ Define the reader as a subclass of the ImageReader of pwem, only imported when the readers are registered. """
+    import mrcfile
+    import numpy as np
+
+    class CompressedMRCImageReader(ImageReader):
+        """ Image reader for gzip compressed MRC files. """
+
+        @staticmethod
+        def getCompatibleExtensions() -> list:
+            return ['gz']
+
+        @staticmethod
+        def getDimensions(filePath: str) -> Tuple[int, int, int, int]:
+            with mrcfile.open(filePath.split('@')[-1], header_only=True, permissive=True) as mrc:
+                header = mrc.header
+                return int(header.nx), int(header.ny), int(header.nz), 1
+
+        @classmethod
+        def open(cls, path: str) -> np.ndarray:
+            with mrcfile.open(path.split('@')[-1], permissive=True) as mrc:
+                return np.array(mrc.data)
+
+    return CompressedMRCImageReader
+
+
+def registerReaders():
+    """ Make the compressed MRC files readable by Scipion. The image readers of pwem pull in most of emlib, so this
+    is done lazily, when the first protocol of the plugin is created (e.g. when a project using them is loaded), rather
+    than when the plugin or the protocols are imported. It can be called any number of times. """
+    global _registered
+    if _registered:
+        return
+    try:
+        from pwem.emlib.image.image_readers import ImageReader, ImageReadersRegistry
+    except ImportError:  # Versions of pwem without image readers
+        logger.debug('Image readers are not available: compressed MRC files will not be readable by Scipion.')
+        return
+    ImageReadersRegistry.addReader(_createReaderClass(ImageReader))
+    _registered = True
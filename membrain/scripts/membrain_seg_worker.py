@@ -0,0 +1,277 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Persistent MemBrain-seg inference worker.
+
+It is launched inside the MemBrain-seg environment, imports membrain-seg (and so torch) only once, keeps the
+models loaded from the checkpoints resident in memory and serves the jobs sent by the Scipion protocol through a
+local socket, one after another. Each job is a list of command line arguments for the membrain CLI, so the worker
+behaves exactly as the membrain executable does. The resources used by each job are measured and sent back with its
+output.
+
+The jobs run on CPU can use a model exported to TorchScript instead of the eager PyTorch one: traced, frozen and
+optimized for inference (layer fusion and oneDNN kernels), in float32 or bfloat16. The exported model is saved next to
+the checkpoint the first time it is needed and reused afterwards by all the workers.
+"""
+import argparse
+import contextlib
+import io
+import os
+import resource
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.connection import Listener, AuthenticationError
+
+AUTHKEY_VAR = 'MEMBRAIN_SEG_WORKER_AUTHKEY'
+CMD_RUN = 'run'
+CMD_PING = 'ping'
+CMD_STOP = 'stop'
+
+# Inference backends of the jobs run on CPU
+BACKEND_PYTORCH = 'pytorch'
+BACKEND_TORCHSCRIPT = 'torchscript'
+BACKEND_TORCHSCRIPT_BF16 = 'torchscript-bf16'
+EXPORT_EXTS = {BACKEND_TORCHSCRIPT: '.cpu.pt',
+               BACKEND_TORCHSCRIPT_BF16: '.cpu-bf16.pt'}
+EXPORT_SAMPLE_SIZE = 64  # Side of the input the model is traced with
+
+# Time spent loading models in the current job
+modelLoadTime = 0.0
+# Backend of the current job
+currentBackend = BACKEND_PYTORCH
+
+
+def getExportFile(checkpointPath: str, backend: str) -> str:
+    return str(checkpointPath) + EXPORT_EXTS[backend]
+
+
+def exportModel(model, exportFile: str, backend: str, sampleSize: int = EXPORT_SAMPLE_SIZE):
+    """ Compile a model loaded on CPU to TorchScript, with its weights frozen as constants, and save it. In bfloat16,
+    the weights and activations take half the memory bandwidth and recent CPUs (AVX512-BF16, AMX) compute them
+    natively, at the cost of some precision. """
+    import torch
+    dtype = torch.bfloat16 if backend == BACKEND_TORCHSCRIPT_BF16 else torch.float32
+    model = model.eval().to(dtype)
+    with torch.no_grad():
+        module = torch.jit.freeze(torch.jit.trace(model, torch.zeros((1, 1) + (sampleSize,) * 3, dtype=dtype)))
+    tmpFile = '%s.%d.part' % (exportFile, os.getpid())
+    try:
+        torch.jit.save(module, tmpFile)
+        os.replace(tmpFile, exportFile)
+    except OSError as e:
+        print('Unable to save the exported model to %s, it will be exported again by each worker: %s'
+              % (exportFile, e), flush=True)
+    return module
+
+
+def loadCpuModel(checkpointPath: str, backend: str, loadFromCheckpoint):
+    """ Model of a checkpoint for the given CPU backend, exported with exportModel if it was not yet.
+    :param loadFromCheckpoint: function loading the PyTorch model of a checkpoint.
+    :return: a module taking and returning float32 tensors, like the PyTorch model.
+    """
+    import torch
+    dtype = torch.bfloat16 if backend == BACKEND_TORCHSCRIPT_BF16 else torch.float32
+    exportFile = getExportFile(checkpointPath, backend)
+    if os.path.exists(exportFile) and os.path.getmtime(exportFile) >= os.path.getmtime(checkpointPath):
+        print('Loading exported model from %s' % exportFile, flush=True)
+        module = torch.jit.load(exportFile, map_location='cpu')
+    else:
+        print('Exporting model %s for the %s backend' % (checkpointPath, backend), flush=True)
+        module = exportModel(loadFromCheckpoint(checkpointPath, map_location='cpu', strict=False), exportFile, backend)
+    # Fusing the layers and switching to oneDNN kernels gives modules that cannot be saved, so it is done when loading
+    try:
+        module = torch.jit.optimize_for_inference(module)
+    except Exception as e:  # Not every layer and data type is supported by every version of PyTorch
+        print('The exported model could not be optimized for inference, only frozen: %s' % e, flush=True)
+
+    class CpuModel(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.module = module
+
+        def forward(self, x):
+            return self.module(x.to(dtype)).float()
+
+    return CpuModel().eval()
+
+
+def cacheModelLoading():
+    """ Make membrain-seg reuse the model loaded from a checkpoint instead of reading it again for each tomogram. """
+    try:
+        from membrain_seg.segmentation.networks.unet import SemanticSegmentationUnet
+    except ImportError as e:
+        print('Unable to cache the model loading, it will be loaded for each job: %s' % e, flush=True)
+        return
+
+    loadFromCheckpoint = SemanticSegmentationUnet.load_from_checkpoint
+    loadedModels = {}
+
+    def cachedLoadFromCheckpoint(checkpoint_path, *args, **kwargs):
+        global modelLoadTime
+        mapLocation = str(kwargs.get('map_location'))
+        backend = currentBackend if mapLocation == 'cpu' else BACKEND_PYTORCH
+        key = (os.path.realpath(str(checkpoint_path)), mapLocation, backend)
+        if key not in loadedModels:
+            t0 = time.time()
+            if backend == BACKEND_PYTORCH:
+                print('Loading model from %s' % checkpoint_path, flush=True)
+                loadedModels[key] = loadFromCheckpoint(checkpoint_path, *args, **kwargs)
+            else:
+                loadedModels[key] = loadCpuModel(str(checkpoint_path), backend, loadFromCheckpoint)
+            modelLoadTime += time.time() - t0
+        return loadedModels[key]
+
+    SemanticSegmentationUnet.load_from_checkpoint = staticmethod(cachedLoadFromCheckpoint)
+
+
+def getMembrainCli():
+    """ Get the callable behind the membrain executable of the current environment. """
+    from importlib.metadata import entry_points
+    eps = entry_points()
+    consoleScripts = eps.select(group='console_scripts') if hasattr(eps, 'select') else eps.get('console_scripts', [])
+    for ep in consoleScripts:
+        if ep.name == 'membrain':
+            return ep.load()
+    raise RuntimeError('The membrain executable was not found in the current environment.')
+
+
+def resetPeakRss():
+    """ Reset the peak resident memory of the process, so it can be measured for each job (Linux only). """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def getPeakRss():
+    """ Peak resident memory of the process, in bytes, since the last reset if supported. """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Peak of the whole life of the worker
+
+
+def getIoCounters():
+    """ Bytes read and written by the process with read and write calls (Linux only). """
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                counters[name] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+
+def runJob(cli, args, backend=BACKEND_PYTORCH):
+    """ Run the membrain CLI in-process with the given arguments, returning its captured output and the resources
+    used. The backend only applies if the job runs on CPU. """
+    global modelLoadTime, currentBackend
+    modelLoadTime = 0.0
+    currentBackend = backend
+    resetPeakRss()
+    t0, cpu0 = time.time(), time.process_time()
+    read0, written0 = getIoCounters()
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        try:
+            cli(args=args, prog_name='membrain', standalone_mode=False)
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                raise RuntimeError('membrain exited with code %s' % e.code)
+    read1, written1 = getIoCounters()
+    stats = {'wallTime': time.time() - t0,
+             'cpuTime': time.process_time() - cpu0,
+             'peakRss': getPeakRss(),
+             'bytesRead': read1 - read0,
+             'bytesWritten': written1 - written0,
+             'modelLoadTime': modelLoadTime}
+    return out.getvalue(), stats
+
+
+def watchParent(parentPid, pollTime=5):
+    """ Exit if the Scipion process that launched the worker is gone, so no orphan workers keep the GPU busy. """
+    while True:
+        time.sleep(pollTime)
+        try:
+            os.kill(parentPid, 0)
+        except OSError:
+            print('Parent process %d is gone. Exiting.' % parentPid, flush=True)
+            os._exit(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Persistent MemBrain-seg inference worker.')
+    parser.add_argument('--address', required=True, help='Unix socket the worker will listen to.')
+    parser.add_argument('--parent-pid', type=int, default=None, help='Exit when this process finishes.')
+    params = parser.parse_args()
+
+    authkey = bytes.fromhex(os.environ.pop(AUTHKEY_VAR))
+    if params.parent_pid:
+        threading.Thread(target=watchParent, args=(params.parent_pid,), daemon=True).start()
+
+    t0 = time.time()
+    cli = getMembrainCli()
+    cacheModelLoading()
+    print('MemBrain-seg worker ready in %0.1f s (CUDA_VISIBLE_DEVICES=%s)'
+          % (time.time() - t0, os.environ.get('CUDA_VISIBLE_DEVICES', '')), flush=True)
+
+    with Listener(params.address, family='AF_UNIX', authkey=authkey) as listener:
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, OSError) as e:
+                # A client that does not know the key, or that left during the handshake, must not stop the worker
+                print('Connection rejected: %s' % e, flush=True)
+                continue
+            with conn:
+                request = conn.recv()
+                cmd = request.get('cmd')
+                if cmd == CMD_STOP:
+                    conn.send({'ok': True, 'output': ''})
+                    break
+                elif cmd == CMD_PING:
+                    conn.send({'ok': True, 'output': ''})
+                    continue
+                t0 = time.time()
+                try:
+                    output, stats = runJob(cli, request['args'], request.get('backend') or BACKEND_PYTORCH)
+                    conn.send({'ok': True, 'output': output, 'stats': stats})
+                except Exception:
+                    conn.send({'ok': False, 'output': traceback.format_exc()})
+                print('Job %s done in %0.1f s' % (request['args'], time.time() - t0), flush=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
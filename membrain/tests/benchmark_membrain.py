@@ -0,0 +1,357 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Benchmark of the overhead added by the MemBrain protocols to the MemBrain-seg executions: step insertion, command
+construction, file moves, header rewrites and writing of the output sets. It runs on any machine, without a GPU or a
+MemBrain-seg installation, on synthetic tomograms and with a stand-in for the membrain executable (membrain_stub.py)
+that writes the same output files and takes a configurable time. Run it with:
+
+    scipion3 tests membrain.tests.benchmark_membrain
+
+It is configured with these environment variables:
+    - MEMBRAIN_BENCHMARK_NTOMOS: numbers of tomograms of each run, separated by spaces (default: 4 16).
+    - MEMBRAIN_BENCHMARK_THREADS: numbers of threads of each run (default: 3 6). Each run uses the number of threads
+      minus two devices, as recommended in the protocol form.
+    - MEMBRAIN_BENCHMARK_BATCH_SIZES: numbers of tomograms per step of each run (default: 1).
+    - MEMBRAIN_BENCHMARK_WORKER: 0 to run the membrain executable for each tomogram, 1 to keep it loaded in a persistent
+      worker for each device (advanced parameter "Keep the model loaded between tomograms?"), or both to measure the
+      speedup of the worker (default: 0 1).
+    - MEMBRAIN_BENCHMARK_SHAPE: dimensions of the synthetic tomograms, z y x (default: 64 128 128).
+    - MEMBRAIN_STUB_STARTUP_TIME and MEMBRAIN_STUB_TIME_PER_GVOXEL: time taken by the stand-in executable for each
+      tomogram (default: 1 and 0 seconds). The startup time is taken by each execution, but only once by each worker.
+    - MEMBRAIN_BENCHMARK_BASELINE: results of a previous run (the benchmark.json file written by the benchmark). If
+      given, the benchmark fails if any overhead grows more than MEMBRAIN_BENCHMARK_TOLERANCE (default: 0.25, i.e.
+      25%), so it can be used as a regression gate when the protocols change.
+"""
+import json
+import math
+import os
+import shutil
+import sys
+import time
+from collections import defaultdict
+from os.path import join, dirname, abspath
+from typing import Dict, List, Tuple
+
+import mrcfile
+import numpy as np
+import pyworkflow.tests as pwtests
+from membrain import Plugin
+from membrain.constants import MEMBRAIN_SEG_ENV_ACTIVATION_VAR, MODEL_MODELS_HOME, MEMBRAIN_SEG_MODEL_VAR, \
+    MEMBRAIN_SEG_MODEL_NAME_DEFAULT, MEMBRAIN_SEG_CACHE_DIR_VAR
+from membrain.protocols import ProtMemBrainSeg
+from membrain.tests.membrain_stub import STARTUP_TIME_VAR, TIME_PER_GVOXEL_VAR, installDistribution
+from pyworkflow.tests import BaseTest
+from pyworkflow.utils import magentaStr, moveFile
+from tomo.objects import SetOfTomoMasks, TomoMask, SetOfTomograms
+from tomo.protocols import ProtImportTomograms
+from tomo.protocols.protocol_import_tomograms import OUTPUT_NAME
+
+NTOMOS_VAR = 'MEMBRAIN_BENCHMARK_NTOMOS'
+THREADS_VAR = 'MEMBRAIN_BENCHMARK_THREADS'
+BATCH_SIZES_VAR = 'MEMBRAIN_BENCHMARK_BATCH_SIZES'
+WORKER_VAR = 'MEMBRAIN_BENCHMARK_WORKER'
+SHAPE_VAR = 'MEMBRAIN_BENCHMARK_SHAPE'
+BASELINE_VAR = 'MEMBRAIN_BENCHMARK_BASELINE'
+TOLERANCE_VAR = 'MEMBRAIN_BENCHMARK_TOLERANCE'
+
+DEFAULT_NTOMOS = '4 16'
+DEFAULT_THREADS = '3 6'
+DEFAULT_BATCH_SIZES = '1'
+DEFAULT_WORKER = '0 1'
+DEFAULT_SHAPE = '64 128 128'
+DEFAULT_STARTUP_TIME = '1'
+DEFAULT_TOLERANCE = '0.25'
+# Metrics checked by the regression gate, with the difference, in seconds, below which they are considered noise
+RUN_METRICS = {'overhead': 1.0, 'stepInsertion': 0.05, 'segmentStep': 0.05, 'createOutputStep': 0.05}
+OPERATION_MIN_REGRESSION = 1.0  # In milliseconds
+
+SAMPLING_RATE = 10.0
+STUB_SCRIPT = join(dirname(abspath(__file__)), 'membrain_stub.py')
+# The steps generator is wrapped by pyworkflow to be resumable
+GENERATOR_STEPS = ['stepsGeneratorStep', 'resumableStepGeneratorStep']
+# Number of repetitions of the micro-benchmarks
+N_REPEATS = 200
+
+
+def createSyntheticTomogram(fileName: str, shape: Tuple[int, int, int], seed: int = 0, nVesicles: int = 6,
+                            samplingRate: float = SAMPLING_RATE):
+    """ Write a tomogram with some vesicles (dark spherical shells, 2 voxels thick) on Gaussian noise, by slices so
+    large tomograms can be created. """
+    rng = np.random.default_rng(seed)
+    shape = np.array(shape)
+    radii = rng.uniform(0.1, 0.25, nVesicles) * shape.min()
+    centers = rng.uniform(radii[:, None], shape - radii[:, None])
+    y, x = np.ogrid[:shape[1], :shape[2]]
+    with mrcfile.new_mmap(fileName, shape=tuple(shape), mrc_mode=2, overwrite=True) as mrc:
+        for z in range(shape[0]):
+            tomoSlice = rng.normal(scale=0.3, size=shape[1:]).astype(np.float32)
+            for (cz, cy, cx), radius in zip(centers, radii):
+                dist = np.sqrt((z - cz) ** 2 + (y - cy) ** 2 + (x - cx) ** 2)
+                tomoSlice[np.abs(dist - radius) < 1] -= 1
+            mrc.data[z] = tomoSlice
+        mrc.voxel_size = samplingRate
+        mrc.update_header_stats()
+
+
+def installStub(stubDir: str):
+    """ Make the stand-in of the membrain executable, also for the worker, and a fake model the ones used by the
+    protocols launched from this process. """
+    binDir = join(stubDir, 'bin')
+    siteDir = join(stubDir, 'site')
+    modelsDir = join(stubDir, 'models')
+    os.makedirs(binDir, exist_ok=True)
+    os.makedirs(modelsDir, exist_ok=True)
+    membrainExe = join(binDir, 'membrain')
+    with open(membrainExe, 'w') as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{STUB_SCRIPT}" "$@"\n')
+    os.chmod(membrainExe, 0o755)
+    installDistribution(siteDir)
+    open(join(modelsDir, MEMBRAIN_SEG_MODEL_NAME_DEFAULT), 'w').close()
+
+    os.environ[MEMBRAIN_SEG_ENV_ACTIVATION_VAR] = (f'export PATH={binDir}:$PATH '
+                                                   f'PYTHONPATH={siteDir}${{PYTHONPATH:+:$PYTHONPATH}}')
+    os.environ[MODEL_MODELS_HOME] = modelsDir
+    os.environ[MEMBRAIN_SEG_MODEL_VAR] = MEMBRAIN_SEG_MODEL_NAME_DEFAULT
+    os.environ[MEMBRAIN_SEG_CACHE_DIR_VAR] = ''
+    os.environ.setdefault(STARTUP_TIME_VAR, DEFAULT_STARTUP_TIME)
+
+
+def getIntList(varName: str, default: str) -> List[int]:
+    return [int(value) for value in os.environ.get(varName, default).split()]
+
+
+def timeIt(func, nRepeats: int = N_REPEATS) -> float:
+    """ Mean time, in milliseconds, of the calls to func(i) for i in range(nRepeats). """
+    t0 = time.perf_counter()
+    for i in range(nRepeats):
+        func(i)
+    return (time.perf_counter() - t0) / nRepeats * 1000
+
+
+class TestMemBrainBenchmark(BaseTest):
+    nTomosList = None
+    threadsList = None
+    batchSizes = None
+    workerModes = None
+    shape = None
+
+    @classmethod
+    def setUpClass(cls):
+        pwtests.setupTestProject(cls)
+        installStub(cls.getOutputPath('stub'))
+        cls.nTomosList = getIntList(NTOMOS_VAR, DEFAULT_NTOMOS)
+        cls.threadsList = getIntList(THREADS_VAR, DEFAULT_THREADS)
+        cls.batchSizes = getIntList(BATCH_SIZES_VAR, DEFAULT_BATCH_SIZES)
+        cls.workerModes = [bool(mode) for mode in getIntList(WORKER_VAR, DEFAULT_WORKER)]
+        cls.shape = tuple(getIntList(SHAPE_VAR, DEFAULT_SHAPE))
+        # The tomograms of each run are hard links to the same files, so they are not recognized as the same data
+        cls.tomoFiles = [cls.getOutputPath('synthetic', f'tomo_{i:03d}.mrc') for i in range(max(cls.nTomosList))]
+        os.makedirs(cls.getOutputPath('synthetic'), exist_ok=True)
+        for i, tomoFile in enumerate(cls.tomoFiles):
+            createSyntheticTomogram(tomoFile, cls.shape, seed=i)
+
+    @classmethod
+    def getStubTime(cls) -> float:
+        """ Time, in seconds, taken by the stand-in executable for each tomogram. """
+        return cls.getStartupTime() + cls.getInferenceTime()
+
+    @staticmethod
+    def getStartupTime() -> float:
+        """ Time, in seconds, taken by the stand-in executable to start, once per worker. """
+        return float(os.environ.get(STARTUP_TIME_VAR, 0))
+
+    @classmethod
+    def getInferenceTime(cls) -> float:
+        """ Time, in seconds, taken by the stand-in executable to segment each tomogram, once started. """
+        return float(os.environ.get(TIME_PER_GVOXEL_VAR, 0)) * np.prod(cls.shape) / 1e9
+
+    @classmethod
+    def getStubTimes(cls, nTomos: int, nDevices: int, useWorker: bool) -> Tuple[float, float]:
+        """ Time, in seconds, the stand-in executable takes in total for all the tomograms, and in the ideal case of
+        a protocol without overhead (the tomograms are processed in rounds, each device processing one at a time). """
+        nRounds = math.ceil(nTomos / nDevices)
+        if useWorker:
+            return (min(nTomos, nDevices) * cls.getStartupTime() + nTomos * cls.getInferenceTime(),
+                    cls.getStartupTime() + nRounds * cls.getInferenceTime())
+        return nTomos * cls.getStubTime(), nRounds * cls.getStubTime()
+
+    def _importTomograms(self, nTomos: int) -> SetOfTomograms:
+        print(magentaStr(f"\n==> Importing {nTomos} synthetic tomograms:"))
+        tomoDir = self.getOutputPath(f'tomos_{nTomos}')
+        os.makedirs(tomoDir, exist_ok=True)
+        for tomoFile in self.tomoFiles[:nTomos]:
+            linkFile = join(tomoDir, os.path.basename(tomoFile))
+            if not os.path.exists(linkFile):
+                os.link(tomoFile, linkFile)
+        protImportTomo = self.newProtocol(ProtImportTomograms,
+                                          filesPath=tomoDir,
+                                          filesPattern='*.mrc',
+                                          samplingRate=SAMPLING_RATE)
+        protImportTomo = self.launchProtocol(protImportTomo)
+        return getattr(protImportTomo, OUTPUT_NAME)
+
+    def _runMembrainSeg(self, inTomograms: SetOfTomograms, nThreads: int, batchSize: int, useWorker: bool) -> dict:
+        nDevices = max(nThreads - 2, 1)
+        print(magentaStr(f"\n==> Segmenting {inTomograms.getSize()} tomograms with {nThreads} threads, "
+                         f"{batchSize} per step, {'with' if useWorker else 'without'} worker:"))
+        protMembrainSeg = self.newProtocol(ProtMemBrainSeg,
+                                           inTomograms=inTomograms,
+                                           storeProbabilities=True,
+                                           useWorker=useWorker,
+                                           useCache=False,
+                                           gpuList=' '.join(str(i) for i in range(nDevices)),
+                                           # The stand-in executable needs almost no memory
+                                           memoryBudget=1024,
+                                           gpuMemoryBudget=1024,
+                                           batchSize=batchSize,
+                                           numberOfThreads=nThreads)
+        protMembrainSeg = self.launchProtocol(protMembrainSeg)
+
+        stepTimes = defaultdict(list)
+        for step in protMembrainSeg.loadSteps():
+            stepTimes[step.funcName.get()].append(step.getElapsedTime().total_seconds())
+        nTomos = inTomograms.getSize()
+        wallTime = protMembrainSeg.getElapsedTime().total_seconds()
+        stubTime, idealTime = self.getStubTimes(nTomos, nDevices, useWorker)
+        return {'nTomos': nTomos,
+                'nThreads': nThreads,
+                'batchSize': batchSize,
+                'useWorker': useWorker,
+                'wallTime': wallTime,
+                'overhead': wallTime - idealTime,
+                'tomosPerMinute': 60 * nTomos / wallTime,
+                # Time of the steps per tomogram, without the time of the stand-in executable
+                'stepInsertion': sum(sum(stepTimes[name]) for name in GENERATOR_STEPS) / nTomos,
+                # It includes the start of the process of the stand-in executable, or of the worker
+                'segmentStep': (sum(stepTimes['runMemBrainSeg']) - stubTime) / nTomos,
+                'createOutputStep': sum(stepTimes['createOutputStep']) / nTomos,
+                'closeOutputStep': sum(stepTimes['closeOutputStep'])}
+
+    def _runMicroBenchmarks(self) -> Dict[str, float]:
+        """ Time, in milliseconds, of each operation done by the protocol for each tomogram. """
+        print(magentaStr("\n==> Timing the operations done for each tomogram:"))
+        workDir = self.getOutputPath('micro')
+        os.makedirs(workDir, exist_ok=True)
+        tomoFile = self.tomoFiles[0]
+        prot = self.newProtocol(ProtMemBrainSeg)
+        nRepeats = 20  # File operations are much slower than the rest
+
+        def buildCommand(i):
+            return (Plugin.getMemBrainSegCmd() % {'GPU': '0'} +
+                    prot._getMemBrainSegArgs(tomoFile, workDir, prot.slidingWindowSize.get()))
+
+        movedFiles = [join(workDir, f'moved_{i}.mrc') for i in range(nRepeats + 1)]
+        shutil.copyfile(tomoFile, movedFiles[0])
+
+        def moveTomoFile(i):
+            moveFile(movedFiles[i], movedFiles[i + 1])
+
+        def rewriteHeader(i):
+            with mrcfile.open(movedFiles[-1], mode='r+', permissive=True) as mrc:
+                mrc.voxel_size = SAMPLING_RATE + i
+                mrc.update_header_stats()
+
+        tomoMasks = SetOfTomoMasks.create(workDir, template='tomomasks%s.sqlite')
+        tomoMasks.setSamplingRate(SAMPLING_RATE)
+
+        def writeSetItem(i):
+            tomoMask = TomoMask()
+            tomoMask.setSamplingRate(SAMPLING_RATE)
+            tomoMask.setFileName(join(workDir, f'tomo_{i}_segmented.mrc'))
+            tomoMask.setVolName(tomoFile)
+            tomoMasks.append(tomoMask)
+            tomoMasks.write()
+
+        return {'commandConstruction': timeIt(buildCommand),
+                'fileMove': timeIt(moveTomoFile, nRepeats),
+                'headerRewrite': timeIt(rewriteHeader, nRepeats),
+                'sqliteWrite': timeIt(writeSetItem)}
+
+    def _checkRegressions(self, results: dict):
+        baselineFile = os.environ.get(BASELINE_VAR)
+        if not baselineFile:
+            return
+        with open(baselineFile) as f:
+            baseline = json.load(f)
+        tolerance = float(os.environ.get(TOLERANCE_VAR, DEFAULT_TOLERANCE))
+        regressions = []
+        for name, value in results['operations'].items():
+            oldValue = baseline['operations'].get(name)
+            if oldValue is not None and value > oldValue * (1 + tolerance) + OPERATION_MIN_REGRESSION:
+                regressions.append(f'{name}: {oldValue:.3f} ms -> {value:.3f} ms')
+        oldRuns = {(run['nTomos'], run['nThreads'], run.get('batchSize', 1), run.get('useWorker', False)): run
+                   for run in baseline['runs']}
+        for run in results['runs']:
+            oldRun = oldRuns.get((run['nTomos'], run['nThreads'], run['batchSize'], run['useWorker']), {})
+            for name, minRegression in RUN_METRICS.items():
+                oldValue = oldRun.get(name)
+                if oldValue is not None and run[name] > oldValue * (1 + tolerance) + minRegression:
+                    regressions.append(f"{name} with {run['nTomos']} tomograms, {run['nThreads']} threads, "
+                                       f"{run['batchSize']} per step and{'' if run['useWorker'] else ' no'} worker: "
+                                       f"{oldValue:.3f} s -> {run[name]:.3f} s")
+        self.assertFalse(regressions, 'Overhead regressions with respect to %s:\n%s'
+                         % (baselineFile, '\n'.join(regressions)))
+
+    @staticmethod
+    def _printResults(results: dict):
+        print(magentaStr('\n==> Benchmark results:'))
+        print(f"Stand-in executable time per tomogram: {results['stubTime']:.2f} s")
+        for name, value in results['operations'].items():
+            print(f'{name:>20}: {value:8.3f} ms')
+        print(f"{'Tomograms':>10} {'Threads':>8} {'Per step':>9} {'Worker':>7} {'Wall (s)':>9} {'Overhead (s)':>13} "
+              f"{'Tomograms/min':>14} {'Insert (s)':>11} {'Segment (s)':>12} {'Output (s)':>11}")
+        for run in results['runs']:
+            print(f"{run['nTomos']:>10} {run['nThreads']:>8} {run['batchSize']:>9} {'yes' if run['useWorker'] else 'no':>7} "
+                  f"{run['wallTime']:>9.2f} {run['overhead']:>13.2f} {run['tomosPerMinute']:>14.1f} "
+                  f"{run['stepInsertion']:>11.3f} {run['segmentStep']:>12.3f} {run['createOutputStep']:>11.3f}")
+        # Speedup of the worker for the runs done with and without it
+        wallTimes = {(run['nTomos'], run['nThreads'], run['batchSize'], run['useWorker']): run['wallTime']
+                     for run in results['runs']}
+        for (nTomos, nThreads, batchSize, useWorker), wallTime in wallTimes.items():
+            withoutWorker = wallTimes.get((nTomos, nThreads, batchSize, False))
+            if useWorker and withoutWorker:
+                print(f'Worker speedup with {nTomos} tomograms, {nThreads} threads and {batchSize} per step: '
+                      f'{withoutWorker / wallTime:.2f}x')
+
+    def test_benchmark(self):
+        results = {'shape': self.shape,
+                   'stubTime': self.getStubTime(),
+                   'operations': self._runMicroBenchmarks(),
+                   'runs': []}
+        for nTomos in self.nTomosList:
+            inTomograms = self._importTomograms(nTomos)
+            for nThreads in self.threadsList:
+                for batchSize in self.batchSizes:
+                    for useWorker in self.workerModes:
+                        results['runs'].append(self._runMembrainSeg(inTomograms, nThreads, batchSize, useWorker))
+
+        self._printResults(results)
+        resultsFile = self.getOutputPath('benchmark.json')
+        with open(resultsFile, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results written to {resultsFile}')
+        self._checkRegressions(results)
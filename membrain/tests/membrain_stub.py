@@ -0,0 +1,163 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Stand-in for the membrain executable of MemBrain-seg, used by the benchmarks to measure the overhead of the protocols
+on machines without a GPU or a MemBrain-seg installation.
+
+It accepts the same arguments as 'membrain segment' and 'membrain skeletonize' and writes output files with the same
+names, types and headers, but the "segmentation" is a cheap thresholding of the tomogram. The time taken by the
+network is mimicked with a sleep of MEMBRAIN_STUB_TIME_PER_GVOXEL seconds per billion voxels of the tomogram, plus
+MEMBRAIN_STUB_STARTUP_TIME seconds in the first job of the process (importing torch and loading the model): in every
+job when run as an executable, only in the first one when run by the persistent worker.
+
+installDistribution makes it the membrain executable found by the worker (see membrain_seg_worker.getMembrainCli).
+"""
+import argparse
+import os
+import sys
+import time
+
+import mrcfile
+import numpy as np
+from scipy import ndimage
+
+STARTUP_TIME_VAR = 'MEMBRAIN_STUB_STARTUP_TIME'
+TIME_PER_GVOXEL_VAR = 'MEMBRAIN_STUB_TIME_PER_GVOXEL'
+
+# Number of slices processed at once, so large tomograms are not loaded whole
+CHUNK_SLICES = 32
+
+# Whether a job already paid the startup time in this process
+started = False
+
+
+def getBaseName(fileName: str) -> str:
+    return os.path.splitext(os.path.basename(fileName))[0]
+
+
+def simulateInference(nVoxels: int):
+    global started
+    startupTime = 0 if started else float(os.environ.get(STARTUP_TIME_VAR, 0))
+    started = True
+    time.sleep(startupTime + float(os.environ.get(TIME_PER_GVOXEL_VAR, 0)) * nVoxels / 1e9)
+
+
+def installDistribution(siteDir: str):
+    """ Register this module as the membrain executable of a fake distribution in siteDir, the way pip registers the
+    one of MemBrain-seg, so the processes with siteDir in their PYTHONPATH find it. """
+    distDir = os.path.join(siteDir, 'membrain_seg_stub-0.0.0.dist-info')
+    os.makedirs(distDir, exist_ok=True)
+    with open(os.path.join(distDir, 'METADATA'), 'w') as f:
+        f.write('Metadata-Version: 2.1\nName: membrain-seg-stub\nVersion: 0.0.0\n')
+    with open(os.path.join(distDir, 'entry_points.txt'), 'w') as f:
+        f.write(f'[console_scripts]\nmembrain = {__name__}:main\n')
+
+
+def segment(params):
+    """ Write the files of 'membrain segment'. Membranes are darker than the background in the synthetic tomograms, so
+    the scores decrease with the density. """
+    baseName = getBaseName(params.tomogram_path)
+    segFile = os.path.join(params.out_folder,
+                           f'{baseName}_{os.path.basename(params.ckpt_path)}_segmented.mrc')
+    scoresFile = os.path.join(params.out_folder, f'{baseName}_scores.mrc')
+
+    with mrcfile.mmap(params.tomogram_path, mode='r', permissive=True) as mrcIn:
+        tomo = mrcIn.data
+        simulateInference(tomo.size)
+        outFiles = [segFile] + ([scoresFile] if params.store_probabilities else [])
+        for outFile in outFiles:
+            with mrcfile.new_mmap(outFile, shape=tomo.shape, mrc_mode=2, overwrite=True) as mrcOut:
+                mrcOut.voxel_size = mrcIn.voxel_size
+        with mrcfile.mmap(segFile, mode='r+') as mrcSeg:
+            mrcScores = mrcfile.mmap(scoresFile, mode='r+') if params.store_probabilities else None
+            for start in range(0, tomo.shape[0], CHUNK_SLICES):
+                scores = -4 * (np.asarray(tomo[start:start + CHUNK_SLICES], dtype=np.float32) + 0.5)
+                mrcSeg.data[start:start + CHUNK_SLICES] = scores > params.segmentation_threshold
+                if mrcScores is not None:
+                    mrcScores.data[start:start + CHUNK_SLICES] = scores
+            if mrcScores is not None:
+                mrcScores.close()
+
+            if params.store_connected_components:
+                labels, _ = ndimage.label(mrcSeg.data > 0, structure=np.ones((3, 3, 3), dtype=bool))
+                if params.connected_component_thres:
+                    sizes = np.bincount(labels.ravel())
+                    labels[sizes[labels] < params.connected_component_thres] = 0
+                mrcSeg.data[:] = labels
+        for outFile in outFiles:
+            with mrcfile.open(outFile, mode='r+') as mrcOut:
+                mrcOut.update_header_stats()
+    print(f'MemBrain-seg stub: {params.tomogram_path} segmented into {params.out_folder}')
+
+
+def skeletonize(params):
+    """ Write the file of 'membrain skeletonize', a copy of the binarized segmentation. """
+    outFile = os.path.join(params.out_folder, f'{getBaseName(params.label_path)}_skel.mrc')
+    with mrcfile.mmap(params.label_path, mode='r', permissive=True) as mrcIn:
+        simulateInference(mrcIn.data.size)
+        with mrcfile.new_mmap(outFile, shape=mrcIn.data.shape, mrc_mode=2, overwrite=True) as mrcOut:
+            for start in range(0, mrcIn.data.shape[0], CHUNK_SLICES):
+                mrcOut.data[start:start + CHUNK_SLICES] = mrcIn.data[start:start + CHUNK_SLICES] > 0
+            mrcOut.voxel_size = mrcIn.voxel_size
+            mrcOut.update_header_stats()
+    print(f'MemBrain-seg stub: {params.label_path} skeletonized into {params.out_folder}')
+
+
+def main(args=None, prog_name: str = 'membrain', standalone_mode: bool = True):
+    """ Run a membrain command. The parameters are the ones of the click command behind the membrain executable, as
+    called by the worker. """
+    parser = argparse.ArgumentParser(prog=prog_name, description='Stand-in for the MemBrain-seg executable.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    segParser = subparsers.add_parser('segment')
+    segParser.add_argument('--ckpt-path', required=True)
+    segParser.add_argument('--tomogram-path', required=True)
+    segParser.add_argument('--out-folder', default='./predictions')
+    segParser.add_argument('--segmentation-threshold', type=float, default=0.0)
+    segParser.add_argument('--sliding-window-size', type=int, default=160)
+    segParser.add_argument('--test-time-augmentation', dest='test_time_augmentation', action='store_true',
+                           default=True)
+    segParser.add_argument('--no-test-time-augmentation', dest='test_time_augmentation', action='store_false')
+    segParser.add_argument('--store-probabilities', action='store_true')
+    segParser.add_argument('--store-connected-components', action='store_true')
+    segParser.add_argument('--connected-component-thres', type=int, default=None)
+    segParser.set_defaults(func=segment)
+
+    skelParser = subparsers.add_parser('skeletonize')
+    skelParser.add_argument('--label-path', required=True)
+    skelParser.add_argument('--out-folder', default='./predictions')
+    skelParser.add_argument('--batch-size', type=int, default=None)
+    skelParser.set_defaults(func=skeletonize)
+
+    # Unknown arguments (e.g. the additional ones given in the protocol form) are ignored
+    params, _ = parser.parse_known_args(args)
+    os.makedirs(params.out_folder, exist_ok=True)
+    params.func(params)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -25,9 +25,14 @@
 # **************************************************************************
 from typing import Tuple
 
+import mrcfile
+import numpy as np
 import pyworkflow.tests as pwtests
-from membrain.protocols import ProtMemBrainSeg, ProtMemBrainSkeletonize
-from membrain.protocols.protocol_membrain_seg import OUTPUT_TOMOMASK_NAME, OUTPUT_TOMOPROBMAP_NAME
+from membrain.protocols import ProtMemBrainSeg, ProtMemBrainSkeletonize, ProtMemBrainThreshold, \
+    ProtMemBrainConnectedComponents
+from membrain.protocols.protocol_membrain_seg import OUTPUT_TOMOMASK_NAME, OUTPUT_TOMOPROBMAP_NAME, \
+    OUTPUT_TOMOSKEL_NAME
+from membrain.utils.encoding import SCORES_FLOAT16
 from pyworkflow.utils import magentaStr, createLink
 from tomo.objects import SetOfTomoMasks, SetOfTomograms
 from tomo.protocols import ProtImportTomograms
@@ -65,15 +70,20 @@ class TestMembrain(TestBaseCentralizedLayer):
         return getattr(protImportTomo, OUTPUT_NAME, None)
 
     def _runMembrainSeg(self, inTomograms: SetOfTomograms,
-                        storeProbabilities: bool = False) -> Tuple[SetOfTomoMasks, SetOfTomoMasks]:
+                        storeProbabilities: bool = False,
+                        doSkeletonize: bool = False,
+                        **kwargs) -> Tuple[SetOfTomoMasks, SetOfTomoMasks, SetOfTomoMasks]:
         print(magentaStr("\n==> Segmenting the membranes:"))
         protMembrainSeg = self.newProtocol(
             ProtMemBrainSeg,
             inTomograms=inTomograms,
-            storeProbabilities=storeProbabilities)
+            storeProbabilities=storeProbabilities,
+            doSkeletonize=doSkeletonize,
+            **kwargs)
         protMembrainSeg = self.launchProtocol(protMembrainSeg)
         return (getattr(protMembrainSeg, OUTPUT_TOMOMASK_NAME, None),
-                getattr(protMembrainSeg, OUTPUT_TOMOPROBMAP_NAME, None))
+                getattr(protMembrainSeg, OUTPUT_TOMOPROBMAP_NAME, None),
+                getattr(protMembrainSeg, OUTPUT_TOMOSKEL_NAME, None))
 
     def _runMembrainSkel(self, inTomomasks: SetOfTomoMasks) -> SetOfTomoMasks:
         print(magentaStr("\n==> Skeletonizing the membranes:"))
@@ -82,6 +92,20 @@ class TestMembrain(TestBaseCentralizedLayer):
         protMembrainSkel = self.launchProtocol(protMembrainSkel)
         return getattr(protMembrainSkel, OUTPUT_TOMOMASK_NAME, None)
 
+    def _runMembrainThreshold(self, inProbMaps: SetOfTomoMasks, thresholds: str) -> ProtMemBrainThreshold:
+        print(magentaStr("\n==> Re-thresholding the probability maps:"))
+        protMembrainThr = self.newProtocol(ProtMemBrainThreshold,
+                                           inTomoProbMaps=inProbMaps,
+                                           thresholds=thresholds)
+        return self.launchProtocol(protMembrainThr)
+
+    def _runMembrainComponents(self, inTomoMasks: SetOfTomoMasks,
+                               sizeThresholds: str) -> ProtMemBrainConnectedComponents:
+        print(magentaStr("\n==> Labelling the connected components:"))
+        protMembrainCc = self.newProtocol(ProtMemBrainConnectedComponents,
+                                          inTomoMasks=inTomoMasks,
+                                          sizeThresholds=sizeThresholds)
+        return self.launchProtocol(protMembrainCc)
 
     def _checkTomoMasks(self, tomoMasks: SetOfTomoMasks):
         self.checkTomoMasks(tomoMasks,
@@ -92,24 +116,69 @@ class TestMembrain(TestBaseCentralizedLayer):
 
     def test_membrain_seg_01(self):
         importedTomos = self._importTomograms()
-        tomoMasks, tomoScores = self._runMembrainSeg(importedTomos)
+        tomoMasks, tomoScores, _ = self._runMembrainSeg(importedTomos)
         # Check the output sets
         self._checkTomoMasks(tomoMasks)
         self.assertIsNone(tomoScores)
 
     def test_membrain_seg_02(self):
         importedTomos = self._importTomograms()
-        tomoMasks, tomoScores = self._runMembrainSeg(importedTomos,
-                                                     storeProbabilities=True)
+        tomoMasks, tomoScores, _ = self._runMembrainSeg(importedTomos,
+                                                        storeProbabilities=True)
+        # Check the output sets
+        self._checkTomoMasks(tomoMasks)
+        self._checkTomoMasks(tomoScores)
+
+    def test_membrain_seg_03(self):
+        importedTomos = self._importTomograms()
+        tomoMasks, tomoScores, _ = self._runMembrainSeg(importedTomos,
+                                                        storeProbabilities=True,
+                                                        scoresEncoding=SCORES_FLOAT16,
+                                                        compressOutputs=True)
         # Check the output sets
         self._checkTomoMasks(tomoMasks)
         self._checkTomoMasks(tomoScores)
+        for tomoScore in tomoScores:
+            self.assertTrue(tomoScore.getFileName().endswith('.mrc.gz'))
+            with mrcfile.open(tomoScore.getFileName()) as mrc:
+                self.assertEqual(mrc.data.dtype, np.float16)
 
     def test_membrain_skel_01(self):
         importedTomos = self._importTomograms()
-        tomoMasks, _ = self._runMembrainSeg(importedTomos)
+        tomoMasks, _, _ = self._runMembrainSeg(importedTomos)
         tomoMasksSkel = self._runMembrainSkel(tomoMasks)
         self._checkTomoMasks(tomoMasksSkel)
 
+    def test_membrain_seg_skel_01(self):
+        importedTomos = self._importTomograms()
+        tomoMasks, _, tomoMasksSkel = self._runMembrainSeg(importedTomos, doSkeletonize=True)
+        self._checkTomoMasks(tomoMasks)
+        self._checkTomoMasks(tomoMasksSkel)
 
+    def test_membrain_threshold_01(self):
+        importedTomos = self._importTomograms()
+        tomoMasks, tomoScores, _ = self._runMembrainSeg(importedTomos, storeProbabilities=True)
+        protThr = self._runMembrainThreshold(tomoScores, thresholds='0.0 1.0')
+        tomoMasksThr0 = getattr(protThr, OUTPUT_TOMOMASK_NAME + '_1', None)
+        tomoMasksThr1 = getattr(protThr, OUTPUT_TOMOMASK_NAME + '_2', None)
+        self._checkTomoMasks(tomoMasksThr0)
+        self._checkTomoMasks(tomoMasksThr1)
+        # The default threshold of the segmentation protocol is 0, so the same segmentations must be obtained
+        segFiles = {tomoMask.getTsId(): tomoMask.getFileName() for tomoMask in tomoMasks}
+        for tomoMask in tomoMasksThr0:
+            with mrcfile.open(segFiles[tomoMask.getTsId()]) as seg, mrcfile.open(tomoMask.getFileName()) as thr:
+                np.testing.assert_array_equal(seg.data > 0, thr.data > 0)
 
+    def test_membrain_components_01(self):
+        importedTomos = self._importTomograms()
+        tomoMasks, _, _ = self._runMembrainSeg(importedTomos)
+        protCc = self._runMembrainComponents(tomoMasks, sizeThresholds='0 1000')
+        tomoMasksAll = getattr(protCc, OUTPUT_TOMOMASK_NAME + '_1', None)
+        tomoMasksBig = getattr(protCc, OUTPUT_TOMOMASK_NAME + '_2', None)
+        self._checkTomoMasks(tomoMasksAll)
+        self._checkTomoMasks(tomoMasksBig)
+        # Without size threshold, the components cover the whole segmentation
+        segFiles = {tomoMask.getTsId(): tomoMask.getFileName() for tomoMask in tomoMasks}
+        for tomoMask in tomoMasksAll:
+            with mrcfile.open(segFiles[tomoMask.getTsId()]) as seg, mrcfile.open(tomoMask.getFileName()) as cc:
+                np.testing.assert_array_equal(seg.data > 0, cc.data > 0)
@@ -0,0 +1,1205 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import json
+import os
+import shlex
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from multiprocessing.connection import Client, AuthenticationError
+from os.path import join, dirname, abspath
+from typing import Tuple, List
+
+import mrcfile
+import numpy as np
+from scipy import ndimage
+
+from membrain import OUTPUT_TOMOMASK_NAME
+from membrain.constants import MEMBRAIN_SEG_WORKER_SCRIPT
+from membrain.protocols import ProtMemBrainSeg, ProtMemBrainSkeletonize, ProtMemBrainThreshold, \
+    ProtMemBrainConnectedComponents
+from membrain.protocols.protocol_base import ProtMemBrainBase
+from membrain.scripts.membrain_seg_worker import BACKEND_TORCHSCRIPT, BACKEND_TORCHSCRIPT_BF16, CMD_PING, \
+    getExportFile, loadCpuModel
+from membrain.tests.membrain_stub import STARTUP_TIME_VAR, installDistribution
+from membrain.utils.agreement import measureAgreement
+from membrain.utils.blocks import createExecutor, getPoolThreads
+from membrain.utils.cache import SegmentationCache
+from membrain.utils.components import labelComponents, labelComponentsFile, countComponentsFile
+from membrain.utils.environment import EnvironmentCache, resolveEnvironment
+from membrain.utils.encoding import SCORES_FLOAT16, SCORES_INT8, encodeScores, compressFile, uncompressed, \
+    getScoresScale
+from membrain.utils.memory import GiB, estimateMemory, chooseWindowSize
+from membrain.utils.output_writer import BatchWriter
+from membrain.utils.preview import PREVIEW_SCORES, PreviewScanner, writePng
+from membrain.utils.perf import PerfStats, PerfTrace, measure, runCommand
+from membrain.utils.region import MIN_REGION_MARGIN, detectSlabFile, getMaskRegion, intersectRegions
+from membrain.utils.rescale import getBinFactor, binArray, binFile, upsampleFile, upsampleArray
+from membrain.utils.scheduler import DeviceScheduler, GPU, CPU
+from membrain.utils.skeletonize import skeletonize, skeletonizeFile, _importTorch
+from membrain.utils.sparse import writeSparse, readSparse, sparseToDense, subsample
+from membrain.utils.staging import ScratchStager
+from membrain.utils.stats import SegmentationStatsScanner, scanFile, getSegmentationStats, getScoresHistogram
+from membrain.utils.threads import parseCpuList, formatCpuList, getAvailableCores, getJobThreads, splitCores, \
+    getThreadEnviron, pinCommand
+from membrain.utils.threshold import thresholdFile
+from membrain.utils.tiling import getTiles, getTileWeights, stitchTiles
+from membrain.utils.worker import MemBrainSegWorker
+from pyworkflow.object import Float, Integer
+from tomo.objects import TomoMask
+
+TEST_DATA_DIR = join(dirname(abspath(__file__)), 'data')
+WORKER_SCRIPT = join(dirname(dirname(abspath(__file__))), 'scripts', MEMBRAIN_SEG_WORKER_SCRIPT)
+
+
+class TestDeviceScheduler(unittest.TestCase):
+
+    def test_sortBySize(self):
+        sizes = {'small': 10, 'big': 1000, 'medium': 100, 'medium2': 100}
+        self.assertEqual(DeviceScheduler.sortBySize(sizes), ['big', 'medium', 'medium2', 'small'])
+
+    def test_gpusBeforeCpus(self):
+        scheduler = DeviceScheduler([3, 5], nCpuSlots=1)
+        devices = [scheduler.acquire(jobId) for jobId in ['a', 'b', 'c']]
+        self.assertEqual([d.kind for d in devices], [GPU, GPU, CPU])
+        self.assertEqual(devices[0].getCudaVisibleDevices(), '3')
+        self.assertEqual(devices[2].getCudaVisibleDevices(), '')
+        # Once released, a GPU is preferred again over the CPU worker
+        scheduler.release('b')
+        scheduler.release('c')
+        self.assertEqual(str(scheduler.acquire('d')), 'gpu:5')
+        # Assignments are kept after releasing the device
+        self.assertEqual(str(scheduler.getAssignment('c')), 'cpu:0')
+        self.assertIsNone(scheduler.getAssignment('unknown'))
+
+    def test_noDevices(self):
+        with self.assertRaises(ValueError):
+            DeviceScheduler([], nCpuSlots=0)
+
+    def test_concurrentJobs(self):
+        """ Run more jobs than devices with fake devices and check that no device is ever oversubscribed and all of
+        them are used. """
+        scheduler = DeviceScheduler([0, 1], nCpuSlots=2)
+        running = {str(d): 0 for d in scheduler.getDevices()}
+        maxRunning = dict(running)
+        lock = threading.Lock()
+
+        def job(jobId):
+            with scheduler.device(jobId) as device:
+                with lock:
+                    running[str(device)] += 1
+                    maxRunning[str(device)] = max(maxRunning[str(device)], running[str(device)])
+                time.sleep(0.01)
+                with lock:
+                    running[str(device)] -= 1
+
+        threads = [threading.Thread(target=job, args=('job%d' % i,)) for i in range(20)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(set(maxRunning.values()), {1})
+        self.assertEqual(len({str(scheduler.getAssignment('job%d' % i)) for i in range(20)}), 4)
+
+    def test_memoryBudget(self):
+        scheduler = DeviceScheduler([0, 1], nCpuSlots=1, hostMemory=10)
+        self.assertEqual(str(scheduler.acquire('a', {GPU: 6, CPU: 8})), 'gpu:0')
+        # The second GPU is free, but the job does not fit in the memory left until the first one finishes
+        acquired = threading.Event()
+
+        def job():
+            scheduler.acquire('b', {GPU: 6, CPU: 8})
+            acquired.set()
+
+        thread = threading.Thread(target=job)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        scheduler.release('a')
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+        # A smaller job fits along with it, and a job larger than the budget runs alone
+        self.assertEqual(str(scheduler.acquire('c', {GPU: 4, CPU: 5})), 'gpu:1')
+        scheduler.release('b')
+        scheduler.release('c')
+        self.assertEqual(str(scheduler.acquire('d', {GPU: 20, CPU: 30})), 'gpu:0')
+
+
+class TestThreads(unittest.TestCase):
+
+    def test_cpuLists(self):
+        self.assertEqual(parseCpuList('0-3,8,10-11\n'), [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(formatCpuList([11, 0, 1, 2, 3, 8, 10]), '0-3,8,10-11')
+        self.assertEqual(formatCpuList([5]), '5')
+
+    def test_splitCores(self):
+        self.assertEqual(getJobThreads(64, 8), 8)
+        self.assertEqual(getJobThreads(3, 4), 1)
+        nodes = [list(range(0, 8)), list(range(8, 16))]
+        # Jobs within a node while they fit, then the remaining cores of several nodes
+        self.assertEqual(splitCores(nodes, 5, 3), [[0, 1, 2], [3, 4, 5], [8, 9, 10], [11, 12, 13], [6, 7, 14]])
+        # Sets reused if there are more jobs than cores
+        self.assertEqual(splitCores(nodes, 3, 8), [nodes[0], nodes[1], nodes[0]])
+        self.assertEqual(splitCores([[0, 1]], 2, 4), [[0, 1], [0, 1]])
+
+    def test_poolThreads(self):
+        # The processes of the pools working on blocks are limited too
+        with createExecutor(2, nThreads=3) as executor:
+            self.assertEqual(executor.submit(os.getenv, 'OMP_NUM_THREADS').result(), '3')
+        self.assertEqual(getPoolThreads(1), sum(len(node) for node in getAvailableCores()))
+
+    @unittest.skipUnless(shutil.which('taskset'), 'taskset is not available')
+    def test_pinCommand(self):
+        core = getAvailableCores()[0][-1]
+        script = 'import os, sys; print(sorted(os.sched_getaffinity(0)), os.environ["OMP_NUM_THREADS"], sys.argv[1:])'
+        cmd = pinCommand('%s -c %s' % (sys.executable, shlex.quote(script)), [core]) + ' "first arg" second'
+        output = subprocess.run(cmd, shell=True, capture_output=True, text=True, check=True,
+                                env={**os.environ, **getThreadEnviron(2)})
+        self.assertEqual(output.stdout.strip(), "[%d] 2 ['first arg', 'second']" % core)
+
+
+class TestMemory(unittest.TestCase):
+
+    def test_estimate(self):
+        small, big = estimateMemory(500 ** 3, 160), estimateMemory(1000 ** 3, 160)
+        self.assertGreater(big.host, small.host)
+        self.assertGreater(big.device, small.device)
+        self.assertGreater(estimateMemory(500 ** 3, 160).device, estimateMemory(500 ** 3, 96).device)
+        # On CPU, the network runs in the host memory
+        onCpu = estimateMemory(500 ** 3, 160, onGpu=False)
+        self.assertEqual(onCpu.device, 0)
+        self.assertGreater(onCpu.host, small.host)
+
+    def test_chooseWindowSize(self):
+        nVoxels = 500 ** 3
+        self.assertEqual(chooseWindowSize(nVoxels, 160, 100 * GiB), 160)
+        windowSize = chooseWindowSize(nVoxels, 160, estimateMemory(nVoxels, 128).device)
+        self.assertEqual(windowSize, 128)
+        self.assertIsNone(chooseWindowSize(nVoxels, 160, GiB))
+
+
+class TestSegmentationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.tomoFile = self._writeFile('tomo.mrc', b'tomogram')
+        self.modelFile = self._writeFile('model.ckpt', b'model')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _writeFile(self, fileName: str, content: bytes) -> str:
+        fileName = join(self.tmpDir, fileName)
+        with open(fileName, 'wb') as f:
+            f.write(content)
+        return fileName
+
+    def test_key(self):
+        cache = SegmentationCache(join(self.tmpDir, 'cache'), maxSize=1000)
+        key = cache.getKey(self.tomoFile, self.modelFile, {'a': 1, 'b': 2})
+        self.assertEqual(key, cache.getKey(self.tomoFile, self.modelFile, {'b': 2, 'a': 1}))
+        self.assertNotEqual(key, cache.getKey(self.tomoFile, self.modelFile, {'a': 1, 'b': 3}))
+        # The key depends on the content, not on the file name
+        link = join(self.tmpDir, 'link.mrc')
+        os.symlink(self.tomoFile, link)
+        copy = self._writeFile('copy.mrc', b'tomogram')
+        self.assertEqual(key, cache.getKey(link, self.modelFile, {'a': 1, 'b': 2}))
+        self.assertEqual(key, cache.getKey(copy, self.modelFile, {'a': 1, 'b': 2}))
+
+    def test_getPut(self):
+        cache = SegmentationCache(join(self.tmpDir, 'cache'), maxSize=1000)
+        key = cache.getKey(self.tomoFile, self.modelFile, {})
+        outFile = join(self.tmpDir, 'out.mrc')
+        self.assertFalse(cache.get(key, {'seg': outFile}))
+        cache.put(key, {'seg': self._writeFile('seg.mrc', b'segmentation')})
+        self.assertTrue(cache.get(key, {'seg': outFile}))
+        with open(outFile, 'rb') as f:
+            self.assertEqual(f.read(), b'segmentation')
+        # Files not stored in the entry are a miss
+        self.assertFalse(cache.get(key, {'seg': outFile, 'scores': join(self.tmpDir, 'scores.mrc')}))
+
+    def test_lruEviction(self):
+        cache = SegmentationCache(join(self.tmpDir, 'cache'), maxSize=25)
+        keys = [cache.getKey(self.tomoFile, self.modelFile, {'i': i}) for i in range(3)]
+        outFile = join(self.tmpDir, 'out.mrc')
+        cache.put(keys[0], {'seg': self._writeFile('seg0.mrc', b'0' * 10)})
+        time.sleep(0.01)
+        cache.put(keys[1], {'seg': self._writeFile('seg1.mrc', b'1' * 10)})
+        time.sleep(0.01)
+        self.assertTrue(cache.get(keys[0], {'seg': outFile}))  # Entry 1 becomes the least recently used
+        time.sleep(0.01)
+        cache.put(keys[2], {'seg': self._writeFile('seg2.mrc', b'2' * 10)})
+        self.assertTrue(cache.get(keys[0], {'seg': outFile}))
+        self.assertFalse(cache.get(keys[1], {'seg': outFile}))
+        self.assertTrue(cache.get(keys[2], {'seg': outFile}))
+
+
+class TestBatchWriter(unittest.TestCase):
+
+    def test_batches(self):
+        batches = []
+        writer = BatchWriter(batches.append, maxItems=3, maxDelay=60)
+        for i in range(7):
+            writer.put(i)
+        writer.stop()
+        self.assertEqual(batches, [[0, 1, 2], [3, 4, 5], [6]])
+        with self.assertRaises(RuntimeError):
+            writer.put(7)
+
+    def test_maxDelay(self):
+        batches = []
+        writer = BatchWriter(batches.append, maxItems=100, maxDelay=0.05)
+        writer.put(0)
+        writer.flush()
+        self.assertEqual(batches, [[0]])
+        writer.stop()
+
+    def test_concurrentProducers(self):
+        committed = []
+        writer = BatchWriter(committed.extend, maxItems=10, maxDelay=0.01)
+        threads = [threading.Thread(target=lambda i=i: [writer.put((i, j)) for j in range(50)]) for i in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        writer.stop()
+        self.assertEqual(sorted(committed), [(i, j) for i in range(4) for j in range(50)])
+
+    def test_error(self):
+        def commit(batch):
+            raise IOError('disk full')
+
+        writer = BatchWriter(commit, maxItems=1, maxDelay=60)
+        writer.put(0)
+        with self.assertRaises(RuntimeError):
+            writer.flush()
+
+
+class _StreamingSet:
+    """ Input set receiving a group of items each time it is reloaded, closed after the last one. """
+
+    def __init__(self, arrivals: list):
+        self.arrivals = arrivals
+        self.items = []
+        self.loadAllProperties()
+
+    def loadAllProperties(self):
+        if self.arrivals:
+            self.items.extend(TomoMask(tsId=tsId) for tsId in self.arrivals.pop(0))
+
+    def isStreamOpen(self) -> bool:
+        return bool(self.arrivals)
+
+    def iterItems(self):
+        return iter(list(self.items))
+
+
+class _StreamingProtocol(ProtMemBrainBase):
+    """ Protocol processing a _StreamingSet, one step per batch. """
+
+    def __init__(self, inSet: _StreamingSet, processedTsIds: set, **kwargs):
+        super().__init__(**kwargs)
+        self.inSet = inSet
+        self.processedTsIds = processedTsIds
+        self.streamingSleepOnWait = Float(0.01)
+        self.batchSize = Integer(2)
+        self.added = []
+        self.batches = {}
+
+    def _getInputSet(self, retPointer: bool = False) -> _StreamingSet:
+        return self.inSet
+
+    def _getProcessedTsIds(self, outputName: str = OUTPUT_TOMOMASK_NAME) -> set:
+        return self.processedTsIds
+
+    def _addInputItem(self, tsId: str, item: TomoMask):
+        self.added.append(tsId)
+
+    def _insertBatchSteps(self, tsIds: List[str]) -> int:
+        stepId = self._insertFunctionStep(self.processStep, *tsIds, prerequisites=[], needsGPU=False)
+        self.batches[stepId] = tsIds
+        return stepId
+
+    def processStep(self, *tsIds: str):
+        pass
+
+    def _getOutputSuffix(self, outputName: str) -> str:
+        return ''
+
+
+class TestStreaming(unittest.TestCase):
+
+    def test_stepsGenerator(self):
+        inSet = _StreamingSet([['t0', 't1', 't2'], [], ['t3', 't4']])
+        protocol = _StreamingProtocol(inSet, processedTsIds={'t1'})
+        protocol.stepsGeneratorStep()
+
+        # Each item is added once, even if seen again in every reload of the set
+        self.assertEqual(protocol.added, ['t0', 't1', 't2', 't3', 't4'])
+        # Registered by a previous execution, so not processed again. The items of each arrival are batched apart.
+        self.assertEqual(list(protocol.batches.values()), [['t0', 't2'], ['t3', 't4']])
+        closeStep = protocol._steps[-1]
+        self.assertEqual(closeStep.funcName.get(), 'closeOutputStep')
+        self.assertEqual(sorted(closeStep._prerequisites), sorted(protocol.batches))
+
+    def test_validateThreads(self):
+        # The steps generator takes one thread, so at least another one is needed to process the items
+        for protocolClass in [ProtMemBrainSeg, ProtMemBrainSkeletonize, ProtMemBrainThreshold,
+                              ProtMemBrainConnectedComponents]:
+            protocol = protocolClass()
+            protocol.numberOfThreads.set(1)
+            self.assertTrue(any('2 threads' in error for error in protocol._validate()), protocolClass.__name__)
+
+
+class TestScratchStager(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.scratchDir = join(self.tmpDir, 'scratch')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_stageAndCopyBack(self):
+        stager = ScratchStager(self.scratchDir, maxStaged=2)
+        srcFiles = {}
+        for i in range(3):
+            srcFiles[i] = join(self.tmpDir, 'tomo%d.mrc' % i)
+            with open(srcFiles[i], 'wb') as f:
+                f.write(os.urandom(1000))
+            stager.add('job%d' % i, srcFiles[i])
+
+        localFile = stager.getInput('job0')
+        self.assertNotEqual(localFile, srcFiles[0])
+        self.assertEqual(os.path.basename(localFile), 'tomo0.mrc')
+        with open(localFile, 'rb') as f1, open(srcFiles[0], 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+        outFile = join(stager.getOutputDir('job0'), 'result.mrc')
+        with open(outFile, 'wb') as f:
+            f.write(b'result')
+        stager.releaseInput('job0')
+        self.assertFalse(os.path.exists(localFile))
+        dstFile = join(self.tmpDir, 'result.mrc')
+        stager.copyBack('job0', {outFile: dstFile})
+        stager.waitCopyBack('job0')
+        with open(dstFile, 'rb') as f:
+            self.assertEqual(f.read(), b'result')
+        self.assertFalse(os.path.exists(outFile))
+
+        # Jobs not prefetched yet are staged on demand
+        self.assertTrue(os.path.exists(stager.getInput('job2')))
+        stager.close()
+        self.assertEqual(os.listdir(self.scratchDir), [])
+
+    def test_failedCopyBack(self):
+        stager = ScratchStager(self.scratchDir)
+        stager.copyBack('job', {join(self.tmpDir, 'missing.mrc'): join(self.tmpDir, 'result.mrc')})
+        with self.assertRaises(IOError):
+            stager.waitCopyBack('job')
+        self.assertFalse(os.path.lexists(join(self.tmpDir, 'result.mrc')))
+        stager.close()
+
+
+class TestSkeletonize(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    @staticmethod
+    def _shells(shape: tuple) -> np.ndarray:
+        """ Segmentation made of a few thick spherical shells. """
+        z, y, x = np.indices(shape)
+        seg = np.zeros(shape, dtype=np.int8)
+        for center, radius, thickness in [((20, 20, 20), 12, 2.5), ((30, 45, 10), 20, 3.5), ((5, 5, 50), 25, 2)]:
+            dist = np.sqrt((z - center[0]) ** 2 + (y - center[1]) ** 2 + (x - center[2]) ** 2)
+            seg[np.abs(dist - radius) < thickness] = 1
+        return seg
+
+    def test_matchesMemBrainSeg(self):
+        """ The reference skeleton was computed by skeletonization() of MemBrain-seg 0.0.10, on the segmentation
+        transposed to x, y, z as 'membrain skeletonize' does. The slab has an even thickness, so its central ridge
+        is decided by exact ties. """
+        if _importTorch() is None:
+            self.skipTest('The skeletons only match the ones of MemBrain-seg exactly with PyTorch installed.')
+        seg = self._shells((40, 60, 70))
+        seg[30:36] = 1
+        with np.load(join(TEST_DATA_DIR, 'skeleton_reference.npz')) as reference:
+            shape = tuple(reference['shape'])
+            refSkeleton = np.unpackbits(reference['skeleton'], count=int(np.prod(shape))).reshape(shape)
+        np.testing.assert_array_equal(skeletonize(seg), refSkeleton)
+
+    def test_plane(self):
+        seg = np.zeros((20, 30, 30), dtype=np.int8)
+        seg[8:13] = 1
+        skel = skeletonize(seg)
+        # The skeleton is the central plane of the slab
+        self.assertEqual(set(np.nonzero(skel)[0]), {10})
+
+    def test_blocksMatchWholeVolume(self):
+        seg = self._shells((40, 60, 70))
+        inFile, outFile = join(self.tmpDir, 'seg.mrc'), join(self.tmpDir, 'skel.mrc')
+        with mrcfile.new(inFile) as mrc:
+            mrc.set_data(seg)
+        skeletonizeFile(inFile, outFile, samplingRate=13.5, nProcs=2, blockSize=16)
+        with mrcfile.open(outFile) as mrc:
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 13.5, places=3)
+            np.testing.assert_array_equal(mrc.data, skeletonize(seg))
+
+
+class TestThreshold(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_thresholds(self):
+        scores = np.random.default_rng(0).normal(size=(37, 20, 30)).astype(np.float32)
+        inFile = join(self.tmpDir, 'scores.mrc')
+        with mrcfile.new(inFile) as mrc:
+            mrc.set_data(scores)
+        outFiles = {threshold: join(self.tmpDir, 'seg%d.mrc' % i) for i, threshold in enumerate([-0.5, 0, 1.2])}
+        thresholdFile(inFile, outFiles, samplingRate=4.2, chunkSlices=8)
+        for threshold, outFile in outFiles.items():
+            with mrcfile.open(outFile) as mrc:
+                self.assertEqual(mrc.data.dtype, np.int8)
+                self.assertAlmostEqual(float(mrc.voxel_size.x), 4.2, places=3)
+                np.testing.assert_array_equal(mrc.data, scores > threshold)
+
+
+class TestRescale(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_getBinFactor(self):
+        self.assertEqual(getBinFactor(2.7, 10), 4)
+        self.assertEqual(getBinFactor(5.4, 10), 2)
+        self.assertEqual(getBinFactor(7.5, 10), 1)
+        self.assertEqual(getBinFactor(14, 10), 1)
+
+    def test_binAndUpsample(self):
+        # Shape not multiple of the factor, processed by several chunks
+        tomo = np.random.default_rng(0).normal(size=(23, 17, 30)).astype(np.float32)
+        tomoFile = join(self.tmpDir, 'tomo.mrc')
+        with mrcfile.new(tomoFile) as mrc:
+            mrc.set_data(tomo)
+        binnedFile = join(self.tmpDir, 'tomo_bin3.mrc')
+        shape = binFile(tomoFile, binnedFile, 3, samplingRate=3.3, chunkSlices=8)
+        self.assertEqual(shape, tomo.shape)
+        expected = binArray(tomo, 3)
+        with mrcfile.open(binnedFile) as mrc:
+            self.assertEqual(mrc.data.shape, (8, 6, 10))
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 9.9, places=3)
+            np.testing.assert_allclose(mrc.data, expected, rtol=1e-5)
+        np.testing.assert_allclose(expected[-1, -1, -1], tomo[21:, 15:, 27:].mean(), rtol=1e-5)
+
+        # A segmentation of the binned tomogram, back on the original grid
+        segFile = join(self.tmpDir, 'seg.mrc')
+        with mrcfile.new(segFile) as mrc:
+            mrc.set_data((expected > 0).astype(np.int8))
+            mrc.add_label('segmentation')
+        upsampleFile(segFile, segFile, 3, shape, samplingRate=3.3, chunkSlices=8)
+        with mrcfile.open(segFile) as mrc:
+            self.assertEqual(mrc.data.dtype, np.int8)
+            self.assertEqual(mrc.data.shape, tomo.shape)
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 3.3, places=3)
+            self.assertIn(b'segmentation', mrc.header.label[:mrc.header.nlabl].tobytes())
+            z, y, x = np.meshgrid(*(np.arange(n) // 3 for n in tomo.shape), indexing='ij')
+            np.testing.assert_array_equal(mrc.data, expected[z, y, x] > 0)
+
+
+    def test_region(self):
+        tomo = np.random.default_rng(1).normal(size=(20, 16, 18)).astype(np.float32)
+        tomoFile = join(self.tmpDir, 'tomo.mrc')
+        with mrcfile.new(tomoFile) as mrc:
+            mrc.set_data(tomo)
+        region = (slice(3, 17), slice(2, 16), slice(5, 11))
+        binnedFile = join(self.tmpDir, 'tomo_input.mrc')
+        shape = binFile(tomoFile, binnedFile, 2, samplingRate=5, region=region, chunkSlices=4)
+        with mrcfile.open(binnedFile) as mrc:
+            binned = mrc.data.copy()
+        np.testing.assert_allclose(binned, binArray(tomo[region], 2), rtol=1e-5)
+
+        upsampleFile(binnedFile, binnedFile, 2, shape, samplingRate=5, region=region, background=-1, chunkSlices=4)
+        expected = np.full(tomo.shape, -1, dtype=np.float32)
+        expected[region] = upsampleArray(binned, 2, tomo[region].shape)
+        with mrcfile.open(binnedFile) as mrc:
+            np.testing.assert_array_equal(mrc.data, expected)
+
+
+class TestRegion(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_detectSlab(self):
+        rng = np.random.default_rng(0)
+        tomo = rng.normal(size=(200, 64, 64)).astype(np.float32)
+        # Structures smooth enough to survive the binning, only in the slab
+        tomo[80:120] += 3 * ndimage.gaussian_filter(rng.normal(size=(40, 64, 64)), 3) / 0.03
+        tomoFile = join(self.tmpDir, 'tomo.mrc')
+        with mrcfile.new(tomoFile) as mrc:
+            mrc.set_data(tomo)
+        zRegion, yRegion, xRegion = detectSlabFile(tomoFile)
+        self.assertLessEqual(zRegion.start, 80)
+        self.assertGreaterEqual(zRegion.start, 80 - 2 * MIN_REGION_MARGIN)
+        self.assertGreaterEqual(zRegion.stop, 120)
+        self.assertLessEqual(zRegion.stop, 120 + 2 * MIN_REGION_MARGIN)
+        self.assertEqual((yRegion, xRegion), (slice(0, 64), slice(0, 64)))
+
+        # Only noise
+        with mrcfile.new(tomoFile, overwrite=True) as mrc:
+            mrc.set_data(rng.normal(size=(50, 32, 32)).astype(np.float32))
+        self.assertIsNone(detectSlabFile(tomoFile))
+
+    def test_maskRegion(self):
+        # Mask binned by 2 with respect to the tomogram
+        mask = np.zeros((50, 40, 60), dtype=np.int8)
+        mask[20:30, 5:10, 25:50] = 1
+        maskFile = join(self.tmpDir, 'mask.mrc')
+        with mrcfile.new(maskFile) as mrc:
+            mrc.set_data(mask)
+        m = MIN_REGION_MARGIN
+        region = getMaskRegion(maskFile, (100, 80, 120), chunkSlices=8)
+        self.assertEqual(region, (slice(40 - m, 60 + m), slice(0, 20 + m), slice(50 - m, 100 + m)))
+        self.assertEqual(intersectRegions(region, (slice(0, 50), slice(0, 80), slice(0, 120))),
+                         (slice(40 - m, 50), slice(0, 20 + m), slice(50 - m, 100 + m)))
+        self.assertEqual(intersectRegions(None, region), region)
+
+        with mrcfile.new(maskFile, overwrite=True) as mrc:
+            mrc.set_data(np.zeros((10, 10, 10), dtype=np.int8))
+        self.assertIsNone(getMaskRegion(maskFile, (10, 10, 10)))
+
+
+class TestSparse(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_roundTrip(self):
+        rng = np.random.default_rng(0)
+        labels = np.zeros((40, 30, 50), dtype=np.int16)
+        labels[5:35, 10, 5:45] = 1
+        labels[20, 2:28, 3:8] = 300
+        skeleton = (rng.random(labels.shape) < 0.3) & (labels > 0)
+        labelsFile = join(self.tmpDir, 'labels.mrc')
+        skelFile = join(self.tmpDir, 'skel.mrc')
+        with mrcfile.new(labelsFile) as mrc:
+            mrc.set_data(labels)
+        with mrcfile.new(skelFile) as mrc:
+            mrc.set_data(skeleton.astype(np.int8))
+            mrc.voxel_size = 7.5
+        compressedLabels = compressFile(labelsFile)
+
+        sparseFile = join(self.tmpDir, 'skel.npz')
+        self.assertEqual(writeSparse(skelFile, sparseFile, labelsFile=compressedLabels, chunkSlices=7),
+                         skeleton.sum())
+        sparse = readSparse(sparseFile)
+        self.assertEqual(sparse.shape, labels.shape)
+        self.assertEqual(sparse.voxelSize, 7.5)
+        self.assertEqual(sparse.coords.dtype, np.uint16)
+        np.testing.assert_array_equal(sparse.coords, np.argwhere(skeleton))
+        np.testing.assert_array_equal(sparse.labels, labels[skeleton])
+
+        denseFile = join(self.tmpDir, 'dense.mrc')
+        sparseToDense(sparseFile, denseFile, chunkSlices=7)
+        with mrcfile.open(denseFile) as mrc:
+            np.testing.assert_array_equal(mrc.data, np.where(skeleton, labels, 0))
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 7.5, places=5)
+
+    def test_subsample(self):
+        coords = np.argwhere(np.ones((8, 8, 8)))
+        self.assertEqual(len(subsample(coords, 1)), len(coords))
+        indices = subsample(coords, 4)
+        self.assertEqual(len(indices), 8)
+        self.assertEqual(len(np.unique(coords[indices] // 4, axis=0)), 8)
+
+
+class TestTiling(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_tiles(self):
+        shape = (40, 100, 151)
+        tiles = getTiles(shape, 64, 16)
+        self.assertEqual(len(tiles), 1 * 2 * 3)
+        self.assertEqual(getTiles((40, 50, 60), 64, 16), [(slice(0, 40), slice(0, 50), slice(0, 60))])
+        covered = np.zeros(shape, dtype=np.float32)
+        for tile in tiles:
+            self.assertTrue(all(s.stop - s.start == min(64, n) for s, n in zip(tile, shape)))
+            zWeights, yWeights, xWeights = getTileWeights(shape, 64, 16, tile)
+            covered[tile] += zWeights[:, None, None] * yWeights[None, :, None] * xWeights[None, None, :]
+        # The weights of neighbouring tiles add up to 1
+        np.testing.assert_allclose(covered, 1, rtol=1e-6)
+        with self.assertRaises(ValueError):
+            getTiles(shape, 64, 33)
+
+    def test_stitchStandInModel(self):
+        """ A local model, whose predictions only depend on a neighbourhood of 2 voxels, gives the same scores by
+        tiles (with an overlap of at least 4 times that) as on the whole volume. """
+        def model(data):
+            return ndimage.uniform_filter(data, size=5) - 0.5
+
+        rng = np.random.default_rng(0)
+        tomo = rng.random((50, 70, 90)).astype(np.float32)
+        tileSize, overlap = 32, 12
+        tiles = getTiles(tomo.shape, tileSize, overlap)
+        tileFiles = []
+        for i, tile in enumerate(tiles):
+            tileFiles.append(join(self.tmpDir, 'tile%d_scores.mrc' % i))
+            with mrcfile.new(tileFiles[-1]) as mrc:
+                mrc.set_data(model(np.ascontiguousarray(tomo[tile])))
+        outFile = join(self.tmpDir, 'scores.mrc')
+        stitchTiles(tileFiles, tomo.shape, tileSize, overlap, outFile, 12.0, chunkSlices=7)
+        with mrcfile.open(outFile) as mrc:
+            np.testing.assert_allclose(mrc.data, model(tomo), atol=1e-6)
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 12.0)
+
+
+class TestAgreement(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _writeVolume(self, name: str, data: np.ndarray) -> str:
+        fileName = join(self.tmpDir, name)
+        with mrcfile.new(fileName) as mrc:
+            mrc.set_data(data)
+        return fileName
+
+    def test_agreement(self):
+        rng = np.random.default_rng(0)
+        refScores = rng.normal(size=(20, 30, 40)).astype(np.float32)
+        scores = refScores + rng.normal(scale=0.01, size=refScores.shape).astype(np.float32)
+        files = [self._writeVolume('%s.mrc' % name, data) for name, data in
+                 [('refSeg', (refScores > 0).astype(np.int8)), ('seg', (scores > 0).astype(np.int8)),
+                  ('refScores', refScores), ('scores', scores)]]
+        agreement = measureAgreement(*files, chunkSlices=7)
+        refSeg, seg = refScores > 0, scores > 0
+        self.assertAlmostEqual(agreement['dice'], 2 * (refSeg & seg).sum() / (refSeg.sum() + seg.sum()))
+        self.assertAlmostEqual(agreement['voxelAgreement'], (refSeg == seg).mean())
+        self.assertAlmostEqual(agreement['maxScoreDiff'], np.abs(refScores - scores).max(), places=6)
+        self.assertAlmostEqual(agreement['meanScoreDiff'], np.abs(refScores - scores).mean(), places=6)
+
+        # Identical empty segmentations agree fully
+        emptyFile = self._writeVolume('empty.mrc', np.zeros((5, 6, 7), dtype=np.int8))
+        self.assertEqual(measureAgreement(emptyFile, emptyFile), {'dice': 1.0, 'voxelAgreement': 1.0})
+        with self.assertRaises(ValueError):
+            measureAgreement(files[0], emptyFile)
+
+
+def _hasTorch() -> bool:
+    try:
+        import torch
+        return True
+    except ImportError:
+        return False
+
+
+@unittest.skipUnless(_hasTorch(), 'PyTorch is only available in the MemBrain-seg environment')
+class TestCpuExport(unittest.TestCase):
+
+    def setUp(self):
+        import torch
+        self.tmpDir = tempfile.mkdtemp()
+        self.checkpoint = join(self.tmpDir, 'model.ckpt')
+        with open(self.checkpoint, 'w') as f:
+            f.write('stand-in')
+        torch.manual_seed(0)
+        # Stand-in for the U-Net of MemBrain-seg, with the same kinds of layers
+        self.model = torch.nn.Sequential(torch.nn.Conv3d(1, 4, 3, padding=1), torch.nn.InstanceNorm3d(4, affine=True),
+                                         torch.nn.LeakyReLU(0.01), torch.nn.Conv3d(4, 1, 1))
+        self.loads = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _loadFromCheckpoint(self, checkpointPath, **kwargs):
+        self.loads += 1
+        return self.model
+
+    def test_export(self):
+        import torch
+        inputs = torch.randn(2, 1, 24, 40, 32)  # Not the shape the model is traced with
+        with torch.no_grad():
+            expected = self.model.eval()(inputs)
+            for backend, atol in [(BACKEND_TORCHSCRIPT, 1e-5), (BACKEND_TORCHSCRIPT_BF16, 0.1)]:
+                model = loadCpuModel(self.checkpoint, backend, self._loadFromCheckpoint)
+                self.assertTrue(os.path.exists(getExportFile(self.checkpoint, backend)))
+                output = model(inputs)
+                self.assertEqual(output.dtype, torch.float32)
+                torch.testing.assert_close(output, expected, atol=atol, rtol=0)
+                # The saved model is reused
+                torch.testing.assert_close(loadCpuModel(self.checkpoint, backend, self._loadFromCheckpoint)(inputs),
+                                           output)
+            self.assertEqual(self.loads, 2)
+
+
+class TestSegWorker(unittest.TestCase):
+    """ Persistent worker running the stand-in of the membrain executable (membrain_stub.py). """
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        siteDir = join(self.tmpDir, 'site')
+        installDistribution(siteDir)
+        self.env = {**os.environ, 'PYTHONPATH': os.pathsep.join([siteDir, os.environ.get('PYTHONPATH', '')])}
+        self.tomoFile = join(self.tmpDir, 'tomo.mrc')
+        with mrcfile.new(self.tomoFile) as mrc:
+            mrc.set_data(np.random.default_rng(0).normal(size=(16, 24, 20)).astype(np.float32))
+            mrc.voxel_size = 10
+        self.worker = self._newWorker()
+
+    def tearDown(self):
+        self.worker.stop()
+        shutil.rmtree(self.tmpDir)
+
+    def _newWorker(self, **env) -> MemBrainSegWorker:
+        return MemBrainSegWorker(f'{shlex.quote(sys.executable)} -u {shlex.quote(WORKER_SCRIPT)}',
+                                 join(self.tmpDir, 'worker.log'), startTimeout=60, env={**self.env, **env})
+
+    def _segmentArgs(self, outDir: str) -> str:
+        return f'segment --ckpt-path model.ckpt --tomogram-path {self.tomoFile} --out-folder {outDir}'
+
+    def test_jobs(self):
+        output, stats = self.worker.run(self._segmentArgs(join(self.tmpDir, 'out1')))
+        self.assertIn('MemBrain-seg stub', output)
+        self.assertTrue(os.path.exists(join(self.tmpDir, 'out1', 'tomo_model.ckpt_segmented.mrc')))
+        self.assertGreater(stats['startTime'], 0)
+        self.assertGreaterEqual(stats['wallTime'], 0)
+        pid = self.worker._process.pid
+        # The next jobs run in the same process
+        _, stats = self.worker.run(self._segmentArgs(join(self.tmpDir, 'out2')))
+        self.assertNotIn('startTime', stats)
+        self.assertEqual(self.worker._process.pid, pid)
+        # A failed job is reported and does not stop the worker
+        with self.assertRaisesRegex(RuntimeError, 'job failed'):
+            self.worker.run('segment --ckpt-path model.ckpt')
+        self.assertTrue(self.worker.isAlive())
+
+    def test_authentication(self):
+        self.worker.start()
+        with self.assertRaises(AuthenticationError):
+            with Client(self.worker._address, family='AF_UNIX', authkey=b'other key') as conn:
+                conn.send({'cmd': CMD_PING})
+        # It keeps serving its own client
+        self.worker.run(self._segmentArgs(self.tmpDir))
+
+    def test_crash(self):
+        # The first job of the worker takes long enough to kill it while running
+        self.worker = self._newWorker(**{STARTUP_TIME_VAR: '3'})
+        self.worker.start()
+        pid = self.worker._process.pid
+        threading.Timer(1, os.killpg, (pid, signal.SIGKILL)).start()
+        with self.assertRaisesRegex(RuntimeError, 'finished unexpectedly'):
+            self.worker.run(self._segmentArgs(self.tmpDir))
+        self.assertFalse(self.worker.isAlive())
+        # Launched again for the next job
+        _, stats = self.worker.run(self._segmentArgs(self.tmpDir))
+        self.assertIn('startTime', stats)
+        self.assertNotEqual(self.worker._process.pid, pid)
+
+    def test_stop(self):
+        self.worker.start()
+        process, socketDir = self.worker._process, self.worker._socketDir
+        self.worker.stop()
+        self.assertEqual(process.wait(timeout=10), 0)
+        self.assertFalse(os.path.exists(socketDir))
+        self.assertFalse(self.worker.isAlive())
+        self.worker.stop()  # Nothing to do
+
+
+class TestConnectedComponents(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_labelComponents(self):
+        seg = np.zeros((10, 10, 10), dtype=np.int8)
+        seg[1:3, 1:3, 1:3] = 1  # 8 voxels
+        seg[5, 5, 5] = seg[6, 6, 6] = 1  # 2 voxels, diagonal neighbours
+        seg[8, 1:9, 1] = 1  # 8 voxels
+        np.testing.assert_array_equal(np.unique(labelComponents(seg)), [0, 1, 2, 3])
+        labels = labelComponents(seg, sizeThreshold=3)
+        self.assertEqual(labels[1, 1, 1], 1)
+        self.assertEqual(labels[5, 5, 5], 0)
+        self.assertEqual(labels[8, 1, 1], 2)
+
+    def test_blocksMatchWholeVolume(self):
+        rng = np.random.default_rng(0)
+        seg = (ndimage.gaussian_filter(rng.random((37, 41, 29)), 1.5) > 0.52).astype(np.int8)
+        inFile = join(self.tmpDir, 'seg.mrc')
+        with mrcfile.new(inFile) as mrc:
+            mrc.set_data(seg)
+        outFiles = {size: join(self.tmpDir, 'cc%d.mrc' % size) for size in [0, 20, 500]}
+        nComponents = labelComponentsFile(inFile, outFiles, samplingRate=6.8, blockSize=11, nProcs=2)
+        for size, outFile in outFiles.items():
+            expected = labelComponents(seg, sizeThreshold=size)
+            self.assertEqual(nComponents[size], expected.max())
+            with mrcfile.open(outFile) as mrc:
+                self.assertAlmostEqual(float(mrc.voxel_size.x), 6.8, places=3)
+                np.testing.assert_array_equal(mrc.data, expected)
+            self.assertEqual(countComponentsFile(inFile, size, blockSize=11, nProcs=2), nComponents[size])
+            # As counted when resuming, from the labelled output
+            self.assertEqual(countComponentsFile(outFile, blockSize=11, nProcs=2), nComponents[size])
+
+
+class TestStats(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_segmentationStats(self):
+        seg = np.zeros((20, 30, 40), dtype=np.int8)
+        seg[3:5, 10:12, 7] = 1
+        seg[15, 25, 30:33] = 2
+        segFile = join(self.tmpDir, 'seg.mrc')
+        with mrcfile.new(segFile) as mrc:
+            mrc.set_data(seg)
+        stats = getSegmentationStats(compressFile(segFile), chunkSlices=4)
+        self.assertAlmostEqual(stats.membraneFraction, 7 / seg.size)
+        self.assertEqual(stats.boundingBox, (7, 10, 3, 32, 25, 15))
+        self.assertEqual(stats.nLabels, 2)
+
+        with mrcfile.new(segFile, overwrite=True) as mrc:
+            mrc.set_data(np.zeros((5, 6, 7), dtype=np.int8))
+        self.assertEqual(getSegmentationStats(segFile), (0.0, None, 0))
+
+    def test_filteredComponents(self):
+        # Connected components labelled as MemBrain-seg does, removing the small ones without renumbering the rest
+        seg = np.zeros((20, 30, 40), dtype=np.int8)
+        seg[2:8, 3:9, 4:10] = 1
+        seg[12, 15, 20] = 1
+        seg[14:19, 20:28, 30:38] = 1
+        labels, _ = ndimage.label(seg)
+        labels[labels == 2] = 0
+        segFile = join(self.tmpDir, 'seg.mrc')
+        with mrcfile.new(segFile) as mrc:
+            mrc.set_data(labels.astype(np.int8))
+        stats = getSegmentationStats(segFile, chunkSlices=3)
+        self.assertEqual(labels.max(), 3)
+        self.assertEqual(stats.nLabels, 2)
+
+    def test_scoresHistogram(self):
+        rng = np.random.default_rng(0)
+        scores = rng.normal(scale=4, size=(20, 30, 40)).astype(np.float32)
+        scoresFile = join(self.tmpDir, 'scores.mrc')
+        with mrcfile.new(scoresFile) as mrc:
+            mrc.set_data(scores)
+        expected, _ = np.histogram(1 / (1 + np.exp(-scores.astype(np.float64))), bins=10, range=(0, 1))
+        histogram = getScoresHistogram(scoresFile, chunkSlices=7)
+        self.assertEqual(sum(histogram), scores.size)
+        # Only the voxels right on the edges of the bins may be counted differently
+        self.assertLessEqual(np.abs(np.array(histogram) - expected).sum(), 2)
+        # Quantized scores are compared in their own units: only the voxels near the edges may change of bin
+        encodeScores(scoresFile, scoresFile, SCORES_INT8)
+        self.assertLessEqual(np.abs(np.array(getScoresHistogram(scoresFile)) - expected).sum(), scores.size * 0.05)
+
+
+class TestPreview(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    @staticmethod
+    def _readPng(fileName: str) -> np.ndarray:
+        with open(fileName, 'rb') as f:
+            png = f.read()
+        width, height = struct.unpack('>II', png[16:24])
+        idatStart = png.index(b'IDAT')
+        idatSize = struct.unpack('>I', png[idatStart - 4:idatStart])[0]
+        rows = np.frombuffer(zlib.decompress(png[idatStart + 4:idatStart + 4 + idatSize]), dtype=np.uint8)
+        return rows.reshape(height, width + 1)[:, 1:]
+
+    def test_png(self):
+        image = np.arange(12, dtype=np.uint8).reshape(3, 4) * 20
+        writePng(join(self.tmpDir, 'image.png'), image)
+        np.testing.assert_array_equal(self._readPng(join(self.tmpDir, 'image.png')), image)
+
+    def test_maskPreviews(self):
+        rng = np.random.default_rng(0)
+        seg = (ndimage.gaussian_filter(rng.random((40, 48, 64)), 2) > 0.51).astype(np.int8)
+        segFile = join(self.tmpDir, 'seg.mrc')
+        with mrcfile.new(segFile) as mrc:
+            mrc.set_data(seg)
+            mrc.voxel_size = 7.0
+        # Read in chunks not aligned with the blocks binned together, along with the statistics
+        previews, stats = scanFile(segFile, [PreviewScanner(join(self.tmpDir, 'seg')), SegmentationStatsScanner()],
+                                   chunkSlices=5)
+        self.assertEqual(stats.membraneFraction, seg.mean())
+        for factor, levelFile in zip([2, 4, 8], previews['levels']):
+            with mrcfile.open(levelFile) as mrc:
+                self.assertAlmostEqual(float(mrc.voxel_size.x), 7.0 * factor, places=4)
+                np.testing.assert_array_equal(mrc.data, np.rint(binArray(seg, factor) * 100))
+        xy, xz, yz = (self._readPng(f) for f in previews['thumbnails'])
+        np.testing.assert_array_equal(xy, np.flipud(seg[20]) * 255)
+        np.testing.assert_array_equal(xz, np.flipud(seg[:, 24, :]) * 255)
+        np.testing.assert_array_equal(yz, np.flipud(seg[:, :, 32]) * 255)
+
+    def test_scoresPreviews(self):
+        rng = np.random.default_rng(0)
+        scores = rng.normal(scale=3, size=(17, 600, 30)).astype(np.float32)
+        scoresFile = join(self.tmpDir, 'scores.mrc')
+        with mrcfile.new(scoresFile) as mrc:
+            mrc.set_data(scores)
+        encodeScores(scoresFile, scoresFile, SCORES_INT8)
+        previews = scanFile(scoresFile, [PreviewScanner(join(self.tmpDir, 'scores'), PREVIEW_SCORES)])[0]
+        with mrcfile.open(previews['levels'][-1]) as mrc:
+            self.assertEqual(mrc.data.shape, (3, 75, 4))
+            self.assertEqual(mrc.data.dtype, np.float16)
+            np.testing.assert_allclose(mrc.data, binArray(binArray(binArray(scores, 2), 2), 2), atol=0.05)
+        # Reduced to at most 256 pixels, by 3
+        xy = self._readPng(previews['thumbnails'][0])
+        self.assertEqual(xy.shape, (200, 10))
+        probabilities = 255 / (1 + np.exp(-binArray(scores[8], 3)))
+        np.testing.assert_allclose(xy, np.flipud(probabilities), atol=3)
+
+
+class TestEncoding(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _writeScores(self) -> Tuple[np.ndarray, str]:
+        scores = np.random.default_rng(0).normal(scale=5, size=(21, 30, 40)).astype(np.float32)
+        inFile = join(self.tmpDir, 'scores.mrc')
+        with mrcfile.new(inFile) as mrc:
+            mrc.set_data(scores)
+            mrc.voxel_size = 7.5
+        return scores, inFile
+
+    def test_float16(self):
+        scores, inFile = self._writeScores()
+        encodeScores(inFile, inFile, SCORES_FLOAT16, chunkSlices=4)
+        with mrcfile.open(inFile) as mrc:
+            self.assertEqual(mrc.header.mode, 12)
+            self.assertAlmostEqual(float(mrc.voxel_size.x), 7.5, places=3)
+            np.testing.assert_allclose(mrc.data, scores, rtol=1e-3)
+
+    def test_int8(self):
+        scores, inFile = self._writeScores()
+        encodeScores(inFile, inFile, SCORES_INT8, chunkSlices=4)
+        with mrcfile.open(inFile) as mrc:
+            self.assertEqual(mrc.data.dtype, np.int8)
+            scale = getScoresScale(mrc)
+            np.testing.assert_allclose(mrc.data * scale, scores, atol=scale / 2 + 1e-6)
+        # The thresholds are applied to the scores, not to the quantized values
+        outFile = join(self.tmpDir, 'seg.mrc')
+        thresholdFile(inFile, {2.0: outFile})
+        with mrcfile.open(outFile) as mrc:
+            self.assertLess(np.mean(mrc.data != (scores > 2.0)), 0.01)
+
+    def test_compressed(self):
+        seg = TestSkeletonize._shells((30, 40, 40))
+        inFile = join(self.tmpDir, 'seg.mrc')
+        with mrcfile.new(inFile) as mrc:
+            mrc.set_data(seg)
+        size = os.path.getsize(inFile)
+        gzFile = compressFile(inFile)
+        self.assertFalse(os.path.exists(inFile))
+        self.assertLess(os.path.getsize(gzFile), size / 10)
+        with uncompressed(gzFile) as plainFile, mrcfile.mmap(plainFile, mode='r') as mrc:
+            np.testing.assert_array_equal(mrc.data, seg)
+        self.assertFalse(os.path.exists(plainFile))
+        # The readers of the plugin accept compressed files
+        outFile = join(self.tmpDir, 'skel.mrc')
+        skeletonizeFile(gzFile, outFile, blockSize=64)
+        with mrcfile.open(outFile) as mrc:
+            np.testing.assert_array_equal(mrc.data, skeletonize(seg))
+
+
+class TestPerf(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'The I/O counters are only available on Linux')
+    def test_runCommand(self):
+        # The resources of the grandchildren are included
+        outFile = join(self.tmpDir, 'out.bin')
+        script = 'x = bytearray(200 * 1024 ** 2); open(%r, "wb").write(bytes(10 ** 7))' % outFile
+        stats = runCommand(f'{sys.executable} -c {shlex.quote(script)}')
+        self.assertGreater(stats.peakRss, 200 * 1024 ** 2)
+        self.assertGreaterEqual(stats.bytesWritten, 10 ** 7)
+        self.assertGreater(stats.cpuTime, 0)
+        self.assertGreaterEqual(stats.wallTime, stats.cpuTime / os.cpu_count())
+        with self.assertRaises(subprocess.CalledProcessError):
+            runCommand('exit 3')
+
+    def test_measureAndTrace(self):
+        inFile = join(self.tmpDir, 'in.bin')
+        with open(inFile, 'wb') as f:
+            f.write(bytes(10 ** 6))
+        with measure() as measurement:
+            time.sleep(0.1)
+            with open(inFile, 'rb') as f:
+                f.read()
+        self.assertGreaterEqual(measurement.stats.wallTime, 0.1)
+        if sys.platform.startswith('linux'):
+            self.assertGreaterEqual(measurement.stats.bytesRead, 10 ** 6)
+
+        total = measurement.stats.combine(PerfStats(1.0, 2.0, 100, 5, 6))
+        self.assertAlmostEqual(total.wallTime, measurement.stats.wallTime + 1.0)
+        self.assertEqual(total.peakRss, 100)
+
+        traceFile = join(self.tmpDir, 'trace.jsonl')
+        trace = PerfTrace(traceFile)
+        trace.add('tomo1', 'segment', total, device='gpu:0')
+        trace.add('tomo2', 'segment', PerfStats())
+        with open(traceFile) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([r['tsId'] for r in records], ['tomo1', 'tomo2'])
+        self.assertEqual(records[0]['device'], 'gpu:0')
+        self.assertEqual(records[0]['peakRss'], 100)
+
+
+class TestEnvironment(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        # Fake environment with a membrain executable, activated setting some variables
+        self.binDir = join(self.tmpDir, 'env', 'bin')
+        os.makedirs(self.binDir)
+        self.membrainExe = join(self.binDir, 'membrain')
+        with open(self.membrainExe, 'w') as f:
+            f.write('#!/bin/sh\necho "$MEMBRAIN_TEST_VAR"\n')
+        os.chmod(self.membrainExe, 0o755)
+        self.activationCmd = f'export MEMBRAIN_TEST_VAR=activated && export PATH={self.binDir}:$PATH'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def test_resolve(self):
+        environment = resolveEnvironment(self.activationCmd)
+        self.assertEqual(environment.membrain, self.membrainExe)
+        self.assertEqual(environment.setVars, {'MEMBRAIN_TEST_VAR': 'activated'})
+        self.assertEqual(environment.prependVars, {'PATH': self.binDir + os.pathsep})
+        environ = environment.getEnviron({'PATH': '/usr/bin'})
+        self.assertEqual(environ['PATH'], f'{self.binDir}{os.pathsep}/usr/bin')
+        output = subprocess.run(environment.membrain, env=environment.getEnviron(), capture_output=True, text=True)
+        self.assertEqual(output.stdout.strip(), 'activated')
+
+        with self.assertRaises(RuntimeError):
+            resolveEnvironment('false')
+        with self.assertRaises(RuntimeError):
+            resolveEnvironment('export PATH=/nonexistent')
+
+    def test_cache(self):
+        cacheFile = join(self.tmpDir, 'cache', 'environments.json')
+        environment = EnvironmentCache(cacheFile).get(self.activationCmd)
+        self.assertTrue(os.path.exists(cacheFile))
+        # Another process gets it from the file, as long as the environment is not modified
+        self.assertEqual(EnvironmentCache(cacheFile)._load(self.activationCmd), environment)
+        self.assertTrue(environment.isValid())
+        os.utime(self.membrainExe, ns=(0, 0))
+        self.assertFalse(environment.isValid())
+        newEnvironment = EnvironmentCache(cacheFile).get(self.activationCmd)
+        self.assertTrue(newEnvironment.isValid())
+        self.assertNotEqual(newEnvironment.stamps, environment.stamps)
+
+
+class TestImportTime(unittest.TestCase):
+    """ Scipion imports the plugin at startup and in each step subprocess, so importing it must be cheap. """
+    # Seconds that importing the plugin may take on top of pwem, which its Plugin class derives from
+    IMPORT_TIME_BUDGET = 0.2
+    # Modules that must only be imported when a protocol is used
+    HEAVY_MODULES = ['tomo', 'tomo.objects', 'pwem.emlib', 'pwem.protocols', 'scipion.install.funcs', 'mrcfile',
+                     'scipy', 'membrain.protocols.protocol_base']
+
+    @staticmethod
+    def _importInSubprocess(moduleName: str) -> Tuple[float, list]:
+        script = ('import json, sys, time\n'
+                  'import pwem\n'
+                  't0 = time.perf_counter()\n'
+                  'import %s\n'
+                  'print(json.dumps([time.perf_counter() - t0, sorted(sys.modules)]))' % moduleName)
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+        importTime, modules = json.loads(output.splitlines()[-1])
+        return importTime, modules
+
+    def test_plugin(self):
+        importTime, modules = self._importInSubprocess('membrain')
+        self.assertEqual([m for m in self.HEAVY_MODULES if m in modules], [])
+        self.assertLess(importTime, self.IMPORT_TIME_BUDGET)
+
+    def test_protocols(self):
+        # The protocols are only imported when accessed
+        _, modules = self._importInSubprocess('membrain.protocols')
+        self.assertEqual([m for m in self.HEAVY_MODULES if m in modules], [])
+        script = ('import inspect, membrain.protocols as p\n'
+                  'print(sorted(name for name, _ in inspect.getmembers(p, inspect.isclass)))')
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.split('\n')[-2], str(sorted(['ProtMemBrainSeg', 'ProtMemBrainSkeletonize',
+                                                              'ProtMemBrainThreshold',
+                                                              'ProtMemBrainConnectedComponents'])))
+
+    def test_readers(self):
+        # The image readers are registered when a protocol is created, not when the protocols are imported
+        script = ('import membrain.readers as r\n'
+                  'from membrain.protocols import ProtMemBrainThreshold\n'
+                  'print(r._registered)\n'
+                  'ProtMemBrainThreshold()\n'
+                  'print(r._registered)')
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.split('\n')[-3:-1], ['False', 'True'])
@@ -0,0 +1,82 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Agreement between two MemBrain-seg results of the same tomogram, e.g. those of two inference backends, to check that a
+faster backend gives the same segmentation. The files are compared by chunks of slices through memory maps.
+"""
+from contextlib import ExitStack
+from os.path import dirname, abspath
+from typing import Dict
+
+import mrcfile
+import numpy as np
+
+from membrain.utils.encoding import uncompressed, getScoresScale
+
+DEFAULT_CHUNK_SLICES = 32
+
+
+def measureAgreement(refSegFile: str, segFile: str, refScoresFile: str = None, scoresFile: str = None,
+                     chunkSlices: int = DEFAULT_CHUNK_SLICES) -> Dict[str, float]:
+    """ Compare a segmentation (voxels > 0) and optionally its score map with reference ones.
+    :return: dict with the Dice coefficient of the membranes (1 if both are empty), the fraction of voxels with the
+    same class and, if the score maps are given, the maximum and mean absolute difference of the scores.
+    """
+    workDir = dirname(abspath(segFile))
+    pairs = [(refSegFile, segFile)]
+    if refScoresFile and scoresFile:
+        pairs.append((refScoresFile, scoresFile))
+    with ExitStack() as stack:
+        mrcs = [[stack.enter_context(mrcfile.mmap(stack.enter_context(uncompressed(fileName, workDir)), mode='r',
+                                                  permissive=True))
+                 for fileName in pair] for pair in pairs]
+        for refMrc, mrc in mrcs:
+            if refMrc.data.shape != mrc.data.shape:
+                raise ValueError('Cannot compare volumes of shapes %s and %s' % (refMrc.data.shape, mrc.data.shape))
+        shape = mrcs[0][0].data.shape
+        scales = [getScoresScale(m) for m in mrcs[-1]]
+        nRef = nOther = nBoth = nEqual = 0
+        maxDiff = sumDiff = 0.0
+        for start in range(0, shape[0], chunkSlices):
+            refSeg, seg = (np.asarray(m.data[start:start + chunkSlices]) > 0 for m in mrcs[0])
+            nRef += int(refSeg.sum())
+            nOther += int(seg.sum())
+            nBoth += int((refSeg & seg).sum())
+            nEqual += int((refSeg == seg).sum())
+            if len(mrcs) > 1:
+                refScores, scores = (np.asarray(m.data[start:start + chunkSlices], dtype=np.float32) * scale
+                                     for m, scale in zip(mrcs[1], scales))
+                diff = np.abs(refScores - scores)
+                maxDiff = max(maxDiff, float(diff.max()))
+                sumDiff += float(diff.sum(dtype=np.float64))
+
+    nVoxels = int(np.prod(shape))
+    agreement = {'dice': 2 * nBoth / (nRef + nOther) if nRef + nOther else 1.0,
+                 'voxelAgreement': nEqual / nVoxels}
+    if len(mrcs) > 1:
+        agreement['maxScoreDiff'] = maxDiff
+        agreement['meanScoreDiff'] = sumDiff / nVoxels
+    return agreement
@@ -0,0 +1,80 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from typing import Tuple, List, Callable, Any
+
+from membrain.utils.threads import getAvailableCores, getJobThreads, limitThreads
+
+DEFAULT_BLOCK_SIZE = 128
+
+Block = Tuple[slice, slice, slice]
+
+
+def createExecutor(nProcs: int, nThreads: int = None) -> ProcessPoolExecutor:
+    """ Pool of processes to work on blocks of volumes. They are spawned, as forking a multithreaded process (like a
+    protocol running its steps in parallel) is not safe.
+    :param nThreads: threads of the thread pools (OpenMP, MKL, PyTorch...) of each process. If None, the available
+    cores are split between the processes, so they do not oversubscribe them (see getPoolThreads).
+    """
+    nProcs = max(nProcs, 1)
+    return ProcessPoolExecutor(max_workers=nProcs, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=limitThreads, initargs=(nThreads or getPoolThreads(nProcs),))
+
+
+def getPoolThreads(nProcs: int) -> int:
+    """ Threads of each process of a pool of nProcs processes sharing the available cores. """
+    return getJobThreads(sum(len(node) for node in getAvailableCores()), nProcs)
+
+
+def getBlocks(shape: Tuple[int, ...], blockSize: int) -> List[Block]:
+    """ Split a volume of the given shape into blocks of at most blockSize voxels per side, in C order. """
+    ranges = [[slice(start, min(start + blockSize, size)) for start in range(0, size, blockSize)] for size in shape]
+    return list(product(*ranges))
+
+
+def mapBlocks(func: Callable, blocks: List[Block], *args, nProcs: int = 1,
+              executor: ProcessPoolExecutor = None, blockArgs: List[Any] = None) -> List[Any]:
+    """ Call func(*args, block) for each block in a pool of processes.
+    :param func: function to call. It must be defined at module level, so the processes can import it.
+    :param nProcs: number of processes used if no executor is given.
+    :param executor: pool of processes to use, so it can be shared by several calls.
+    :param blockArgs: if given, an extra argument for each block, passed after it: func(*args, block, blockArg).
+    :return: the results, in the same order as the blocks.
+    """
+    ownExecutor = executor is None
+    if ownExecutor:
+        executor = createExecutor(min(nProcs, len(blocks)))
+    try:
+        if blockArgs is None:
+            futures = [executor.submit(func, *args, block) for block in blocks]
+        else:
+            futures = [executor.submit(func, *args, block, blockArg) for block, blockArg in zip(blocks, blockArgs)]
+        return [future.result() for future in futures]
+    finally:
+        if ownExecutor:
+            executor.shutdown()
@@ -0,0 +1,175 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from os.path import join, exists, lexists, getsize, realpath
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+HASH_BLOCK_SIZE = 16 * 1024 * 1024
+ENTRIES_DIR = 'entries'
+HASHES_DIR = 'hashes'
+TMP_DIR = 'tmp'
+
+
+def getFileIdentity(fileName: str) -> str:
+    """ Cheap identity of the data behind a file: the resolved path plus its size and modification time. Links
+    pointing to the same file share the same identity. """
+    fileName = realpath(fileName)
+    st = os.stat(fileName)
+    return '%s|%d|%d' % (fileName, st.st_size, st.st_mtime_ns)
+
+
+def hashFile(fileName: str) -> str:
+    """ SHA-256 of the content of a file. """
+    sha = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class SegmentationCache:
+    """ Content-addressed store of MemBrain-seg results that can be shared by different protocols and projects.
+    The entries are indexed by the hash of the tomogram content, the hash of the model file and the parameters used,
+    so any re-run with the same data, model and parameters retrieves the results instead of recomputing them. When
+    the total size exceeds the maximum, the least recently used entries are removed.
+
+    The hash of each file is remembered by its identity (path, size and modification time), so big files are only
+    read once. """
+
+    def __init__(self, cacheDir: str, maxSize: int):
+        """
+        :param cacheDir: directory of the cache. It is created if it does not exist.
+        :param maxSize: maximum size of the cache in bytes.
+        """
+        self._cacheDir = cacheDir
+        self._maxSize = maxSize
+        self._lock = threading.Lock()
+        for subDir in [ENTRIES_DIR, HASHES_DIR, TMP_DIR]:
+            os.makedirs(join(cacheDir, subDir), exist_ok=True)
+
+    def getFileHash(self, fileName: str) -> str:
+        identity = getFileIdentity(fileName)
+        hashFileName = join(self._cacheDir, HASHES_DIR, hashlib.sha1(identity.encode()).hexdigest())
+        if exists(hashFileName):
+            with open(hashFileName) as f:
+                return f.read().strip()
+        fileHash = hashFile(fileName)
+        self._writeAtomic(hashFileName, fileHash)
+        return fileHash
+
+    def getKey(self, tomoFile: str, modelFile: str, params: dict) -> str:
+        """ Key of the entry corresponding to the given tomogram, model and parameters. The parameters are
+        serialized in a canonical way, so the order does not matter. """
+        key = {'tomogram': self.getFileHash(tomoFile),
+               'model': self.getFileHash(modelFile),
+               'params': params}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str, outFiles: Dict[str, str]) -> bool:
+        """ Retrieve the files of an entry.
+        :param key: entry key.
+        :param outFiles: dict of {file id: destination file name} with the files that must be retrieved.
+        :return: True if the entry exists and contains all the requested files, which are then placed in their
+        destinations. False otherwise.
+        """
+        entryDir = self._getEntryDir(key)
+        cachedFiles = {fileId: join(entryDir, fileId) for fileId in outFiles}
+        if not all(exists(f) for f in cachedFiles.values()):
+            return False
+        for fileId, outFile in outFiles.items():
+            self._linkOrCopy(cachedFiles[fileId], outFile)
+        try:
+            os.utime(entryDir)  # Most recently used
+        except OSError:
+            pass
+        return True
+
+    def put(self, key: str, files: Dict[str, str]):
+        """ Store the given files, dict of {file id: file name}, as a new entry. """
+        entryDir = self._getEntryDir(key)
+        if exists(entryDir):
+            return
+        tmpDir = join(self._cacheDir, TMP_DIR, uuid.uuid4().hex)
+        os.makedirs(tmpDir)
+        try:
+            for fileId, fileName in files.items():
+                self._linkOrCopy(fileName, join(tmpDir, fileId))
+            os.makedirs(os.path.dirname(entryDir), exist_ok=True)
+            # Atomic, so concurrent protocols never see incomplete entries
+            os.rename(tmpDir, entryDir)
+        except OSError as e:
+            logger.warning('Unable to store %s in the cache: %s' % (key, e))
+            shutil.rmtree(tmpDir, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache size is below the maximum. """
+        with self._lock:
+            entries = []
+            entriesDir = join(self._cacheDir, ENTRIES_DIR)
+            for prefix in os.listdir(entriesDir):
+                for key in os.listdir(join(entriesDir, prefix)):
+                    entryDir = join(entriesDir, prefix, key)
+                    try:
+                        size = sum(getsize(join(entryDir, f)) for f in os.listdir(entryDir))
+                        entries.append((os.stat(entryDir).st_mtime, size, entryDir))
+                    except OSError:  # Removed by another process
+                        continue
+            totalSize = sum(entry[1] for entry in entries)
+            for _, size, entryDir in sorted(entries):
+                if totalSize <= self._maxSize:
+                    break
+                logger.info('Removing %s from the cache' % entryDir)
+                shutil.rmtree(entryDir, ignore_errors=True)
+                totalSize -= size
+
+    def _getEntryDir(self, key: str) -> str:
+        return join(self._cacheDir, ENTRIES_DIR, key[:2], key)
+
+    @staticmethod
+    def _linkOrCopy(src: str, dst: str):
+        """ Hard links are used when possible, so the cache does not duplicate the data in the same filesystem. """
+        if lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(realpath(src), dst)
+        except OSError:
+            shutil.copyfile(src, dst)
+
+    def _writeAtomic(self, fileName: str, content: str):
+        tmpFile = join(self._cacheDir, TMP_DIR, uuid.uuid4().hex)
+        with open(tmpFile, 'w') as f:
+            f.write(content)
+        os.replace(tmpFile, fileName)
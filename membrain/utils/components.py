@@ -0,0 +1,244 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Out-of-core labelling of the connected components of a segmentation, with the same result as the option
+--store-connected-components of 'membrain segment': components connected in 26-neighbourhood, labelled 1..N in the
+order they are found scanning the volume, optionally removing the ones smaller than a number of voxels.
+
+The volume is labelled by blocks in parallel. The labels of the voxels on the faces of the blocks are used to merge the
+components that cross the boundaries, with a connected components search on the graph of block labels. The blocks are
+labelled again in a second pass to write the final labels, so only the faces are kept in memory.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from os.path import dirname, abspath
+from typing import Dict, Tuple, List
+
+import mrcfile
+import numpy as np
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from membrain.utils.blocks import Block, DEFAULT_BLOCK_SIZE, getBlocks, mapBlocks
+from membrain.utils.encoding import uncompressed
+
+STRUCTURE = np.ones((3, 3, 3), dtype=bool)
+
+# Smallest signed or unsigned integer MRC modes able to store the labels, float32 otherwise as 'membrain segment' does
+LABEL_MODES = [(np.iinfo(np.int8).max, 0), (np.iinfo(np.int16).max, 1), (np.iinfo(np.uint16).max, 6)]
+LABEL_MODE_FLOAT = 2
+
+
+def labelComponents(segmentation: np.ndarray, sizeThreshold: int = None) -> np.ndarray:
+    """ Label the connected components of a whole segmentation (voxels > 0), as 'membrain segment'. """
+    labels, _ = ndimage.label(segmentation > 0, structure=STRUCTURE)
+    if sizeThreshold is not None and sizeThreshold > 1:
+        sizes = np.bincount(labels.ravel())
+        keep = sizes >= sizeThreshold
+        keep[0] = False
+        newLabels = np.zeros(len(sizes), dtype=labels.dtype)
+        newLabels[keep] = np.arange(1, keep.sum() + 1)
+        labels = newLabels[labels]
+    return labels
+
+
+def labelComponentsFile(inFile: str, outFiles: Dict[int, str], samplingRate: float = None,
+                        blockSize: int = DEFAULT_BLOCK_SIZE, nProcs: int = 1,
+                        executor: ProcessPoolExecutor = None) -> Dict[int, int]:
+    """ Label the connected components of a segmentation file, removing the small ones.
+    :param inFile: MRC file with the segmentation, possibly compressed.
+    :param outFiles: dict of {size threshold: MRC file where the corresponding labels will be written}. Components
+    smaller than the size threshold (in voxels) are removed. A threshold lower than 2 keeps all of them.
+    :param samplingRate: voxel size of the outputs. If None, the one of the input is used.
+    :param blockSize: size of the blocks the volume is divided into.
+    :param nProcs: number of processes used if no executor is given.
+    :param executor: pool of processes to use, so it can be shared by several files.
+    :return: dict of {size threshold: number of components}.
+    """
+    with uncompressed(inFile, dirname(abspath(next(iter(outFiles.values()))))) as plainFile:
+        with mrcfile.mmap(plainFile, mode='r', permissive=True) as mrcIn:
+            shape = mrcIn.data.shape
+            voxelSize = mrcIn.voxel_size if samplingRate is None else samplingRate
+
+        blocks = getBlocks(shape, blockSize)
+        offsets, sizes, firstVoxels, components = _findComponents(plainFile, shape, blocks, nProcs, executor)
+
+        nComponents = {}
+        lutFiles = {}
+        for sizeThreshold, outFile in outFiles.items():
+            globalLabels, nComponents[sizeThreshold] = _getFinalLabels(components, sizes, firstVoxels, sizeThreshold)
+            lutFiles[outFile] = globalLabels
+            mode = next((m for maxValue, m in LABEL_MODES if nComponents[sizeThreshold] <= maxValue), LABEL_MODE_FLOAT)
+            with mrcfile.new_mmap(outFile, shape=shape, mrc_mode=mode, overwrite=True) as mrcOut:
+                mrcOut.voxel_size = voxelSize
+
+        # Second pass to write the final labels
+        luts = [{outFile: globalLabels[offsets[i]:offsets[i + 1] + 1].copy()
+                 for outFile, globalLabels in lutFiles.items()}
+                for i in range(len(blocks))]
+        for lut in luts:
+            for values in lut.values():
+                values[0] = 0  # Local label 0 is the background, not the last label of the previous block
+        mapBlocks(_writeBlock, blocks, plainFile, nProcs=nProcs, executor=executor, blockArgs=luts)
+
+        for outFile in outFiles.values():
+            with mrcfile.open(outFile, mode='r+', permissive=True) as mrcOut:
+                mrcOut.update_header_stats()
+    return nComponents
+
+
+def countComponentsFile(inFile: str, sizeThreshold: int = 0, blockSize: int = DEFAULT_BLOCK_SIZE, nProcs: int = 1,
+                        executor: ProcessPoolExecutor = None, tmpDir: str = None) -> int:
+    """ Number of connected components of a segmentation file with at least sizeThreshold voxels, as
+    labelComponentsFile would label, without writing them.
+    :param tmpDir: directory where the file is decompressed if needed. The one of the file if None.
+    """
+    with uncompressed(inFile, tmpDir or dirname(abspath(inFile))) as plainFile:
+        with mrcfile.mmap(plainFile, mode='r', permissive=True) as mrcIn:
+            shape = mrcIn.data.shape
+        _, sizes, firstVoxels, components = _findComponents(plainFile, shape, getBlocks(shape, blockSize), nProcs,
+                                                            executor)
+    return _getFinalLabels(components, sizes, firstVoxels, sizeThreshold)[1]
+
+
+def _findComponents(inFile: str, shape: Tuple[int, ...], blocks: List[Block], nProcs: int,
+                    executor: ProcessPoolExecutor) -> Tuple[np.ndarray, ...]:
+    """ First pass of the labelling: label the blocks and merge their labels into components.
+    :return: the offset of the labels of each block, and the size, first voxel and component of each global block
+    label.
+    """
+    blockInfos = mapBlocks(_labelBlock, blocks, inFile, nProcs=nProcs, executor=executor)
+
+    # Block labels are made global adding the number of labels of the previous blocks
+    nLabels = np.array([info['nLabels'] for info in blockInfos])
+    offsets = np.concatenate([[0], np.cumsum(nLabels)])
+    sizes = np.concatenate([[0]] + [info['sizes'] for info in blockInfos])
+    firstVoxels = np.concatenate([[-1]] + [info['firstVoxels'] for info in blockInfos])
+    components = _mergeBlocks(blocks, blockInfos, offsets, shape)
+    return offsets, sizes, firstVoxels, components
+
+
+def _labelBlock(inFile: str, block: Block) -> dict:
+    """ Label a block and return the size and the first voxel (global index in C order) of each label and the
+    labels of the voxels on its faces. """
+    with mrcfile.mmap(inFile, mode='r', permissive=True) as mrcIn:
+        shape = mrcIn.data.shape
+        labels, nLabels = ndimage.label(mrcIn.data[block] > 0, structure=STRUCTURE)
+
+    flatLabels = labels.ravel()
+    uniqueLabels, firstLocal = np.unique(flatLabels, return_index=True)
+    firstVoxels = np.zeros(nLabels, dtype=np.int64)
+    localCoords = np.unravel_index(firstLocal[uniqueLabels > 0], labels.shape)
+    globalCoords = tuple(c + s.start for c, s in zip(localCoords, block))
+    firstVoxels[uniqueLabels[uniqueLabels > 0] - 1] = np.ravel_multi_index(globalCoords, shape)
+
+    faces = {}
+    for axis, s in enumerate(block):
+        for side, pos, atBorder in [(0, 0, s.start == 0), (1, -1, s.stop == shape[axis])]:
+            if atBorder:
+                continue
+            face = np.take(labels, pos, axis=axis)
+            nonZero = np.nonzero(face)
+            # Coordinates in the whole plane of the volume perpendicular to the axis
+            otherStarts = [b.start for i, b in enumerate(block) if i != axis]
+            faces[(axis, side)] = (nonZero[0] + otherStarts[0], nonZero[1] + otherStarts[1], face[nonZero])
+
+    return {'nLabels': nLabels,
+            'sizes': np.bincount(flatLabels, minlength=nLabels + 1)[1:],
+            'firstVoxels': firstVoxels,
+            'faces': faces}
+
+
+def _mergeBlocks(blocks: List[Block], blockInfos: List[dict], offsets: np.ndarray,
+                 shape: Tuple[int, ...]) -> np.ndarray:
+    """ Component of each global block label (and 0 for the background), merging the labels connected across the
+    faces of the blocks. """
+    # Faces of the blocks on both sides of each cut of the volume, indexed by (axis, position of the cut)
+    cuts = {}
+    for i, (block, info) in enumerate(zip(blocks, blockInfos)):
+        for (axis, side), (u, v, labels) in info['faces'].items():
+            cutPos = block[axis].stop if side == 1 else block[axis].start
+            cuts.setdefault((axis, cutPos), ([], []))[1 - side].append((u, v, labels + offsets[i]))
+
+    edges = []
+    for (axis, _), (lowFaces, highFaces) in cuts.items():
+        # Voxels before and after the cut are connected if they are at most one voxel apart in the plane
+        if not lowFaces or not highFaces:
+            continue
+        lowU, lowV, lowLabels = (np.concatenate(arrays) for arrays in zip(*lowFaces))
+        highU, highV, highLabels = (np.concatenate(arrays) for arrays in zip(*highFaces))
+        if not len(lowLabels) or not len(highLabels):
+            continue
+        # Wide enough for the neighbours of the voxels on the borders of the plane not to collide with other voxels
+        width = shape[[i for i in range(3) if i != axis][1]] + 2
+        lowKeys = lowU * width + lowV
+        order = np.argsort(lowKeys)
+        lowKeys, lowLabels = lowKeys[order], lowLabels[order]
+        for du in (-1, 0, 1):
+            for dv in (-1, 0, 1):
+                keys = (highU + du) * width + (highV + dv)
+                pos = np.clip(np.searchsorted(lowKeys, keys), 0, len(lowKeys) - 1)
+                match = lowKeys[pos] == keys
+                edges.append((lowLabels[pos[match]], highLabels[match]))
+
+    nNodes = offsets[-1] + 1
+    if edges:
+        src = np.concatenate([e[0] for e in edges])
+        dst = np.concatenate([e[1] for e in edges])
+    else:
+        src = dst = np.zeros(0, dtype=np.int64)
+    graph = coo_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(nNodes, nNodes))
+    _, components = connected_components(graph, directed=False)
+    return components
+
+
+def _getFinalLabels(components: np.ndarray, sizes: np.ndarray, firstVoxels: np.ndarray,
+                    sizeThreshold: int) -> Tuple[np.ndarray, int]:
+    """ Final label of each global block label. The components are numbered by their first voxel, like a labelling
+    of the whole volume would do, after removing the ones smaller than the threshold. """
+    nComponents = components.max() + 1
+    componentSizes = np.bincount(components, weights=sizes, minlength=nComponents)
+    componentFirst = np.full(nComponents, np.iinfo(np.int64).max)
+    np.minimum.at(componentFirst, components[1:], firstVoxels[1:])
+    keep = np.ones(nComponents, dtype=bool)
+    keep[components[0]] = False  # Background
+    if sizeThreshold > 1:
+        keep &= componentSizes >= sizeThreshold
+    kept = np.nonzero(keep)[0]
+    finalLabels = np.zeros(nComponents, dtype=np.int64)
+    finalLabels[kept[np.argsort(componentFirst[kept])]] = np.arange(1, len(kept) + 1)
+    return finalLabels[components], len(kept)
+
+
+def _writeBlock(inFile: str, block: Block, luts: Dict[str, np.ndarray]):
+    """ Label a block again and write its final labels in each output file. """
+    with mrcfile.mmap(inFile, mode='r', permissive=True) as mrcIn:
+        labels, nLabels = ndimage.label(mrcIn.data[block] > 0, structure=STRUCTURE)
+    if not nLabels:
+        return
+    for outFile, lut in luts.items():
+        with mrcfile.mmap(outFile, mode='r+', permissive=True) as mrcOut:
+            mrcOut.data[block] = lut[labels]
@@ -0,0 +1,141 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Compact encodings of the output volumes. They are all MRC files, so they can be read with mrcfile:
+    - Score maps can be stored as float16 (MRC mode 12) or quantized to int8 (MRC mode 0), with the scale needed to
+      recover the scores written in a label of the header.
+    - Any volume can be compressed with gzip. The segmentations are mostly background, so they shrink much more than
+      with any bit packing. mrcfile reads them transparently, but the rest of the programs may not, so the readers of
+      this plugin decompress them to a temporary file first (see uncompressed).
+"""
+import gzip
+import os
+import re
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+import mrcfile
+import numpy as np
+
+# Score encodings
+SCORES_FLOAT32 = 0
+SCORES_FLOAT16 = 1
+SCORES_INT8 = 2
+SCORES_ENCODINGS = ['float32 (as MemBrain-seg)', 'float16', 'int8 (quantized)']
+
+COMPRESSED_EXT = '.gz'
+COMPRESS_LEVEL = 3
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+# Number of slices encoded at once
+DEFAULT_CHUNK_SLICES = 32
+
+SCORES_SCALE_LABEL = 'MemBrain-seg scores quantized to int8, scale: %r'
+SCORES_SCALE_PATTERN = re.compile(r'MemBrain-seg scores quantized to int8, scale: ([-+.\deE]+)')
+
+
+def isCompressed(fileName: str) -> bool:
+    return fileName.endswith(COMPRESSED_EXT)
+
+
+def removeCompressedExt(fileName: str) -> str:
+    return fileName[:-len(COMPRESSED_EXT)] if isCompressed(fileName) else fileName
+
+
+def compressFile(fileName: str) -> str:
+    """ Compress a file with gzip, by chunks, replacing it with the compressed one.
+    :return: the name of the compressed file.
+    """
+    outFile = fileName + COMPRESSED_EXT
+    tmpFile = outFile + '.part'
+    with open(fileName, 'rb') as fIn, gzip.open(tmpFile, 'wb', compresslevel=COMPRESS_LEVEL) as fOut:
+        shutil.copyfileobj(fIn, fOut, COPY_BUFFER_SIZE)
+    os.replace(tmpFile, outFile)
+    os.remove(fileName)
+    return outFile
+
+
+@contextmanager
+def uncompressed(fileName: str, tmpDir: str = None):
+    """ Context manager giving the name of an uncompressed version of the file, so it can be memory-mapped. If the
+    file is compressed, it is decompressed by chunks to a temporary file, removed on exit. """
+    if not isCompressed(fileName):
+        yield fileName
+        return
+    fd, tmpFile = tempfile.mkstemp(suffix='.mrc', dir=tmpDir)
+    try:
+        with gzip.open(fileName, 'rb') as fIn, os.fdopen(fd, 'wb') as fOut:
+            shutil.copyfileobj(fIn, fOut, COPY_BUFFER_SIZE)
+        yield tmpFile
+    finally:
+        os.remove(tmpFile)
+
+
+def getScoresScale(mrc) -> float:
+    """ Factor to convert the values of an open score map into scores: 1 unless they are quantized. """
+    for label in mrc.header.label[:mrc.header.nlabl]:
+        match = SCORES_SCALE_PATTERN.search(label.decode('ascii', errors='ignore'))
+        if match:
+            return float(match.group(1))
+    return 1.0
+
+
+def encodeScores(inFile: str, outFile: str, encoding: int, chunkSlices: int = DEFAULT_CHUNK_SLICES):
+    """ Write a float32 score map with the given encoding, by chunks of slices. The output file can be the input
+    one. """
+    if encoding == SCORES_FLOAT32:
+        if outFile != inFile:
+            shutil.copyfile(inFile, outFile)
+        return
+
+    tmpFile = outFile + '.part'
+    with mrcfile.mmap(inFile, mode='r', permissive=True) as mrcIn:
+        scores = mrcIn.data
+        nSlices = scores.shape[0]
+        if encoding == SCORES_INT8:
+            maxAbs = max((float(np.abs(scores[start:start + chunkSlices]).max())
+                          for start in range(0, nSlices, chunkSlices)), default=0.0)
+            scale = maxAbs / np.iinfo(np.int8).max or 1.0
+            dtype, mode = np.int8, 0
+        else:
+            scale = None
+            dtype, mode = np.float16, 12
+
+        with mrcfile.new_mmap(tmpFile, shape=scores.shape, mrc_mode=mode, overwrite=True) as mrcOut:
+            for start in range(0, nSlices, chunkSlices):
+                chunk = np.asarray(scores[start:start + chunkSlices], dtype=np.float32)
+                if scale is not None:
+                    chunk = np.rint(chunk / scale)
+                mrcOut.data[start:start + chunkSlices] = chunk.astype(dtype)
+            mrcOut.voxel_size = mrcIn.voxel_size
+            nlabl = int(mrcIn.header.nlabl)
+            mrcOut.header.label[:nlabl] = mrcIn.header.label[:nlabl]
+            mrcOut.header.nlabl = nlabl
+            if scale is not None:
+                mrcOut.add_label(SCORES_SCALE_LABEL % scale)
+            mrcOut.update_header_stats()
+    os.replace(tmpFile, outFile)
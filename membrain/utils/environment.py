@@ -0,0 +1,187 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Resolution of the MemBrain-seg environment. Activating a conda environment takes seconds and reads many files of the
+(often shared) filesystem, so instead of activating it for each job, the environment is activated once, the variables
+it sets and the paths of its Python interpreter and membrain executable are recorded, and the jobs launch the
+executables directly with those variables.
+
+The result is kept in a cache file, so it is resolved again only if the activation command changes or the
+environment is modified (checked comparing the modification times of its executables).
+"""
+import json
+import logging
+import os
+import shlex
+import subprocess
+import threading
+from os.path import dirname, join, exists
+from typing import NamedTuple, Dict, List
+
+logger = logging.getLogger(__name__)
+
+ENV_MARKER = 'MEMBRAIN_SEG_ENVIRONMENT:'
+# Printed from inside the activated environment
+RESOLVE_SCRIPT = ('import json, os, shutil, sys; '
+                  'print(%r + json.dumps({"environ": dict(os.environ), "python": sys.executable, '
+                  '"membrain": shutil.which("membrain")}))' % ENV_MARKER)
+# Variables set by the shell itself, not by the activation
+SHELL_VARS = {'_', 'SHLVL', 'PWD', 'OLDPWD'}
+RESOLVE_TIMEOUT = 600
+
+
+class ResolvedEnvironment(NamedTuple):
+    """ Changes made by the activation of an environment to the variables of the process that activated it, and the
+    executables found in it. """
+    activationCmd: str
+    python: str
+    membrain: str
+    setVars: Dict[str, str]
+    prependVars: Dict[str, str]  # Prefixes added to path-like variables, e.g. PATH
+    unsetVars: List[str]
+    stamps: Dict[str, int]  # Modification times of the files that change if the environment is modified
+
+    def getEnviron(self, baseEnviron: Dict[str, str] = None) -> Dict[str, str]:
+        """ Variables of the process to launch the executables of the environment, from the ones of the current
+        process or the given ones. """
+        environ = dict(os.environ if baseEnviron is None else baseEnviron)
+        for name in self.unsetVars:
+            environ.pop(name, None)
+        environ.update(self.setVars)
+        for name, prefix in self.prependVars.items():
+            environ[name] = prefix + environ[name] if environ.get(name) else prefix.rstrip(os.pathsep)
+        return environ
+
+    def isValid(self) -> bool:
+        return getStamps(self.stamps) == self.stamps
+
+
+def getStamps(paths) -> Dict[str, int]:
+    """ Modification times (in ns) of the given paths, -1 for the missing ones. """
+    stamps = {}
+    for path in paths:
+        try:
+            stamps[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            stamps[path] = -1
+    return stamps
+
+
+def resolveEnvironment(activationCmd: str, timeout: int = RESOLVE_TIMEOUT) -> ResolvedEnvironment:
+    """ Activate an environment in a shell and record its changes to the variables of the current process.
+    :raise RuntimeError: if the activation fails or the membrain executable is not found in the environment.
+    """
+    baseEnviron = dict(os.environ)
+    cmd = f'{activationCmd} && python -c {shlex.quote(RESOLVE_SCRIPT)}'
+    try:
+        result = subprocess.run(cmd, shell=True, executable='/bin/bash', capture_output=True, text=True,
+                                timeout=timeout, env=baseEnviron)
+    except (OSError, subprocess.SubprocessError) as e:
+        raise RuntimeError(f'Could not activate the environment with "{activationCmd}": {e}')
+    resolved = next((json.loads(line[len(ENV_MARKER):]) for line in result.stdout.splitlines()
+                     if line.startswith(ENV_MARKER)), None)
+    if result.returncode or resolved is None:
+        raise RuntimeError(f'Could not activate the environment with "{activationCmd}":\n{result.stderr}')
+    if not resolved['membrain']:
+        raise RuntimeError(f'The membrain executable was not found in the environment activated with '
+                           f'"{activationCmd}".')
+
+    setVars, prependVars = {}, {}
+    environ = resolved['environ']
+    for name, value in environ.items():
+        oldValue = baseEnviron.get(name)
+        if name in SHELL_VARS or value == oldValue:
+            continue
+        if oldValue and value.endswith(os.pathsep + oldValue):
+            prependVars[name] = value[:-len(oldValue)]
+        else:
+            setVars[name] = value
+    unsetVars = [name for name in baseEnviron if name not in environ and name not in SHELL_VARS]
+
+    # Installing or removing packages modifies the conda-meta directory of a conda environment
+    prefix = dirname(dirname(resolved['python']))
+    stampPaths = [resolved['python'], resolved['membrain']] + \
+                 ([join(prefix, 'conda-meta')] if exists(join(prefix, 'conda-meta')) else [])
+    return ResolvedEnvironment(activationCmd, resolved['python'], resolved['membrain'], setVars, prependVars,
+                               unsetVars, getStamps(stampPaths))
+
+
+class EnvironmentCache:
+    """ Environments resolved, kept in memory and in a JSON file shared by the processes. An environment is resolved
+    again if its activation command is not in the file or the environment has been modified since it was resolved. """
+
+    def __init__(self, cacheFile: str):
+        self._cacheFile = cacheFile
+        self._resolved = {}
+        self._errors = {}  # Not retried
+        self._lock = threading.Lock()
+
+    def get(self, activationCmd: str) -> ResolvedEnvironment:
+        """ Get the environment activated with the given command, resolving it if needed.
+        :raise RuntimeError: if it cannot be resolved.
+        """
+        with self._lock:
+            if activationCmd in self._errors:
+                raise self._errors[activationCmd]
+            environment = self._resolved.get(activationCmd)
+            if environment is None:
+                environment = self._load(activationCmd)
+                if environment is None or not environment.isValid():
+                    logger.info(f'Resolving the environment activated with "{activationCmd}"')
+                    try:
+                        environment = resolveEnvironment(activationCmd)
+                    except RuntimeError as e:
+                        self._errors[activationCmd] = e
+                        raise
+                    self._save(environment)
+                self._resolved[activationCmd] = environment
+            return environment
+
+    def _load(self, activationCmd: str):
+        try:
+            with open(self._cacheFile) as f:
+                entry = json.load(f).get(activationCmd)
+            return ResolvedEnvironment(**entry) if entry else None
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _save(self, environment: ResolvedEnvironment):
+        """ Add an environment to the cache file, replaced atomically so concurrent readers never see it partially
+        written. """
+        try:
+            with open(self._cacheFile) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        entries[environment.activationCmd] = environment._asdict()
+        try:
+            os.makedirs(dirname(self._cacheFile) or '.', exist_ok=True)
+            tmpFile = f'{self._cacheFile}.{os.getpid()}.tmp'
+            with open(tmpFile, 'w') as f:
+                json.dump(entries, f, indent=2)
+            os.replace(tmpFile, self._cacheFile)
+        except OSError as e:
+            logger.warning(f'Could not write the environment cache {self._cacheFile}: {e}')
@@ -0,0 +1,120 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Estimation of the memory used by 'membrain segment' (MemBrain-seg 0.0.10) for a tomogram, and of the memory available
+to run it, so the number of tomograms processed at once and the sliding window size can be planned.
+
+The whole tomogram is loaded in memory as float32, and several copies of it are alive at the peak: the normalized
+input, the mirrored copy of the test-time augmentation, the accumulated predictions and the output and weights of the
+sliding window inference, plus the thresholded output. The mirrored copy is moved whole to the GPU, where the network
+runs on one window at a time. The test-time augmentation repeats the same inference 8 times, so it does not change the
+peak. The constants are rough upper bounds measured on typical runs.
+"""
+import logging
+import os
+import shutil
+import subprocess
+from typing import NamedTuple, Iterable, Dict, Union
+
+logger = logging.getLogger(__name__)
+
+GiB = 1024 ** 3
+
+HOST_BYTES_PER_VOXEL = 32
+HOST_BASE_MEMORY = 3 * GiB  # Python, PyTorch and the model
+DEVICE_BYTES_PER_VOXEL = 4
+DEVICE_BASE_MEMORY = 1.5 * GiB  # CUDA context and model
+# Activations of the network for each voxel of the sliding window, with mixed precision
+WINDOW_BYTES_PER_VOXEL = 1536
+WINDOW_SIZE_STEP = 32  # MemBrain-seg requires multiples of 32
+MIN_WINDOW_SIZE = 64
+
+# Fraction of the memory of the machine used by default, leaving room for the rest of processes
+HOST_MEMORY_FRACTION = 0.9
+
+CGROUP_LIMIT_FILES = ['/sys/fs/cgroup/memory.max',  # cgroup v2
+                      '/sys/fs/cgroup/memory/memory.limit_in_bytes']  # cgroup v1
+
+
+class MemoryEstimate(NamedTuple):
+    """ Peak memory, in bytes, of the segmentation of a tomogram. """
+    host: int
+    device: int
+
+
+def estimateMemory(nVoxels: int, windowSize: int, onGpu: bool = True) -> MemoryEstimate:
+    """ Peak memory used to segment a tomogram with the given number of voxels and sliding window size. On CPU, the
+    device memory is taken from the host. """
+    windowMemory = WINDOW_BYTES_PER_VOXEL * windowSize ** 3
+    host = HOST_BASE_MEMORY + HOST_BYTES_PER_VOXEL * nVoxels
+    device = DEVICE_BASE_MEMORY + DEVICE_BYTES_PER_VOXEL * nVoxels + windowMemory
+    if onGpu:
+        return MemoryEstimate(int(host), int(device))
+    return MemoryEstimate(int(host + DEVICE_BYTES_PER_VOXEL * nVoxels + windowMemory), 0)
+
+
+def chooseWindowSize(nVoxels: int, maxWindowSize: int, deviceMemory: int) -> Union[int, None]:
+    """ Largest valid sliding window size, not larger than maxWindowSize, with which a tomogram fits in the given
+    device memory. None if not even the smallest one fits. """
+    windowSize = maxWindowSize - maxWindowSize % WINDOW_SIZE_STEP
+    while windowSize >= MIN_WINDOW_SIZE:
+        if estimateMemory(nVoxels, windowSize).device <= deviceMemory:
+            return windowSize
+        windowSize -= WINDOW_SIZE_STEP
+    return None
+
+
+def getHostMemory() -> int:
+    """ Memory of the machine, or the limit of the control group of the process if lower (as set by queue systems
+    like Slurm, whose OOM killer enforces it). """
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for limitFile in CGROUP_LIMIT_FILES:
+        try:
+            with open(limitFile) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isdigit():
+            memory = min(memory, int(limit))
+    return memory
+
+
+def getGpuMemory(gpuIds: Iterable[int]) -> Dict[int, int]:
+    """ Total memory of the given GPUs, as reported by nvidia-smi. The GPUs not found are not included. """
+    nvidiaSmi = shutil.which('nvidia-smi')
+    if not nvidiaSmi:
+        return {}
+    try:
+        output = subprocess.run([nvidiaSmi, '--query-gpu=index,memory.total', '--format=csv,noheader,nounits'],
+                                capture_output=True, text=True, timeout=30, check=True).stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning('Could not get the memory of the GPUs: %s' % e)
+        return {}
+    memory = {}
+    for line in output.splitlines():
+        index, total = (field.strip() for field in line.split(','))
+        memory[int(index)] = int(float(total)) * 1024 ** 2  # MiB
+    return {gpuId: memory[gpuId] for gpuId in gpuIds if gpuId in memory}
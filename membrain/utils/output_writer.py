@@ -0,0 +1,111 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Any, List
+
+logger = logging.getLogger(__name__)
+
+
+class BatchWriter:
+    """ Commit the items produced by several threads from a single thread, in batches. A batch is committed when it
+    reaches a maximum number of items or when its oldest item has waited for a maximum time, whatever happens first.
+    This replaces one database transaction per item by one per batch and avoids the producers contending for the
+    database. """
+
+    def __init__(self, commitFunc: Callable[[List[Any]], None], maxItems: int = 50, maxDelay: float = 30):
+        """
+        :param commitFunc: function called with the list of items of each batch, always from the writer thread.
+        :param maxItems: maximum number of items per batch.
+        :param maxDelay: maximum time (in seconds) an item waits before its batch is committed.
+        """
+        self._commitFunc = commitFunc
+        self._maxItems = maxItems
+        self._maxDelay = maxDelay
+        self._queue = queue.Queue()
+        self._error = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='BatchWriter', daemon=True)
+        self._thread.start()
+
+    def put(self, item: Any):
+        """ Queue an item to be committed. """
+        self._checkError()
+        if self._stopped:
+            raise RuntimeError('The writer has been stopped.')
+        self._queue.put(item)
+
+    def flush(self):
+        """ Block until all the queued items have been committed. """
+        self._queue.join()
+        self._checkError()
+
+    def stop(self):
+        """ Commit the pending items and finish the writer thread. """
+        if not self._stopped:
+            self._stopped = True
+            self._queue.put(None)
+            self._thread.join()
+        self._checkError()
+
+    def _checkError(self):
+        if self._error is not None:
+            raise RuntimeError('Error committing the outputs: %s' % self._error) from self._error
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            batch = [item]
+            deadline = time.time() + self._maxDelay
+            while len(batch) < self._maxItems:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.task_done()
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit(batch)
+
+    def _commit(self, batch: List[Any]):
+        try:
+            if self._error is None:
+                self._commitFunc(batch)
+                logger.info('%d items committed.' % len(batch))
+        except Exception as e:
+            logger.error('Error committing %d items: %s' % (len(batch), e), exc_info=True)
+            self._error = e
+        finally:
+            for _ in batch:
+                self._queue.task_done()
@@ -0,0 +1,132 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Performance measurements of the protocol steps: wall time, CPU time, peak resident memory and bytes read and
+written, either of a child process (the membrain executable) or of the work done by the current thread. They are
+written to a trace file, one JSON record per line, so the time spent in each phase of each tomogram can be analyzed.
+"""
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import NamedTuple, Tuple, Union
+
+PERF_TRACE_FILE = 'perf_trace.jsonl'
+
+
+class PerfStats(NamedTuple):
+    """ Resources used by a piece of work. Times in seconds and sizes in bytes. The peak memory is 0 if unknown. """
+    wallTime: float = 0.0
+    cpuTime: float = 0.0
+    peakRss: int = 0
+    bytesRead: int = 0
+    bytesWritten: int = 0
+
+    def combine(self, other: 'PerfStats') -> 'PerfStats':
+        """ Resources used by this piece of work and another one done after it. """
+        return PerfStats(self.wallTime + other.wallTime,
+                         self.cpuTime + other.cpuTime,
+                         max(self.peakRss, other.peakRss),
+                         self.bytesRead + other.bytesRead,
+                         self.bytesWritten + other.bytesWritten)
+
+
+def getIoCounters(pid: Union[int, str] = 'self', tid: int = None) -> Tuple[int, int]:
+    """ Bytes read and written by a process, or by one of its threads, with read and write calls, whether they
+    reach the storage or not. (0, 0) if they cannot be known (only Linux provides them). """
+    ioFile = f'/proc/{pid}/io' if tid is None else f'/proc/{pid}/task/{tid}/io'
+    counters = {}
+    try:
+        with open(ioFile) as f:
+            for line in f:
+                name, value = line.split(':')
+                counters[name] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+
+def runCommand(cmd: str, env: dict = None) -> PerfStats:
+    """ Run a shell command, measuring the resources used by it and by all its descendants.
+    :raise subprocess.CalledProcessError: if the command fails.
+    """
+    t0 = time.time()
+    process = subprocess.Popen(cmd, shell=True, env=env)
+    pid = process.pid
+    try:
+        # Wait for it without reaping it, so its I/O counters, that include the ones of its children, are readable
+        os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+        bytesRead, bytesWritten = getIoCounters(pid)
+    except (AttributeError, ChildProcessError):  # os.waitid is not available in all the platforms
+        bytesRead = bytesWritten = 0
+    _, status, usage = os.wait4(pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wallTime = time.time() - t0
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    # ru_maxrss is in kilobytes on Linux
+    return PerfStats(wallTime, usage.ru_utime + usage.ru_stime, usage.ru_maxrss * 1024, bytesRead, bytesWritten)
+
+
+class Measurement:
+    """ Resources used by the work done in a measure block, available once the block finishes. """
+
+    def __init__(self):
+        self.stats = PerfStats()
+
+
+@contextmanager
+def measure():
+    """ Context manager measuring the wall time, the CPU time and the I/O of the current thread. The work done by
+    other processes, e.g. pools of processes, is not included. """
+    measurement = Measurement()
+    tid = threading.get_native_id()
+    t0, cpu0 = time.time(), time.thread_time()
+    read0, written0 = getIoCounters(tid=tid)
+    try:
+        yield measurement
+    finally:
+        read1, written1 = getIoCounters(tid=tid)
+        measurement.stats = PerfStats(time.time() - t0, time.thread_time() - cpu0, 0,
+                                      read1 - read0, written1 - written0)
+
+
+class PerfTrace:
+    """ Trace file where the resources used by each phase of the processing of each tomogram are recorded, one JSON
+    record per line. It can be written from several threads. """
+
+    def __init__(self, fileName: str):
+        self._fileName = fileName
+        self._lock = threading.Lock()
+
+    def add(self, tsId: str, phase: str, stats: PerfStats, **extra):
+        """ Record the resources used by a phase. The extra fields (e.g. the device) are added to the record. """
+        record = {'time': time.time(), 'tsId': tsId, 'phase': phase, **stats._asdict(), **extra}
+        with self._lock:
+            with open(self._fileName, 'a') as f:
+                f.write(json.dumps(record) + '\n')
@@ -0,0 +1,160 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Previews of the MemBrain-seg outputs, so viewers and reports can show them without loading the full volumes, e.g. over
+a network mount: a multiscale pyramid of the volume binned by 2, 4 and 8, and PNG thumbnails of its central XY, XZ
+and YZ slices. They are generated by a scanner (see membrain.utils.stats), in the same pass as the statistics.
+
+The levels of the segmentations hold the percentage of membrane voxels of each block (int8), and the ones of the score
+maps the mean score (float16). The thumbnails show the membrane voxels in white, keeping the thin membranes visible
+when they are reduced, and the membrane probability of the score maps in grey levels.
+"""
+import struct
+import zlib
+from typing import Tuple, List, Dict
+
+import mrcfile
+import numpy as np
+
+from membrain.utils.rescale import binArray, getBinnedShape
+from membrain.utils.stats import VolumeScanner
+
+PREVIEW_FACTORS = (2, 4, 8)
+THUMBNAIL_SIZE = 256  # Maximum width and height of the thumbnails, in pixels
+THUMBNAIL_AXES = ['xy', 'xz', 'yz']
+
+# Kinds of volumes
+PREVIEW_MASK = 'mask'
+PREVIEW_SCORES = 'scores'
+
+
+class PreviewScanner(VolumeScanner):
+    """ Write the previews of a volume read by scanFile. Each level is binned from the previous one, and the slices are
+    buffered so the ones binned together arrive at once, whatever the size of the chunks.
+    :param outPrefix: prefix of the files written: <outPrefix>_bin<factor>.mrc and <outPrefix>_<axes>.png.
+    :param kind: PREVIEW_MASK for the segmentations (voxels > 0) and skeletons, PREVIEW_SCORES for the score maps.
+    """
+
+    def __init__(self, outPrefix: str, kind: str = PREVIEW_MASK, factors: Tuple[int, ...] = PREVIEW_FACTORS,
+                 thumbnailSize: int = THUMBNAIL_SIZE):
+        if any(f2 % f1 for f1, f2 in zip((1,) + tuple(factors), factors)):
+            raise ValueError('Each binning factor must be a multiple of the previous one: %s' % (factors,))
+        self.outPrefix = outPrefix
+        self.kind = kind
+        self.factors = factors
+        self.thumbnailSize = thumbnailSize
+
+    def begin(self, shape: Tuple[int, int, int], voxelSize: float, scale: float):
+        self.shape = shape
+        self.scale = scale
+        self.pending = []
+        self.pendingStart = 0
+        mode = 0 if self.kind == PREVIEW_MASK else 12
+        self.mrcs = []
+        for factor in self.factors:
+            mrc = mrcfile.new_mmap(self.getLevelFile(factor), shape=getBinnedShape(shape, factor), mrc_mode=mode,
+                                   overwrite=True)
+            mrc.voxel_size = voxelSize * factor
+            self.mrcs.append(mrc)
+        nz, ny, nx = shape
+        self.slices = {'xy': None,
+                       'xz': np.zeros((nz, nx), dtype=np.float32),
+                       'yz': np.zeros((nz, ny), dtype=np.float32)}
+
+    def add(self, start: int, chunk: np.ndarray):
+        values = (chunk > 0).astype(np.float32) if self.kind == PREVIEW_MASK else chunk.astype(np.float32) * self.scale
+        nz, ny, nx = self.shape
+        if start <= nz // 2 < start + len(values):
+            self.slices['xy'] = values[nz // 2 - start].copy()
+        self.slices['xz'][start:start + len(values)] = values[:, ny // 2, :]
+        self.slices['yz'][start:start + len(values)] = values[:, :, nx // 2]
+
+        self.pending.append(values)
+        nPending = sum(len(v) for v in self.pending)
+        nReady = nPending - nPending % self.factors[-1]
+        if nReady:
+            pending = np.concatenate(self.pending) if len(self.pending) > 1 else self.pending[0]
+            self._writeLevels(pending[:nReady])
+            self.pending = [pending[nReady:]] if nReady < nPending else []
+
+    def end(self) -> Dict[str, List[str]]:
+        """ :return: {'levels': files of the pyramid, 'thumbnails': files of the thumbnails}. """
+        if self.pending:
+            self._writeLevels(np.concatenate(self.pending))
+        for mrc in self.mrcs:
+            mrc.update_header_stats()
+            mrc.close()
+        thumbnails = []
+        for axes in THUMBNAIL_AXES:
+            thumbnails.append(self.getThumbnailFile(axes))
+            writePng(thumbnails[-1], self._getThumbnail(self.slices[axes]))
+        return {'levels': [self.getLevelFile(factor) for factor in self.factors], 'thumbnails': thumbnails}
+
+    def getLevelFile(self, factor: int) -> str:
+        return f'{self.outPrefix}_bin{factor}.mrc'
+
+    def getThumbnailFile(self, axes: str) -> str:
+        return f'{self.outPrefix}_{axes}.png'
+
+    def _writeLevels(self, values: np.ndarray):
+        """ Bin a block of slices, starting at a multiple of the largest factor, by each factor. """
+        level, previousFactor = values, 1
+        for factor, mrc in zip(self.factors, self.mrcs):
+            level = binArray(level, factor // previousFactor)
+            previousFactor = factor
+            start = self.pendingStart // factor
+            if self.kind == PREVIEW_MASK:
+                mrc.data[start:start + len(level)] = np.rint(level * 100)
+            else:
+                mrc.data[start:start + len(level)] = level
+        self.pendingStart += len(values)
+
+    def _getThumbnail(self, image: np.ndarray) -> np.ndarray:
+        """ Image of a slice reduced to the size of the thumbnails, as uint8 grey levels, with the Y axis (or Z)
+        pointing up as in the viewers. """
+        factor = -(-max(image.shape) // self.thumbnailSize)
+        if self.kind == PREVIEW_MASK:
+            for axis in range(2):
+                image = np.maximum.reduceat(image, np.arange(0, image.shape[axis], factor), axis=axis)
+            grey = image * 255
+        else:
+            grey = 255 / (1 + np.exp(-np.clip(binArray(image, factor), -50, 50)))
+        return np.flipud(np.rint(grey).astype(np.uint8))
+
+
+def writePng(fileName: str, image: np.ndarray):
+    """ Write a 2D uint8 array as a greyscale PNG, the first row at the top. """
+    height, width = image.shape
+    rows = np.hstack([np.zeros((height, 1), dtype=np.uint8), image])  # Filter type 0 before each row
+
+    def pngChunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    with open(fileName, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n'
+                + pngChunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0))
+                + pngChunk(b'IDAT', zlib.compress(np.ascontiguousarray(rows).tobytes()))
+                + pngChunk(b'IEND', b''))
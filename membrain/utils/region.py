@@ -0,0 +1,128 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Detection of the region of a tomogram worth segmenting, so the sliding window inference does not go through the empty
+space around the specimen. The region is a box (see membrain.utils.blocks.Block) and it can come from:
+    - The specimen slab: the slices whose variance, once binned in xy to attenuate the noise, is well above the one of
+      the empty slices. On cryo-FIB lamellae, more than half of the slices are usually empty.
+    - A mask: the bounding box of its non-zero voxels. The mask can have a different size (e.g. binning) than the
+      tomogram.
+A margin is added around the region, so the network sees some context on its borders.
+"""
+from typing import Tuple, Union
+
+import mrcfile
+import numpy as np
+
+from membrain.utils.blocks import Block
+from membrain.utils.encoding import uncompressed
+
+# Number of slices read at once
+DEFAULT_CHUNK_SLICES = 32
+# Binning in xy of the slices before computing their variance
+SLAB_PROFILE_BINNING = 4
+# A slice belongs to the slab if its variance is above this fraction of the way from the empty slices to the specimen
+SLAB_THRESHOLD = 0.25
+# The slab is only detected if the variance of the specimen is at least this fraction higher than the empty slices
+SLAB_MIN_CONTRAST = 0.5
+# Margin added to each side of the slab, as a fraction of its thickness, and to any region, in voxels
+SLAB_MARGIN = 0.1
+MIN_REGION_MARGIN = 16
+
+
+def getSliceProfile(data: np.ndarray, chunkSlices: int = DEFAULT_CHUNK_SLICES,
+                    binning: int = SLAB_PROFILE_BINNING) -> np.ndarray:
+    """ Variance of each slice of a volume (z, y, x) binned in xy, which follows the amount of structure in it. """
+    _, ny, nx = data.shape
+    by, bx = max(ny // binning, 1), max(nx // binning, 1)
+    fy, fx = ny // by, nx // bx
+    profile = []
+    for start in range(0, data.shape[0], chunkSlices):
+        chunk = np.asarray(data[start:start + chunkSlices, :by * fy, :bx * fx], dtype=np.float32)
+        binned = chunk.reshape(len(chunk), by, fy, bx, fx).mean(axis=(2, 4))
+        profile.append(binned.var(axis=(1, 2)))
+    return np.concatenate(profile)
+
+
+def detectSlab(profile: np.ndarray) -> Union[slice, None]:
+    """ Range of slices of the specimen slab, with a margin, given the profile of the slices (see getSliceProfile).
+    None if there is no clear slab. """
+    low, high = np.percentile(profile, [5, 95])
+    if high <= low * (1 + SLAB_MIN_CONTRAST):
+        return None
+    inSlab = np.nonzero(profile > low + SLAB_THRESHOLD * (high - low))[0]
+    start, stop = int(inSlab[0]), int(inSlab[-1]) + 1
+    margin = max(int(SLAB_MARGIN * (stop - start)), MIN_REGION_MARGIN)
+    return slice(max(start - margin, 0), min(stop + margin, len(profile)))
+
+
+def detectSlabFile(tomoFile: str, chunkSlices: int = DEFAULT_CHUNK_SLICES) -> Union[Block, None]:
+    """ Region of the specimen slab of a tomogram. None if there is no clear slab or it covers all the slices. """
+    with mrcfile.mmap(tomoFile, mode='r', permissive=True) as mrc:
+        shape = mrc.data.shape
+        slab = detectSlab(getSliceProfile(mrc.data, chunkSlices))
+    if slab is None or (slab.start == 0 and slab.stop == shape[0]):
+        return None
+    return slab, slice(0, shape[1]), slice(0, shape[2])
+
+
+def getMaskRegion(maskFile: str, shape: Tuple[int, int, int], tmpDir: str = None,
+                  chunkSlices: int = DEFAULT_CHUNK_SLICES) -> Union[Block, None]:
+    """ Region of a tomogram of the given shape covered by the non-zero voxels of a mask, with a margin. The mask is
+    scaled to the tomogram if their shapes differ. None if the mask is empty. """
+    with uncompressed(maskFile, tmpDir) as plainFile, mrcfile.mmap(plainFile, mode='r', permissive=True) as mrc:
+        mask = mrc.data
+        maskShape = mask.shape
+        anyZ = np.zeros(maskShape[0], dtype=bool)
+        anyY = np.zeros(maskShape[1], dtype=bool)
+        anyX = np.zeros(maskShape[2], dtype=bool)
+        for start in range(0, maskShape[0], chunkSlices):
+            chunk = np.asarray(mask[start:start + chunkSlices]) != 0
+            anyZ[start:start + len(chunk)] = chunk.any(axis=(1, 2))
+            anyY |= chunk.any(axis=(0, 2))
+            anyX |= chunk.any(axis=(0, 1))
+    if not anyZ.any():
+        return None
+    region = []
+    for present, maskSize, size in zip((anyZ, anyY, anyX), maskShape, shape):
+        indices = np.nonzero(present)[0]
+        scale = size / maskSize
+        start = int(np.floor(indices[0] * scale)) - MIN_REGION_MARGIN
+        stop = int(np.ceil((indices[-1] + 1) * scale)) + MIN_REGION_MARGIN
+        region.append(slice(max(start, 0), min(stop, size)))
+    return tuple(region)
+
+
+def intersectRegions(region1: Union[Block, None], region2: Union[Block, None]) -> Union[Block, None]:
+    """ Intersection of two regions, where None means the whole volume. """
+    if region1 is None or region2 is None:
+        return region1 or region2
+    return tuple(slice(max(s1.start, s2.start), max(min(s1.stop, s2.stop), max(s1.start, s2.start)))
+                 for s1, s2 in zip(region1, region2))
+
+
+def getRegionShape(region: Block) -> Tuple[int, ...]:
+    return tuple(s.stop - s.start for s in region)
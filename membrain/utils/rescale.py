@@ -0,0 +1,148 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Binning of the tomograms to the pixel size MemBrain-seg was trained at, and upsampling of its outputs back to the grid
+of the original tomograms, so tomograms with small pixel sizes are segmented at a fraction of the cost. A region of the
+tomogram can be extracted at the same time (see membrain.utils.region), the rest of the outputs being background.
+
+The tomograms are binned by averaging blocks of voxels, and the outputs are upsampled repeating each voxel (nearest
+neighbour), which keeps the labels and the segmentation values unchanged. Both are done by chunks of slices, through
+memory maps, so the volumes are never loaded whole in memory.
+"""
+import os
+from typing import Tuple
+
+import mrcfile
+import numpy as np
+from mrcfile.utils import mode_from_dtype
+
+from membrain.utils.blocks import Block
+
+# Pixel size of the data MemBrain-seg is trained on, in Å/px
+MEMBRAIN_SEG_SAMPLING_RATE = 10.0
+
+# Number of slices of the original tomogram processed at once
+DEFAULT_CHUNK_SLICES = 32
+
+
+def getBinFactor(samplingRate: float, targetSamplingRate: float) -> int:
+    """ Integer binning factor that brings the given sampling rate closest to the target one, never less than 1. """
+    if not samplingRate or samplingRate <= 0:
+        return 1
+    return max(int(round(targetSamplingRate / samplingRate)), 1)
+
+
+def getBinnedShape(shape: Tuple[int, ...], factor: int) -> Tuple[int, ...]:
+    """ Shape of a volume binned by the given factor. The blocks on the borders may be smaller. """
+    return tuple(-(-n // factor) for n in shape)
+
+
+def binArray(data: np.ndarray, factor: int) -> np.ndarray:
+    """ Average each block of factor^3 voxels of a volume, as float32. """
+    binned = np.asarray(data, dtype=np.float32)
+    for axis in range(binned.ndim):
+        size = binned.shape[axis]
+        starts = np.arange(0, size, factor)
+        counts = np.diff(np.append(starts, size)).astype(np.float32)
+        binned = np.add.reduceat(binned, starts, axis=axis)
+        binned /= counts.reshape([-1 if i == axis else 1 for i in range(binned.ndim)])
+    return binned
+
+
+def upsampleArray(data: np.ndarray, factor: int, shape: Tuple[int, ...]) -> np.ndarray:
+    """ Repeat each voxel of a binned volume factor times along each axis, cropping the result to the given
+    shape. """
+    upsampled = data
+    for axis, size in enumerate(shape):
+        upsampled = np.repeat(upsampled, factor, axis=axis)[(slice(None),) * axis + (slice(0, size),)]
+    return upsampled
+
+
+def binFile(inFile: str, outFile: str, factor: int, samplingRate: float, region: Block = None,
+            chunkSlices: int = DEFAULT_CHUNK_SLICES) -> Tuple[int, ...]:
+    """ Write a region of a tomogram binned by the given factor.
+    :param samplingRate: voxel size of the input, in Å/px. The one of the output is multiplied by the factor.
+    :param region: box of the tomogram to write (see membrain.utils.region). The whole tomogram if None.
+    :return: the shape of the whole input.
+    """
+    # Whole blocks of slices are read at once
+    step = factor * max(chunkSlices // factor, 1)
+    tmpFile = outFile + '.part'
+    with mrcfile.mmap(inFile, mode='r', permissive=True) as mrcIn:
+        data = mrcIn.data
+        shape = data.shape
+        zRegion, yRegion, xRegion = region or tuple(slice(0, n) for n in shape)
+        binnedShape = getBinnedShape((zRegion.stop - zRegion.start, yRegion.stop - yRegion.start,
+                                      xRegion.stop - xRegion.start), factor)
+        with mrcfile.new_mmap(tmpFile, shape=binnedShape, mrc_mode=2, overwrite=True) as mrcOut:
+            for start in range(zRegion.start, zRegion.stop, step):
+                binned = binArray(data[start:min(start + step, zRegion.stop), yRegion, xRegion], factor)
+                outStart = (start - zRegion.start) // factor
+                mrcOut.data[outStart:outStart + len(binned)] = binned
+            mrcOut.voxel_size = samplingRate * factor
+    os.replace(tmpFile, outFile)
+    return shape
+
+
+def upsampleFile(inFile: str, outFile: str, factor: int, shape: Tuple[int, ...], samplingRate: float,
+                 region: Block = None, background: float = 0, chunkSlices: int = DEFAULT_CHUNK_SLICES):
+    """ Write a volume computed on a region of a tomogram binned with binFile on the grid of the whole tomogram,
+    keeping its data type and the labels of its header. The output file can be the input one.
+    :param shape: shape of the whole tomogram.
+    :param samplingRate: voxel size of the tomogram, in Å/px.
+    :param region: box of the tomogram the volume corresponds to. The whole tomogram if None.
+    :param background: value of the voxels outside the region.
+    """
+    step = factor * max(chunkSlices // factor, 1)
+    region = region or tuple(slice(0, n) for n in shape)
+    zRegion, yRegion, xRegion = region
+    regionShape = tuple(s.stop - s.start for s in region)
+    tmpFile = outFile + '.part'
+    with mrcfile.mmap(inFile, mode='r', permissive=True) as mrcIn:
+        data = mrcIn.data
+        with mrcfile.new_mmap(tmpFile, shape=shape, mrc_mode=mode_from_dtype(data.dtype),
+                              overwrite=True) as mrcOut:
+            for start in range(0, shape[0], step):
+                stop = min(start + step, shape[0])
+                out = mrcOut.data[start:stop]
+                if regionShape != tuple(shape):
+                    out[...] = background
+                # Slices of the chunk inside the region, relative to the start of the region
+                regionStart = max(start, zRegion.start) - zRegion.start
+                regionStop = min(stop, zRegion.stop) - zRegion.start
+                if regionStart >= regionStop:
+                    continue
+                binnedStart = regionStart // factor
+                chunk = np.asarray(data[binnedStart:-(-regionStop // factor)])
+                upsampled = upsampleArray(chunk, factor, (regionStop - binnedStart * factor,) + regionShape[1:])
+                out[zRegion.start + regionStart - start:zRegion.start + regionStop - start, yRegion, xRegion] = \
+                    upsampled[regionStart - binnedStart * factor:]
+            mrcOut.voxel_size = samplingRate
+            nlabl = int(mrcIn.header.nlabl)
+            mrcOut.header.label[:nlabl] = mrcIn.header.label[:nlabl]
+            mrcOut.header.nlabl = nlabl
+            mrcOut.update_header_stats()
+    os.replace(tmpFile, outFile)
@@ -0,0 +1,143 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Iterable, Union
+
+logger = logging.getLogger(__name__)
+
+GPU = 'gpu'
+CPU = 'cpu'
+
+
+class Device:
+    """ A processing slot: a GPU (identified by its CUDA id) or a CPU worker. """
+
+    def __init__(self, kind: str, index: int):
+        self.kind = kind
+        self.index = index
+
+    def isGpu(self) -> bool:
+        return self.kind == GPU
+
+    def getCudaVisibleDevices(self) -> str:
+        """ Value of CUDA_VISIBLE_DEVICES for a job running on this device. An empty string hides all the GPUs,
+        so the job runs on CPU. """
+        return str(self.index) if self.isGpu() else ''
+
+    def __str__(self):
+        return '%s:%d' % (self.kind, self.index)
+
+    def __repr__(self):
+        return 'Device(%s)' % self
+
+
+class DeviceScheduler:
+    """ Assign jobs to a pool of devices made of a list of GPUs plus a number of CPU workers used as fallback.
+    Each device runs one job at a time. A job waiting for a device takes a free GPU if there is one and a free CPU
+    worker otherwise. Combined with submitting the jobs sorted with sortBySize (largest first), this is the longest
+    processing time first rule, which keeps all the devices busy and minimizes the makespan. The device used by each
+    job is recorded.
+
+    Optionally, the jobs declare the host memory they need and the scheduler keeps the jobs running at the same time
+    within a memory budget. """
+
+    def __init__(self, gpuIds: Iterable[int], nCpuSlots: int = 0, hostMemory: int = None):
+        """
+        :param gpuIds: CUDA ids of the GPUs.
+        :param nCpuSlots: number of CPU workers.
+        :param hostMemory: host memory budget, in bytes, of the jobs running at the same time. None for no limit.
+        """
+        self._devices = [Device(GPU, int(gpuId)) for gpuId in gpuIds]
+        self._devices += [Device(CPU, i) for i in range(nCpuSlots)]
+        if not self._devices:
+            raise ValueError('At least one GPU or CPU worker is required.')
+        self._free = list(self._devices)
+        self._assignments = {}
+        self._hostMemory = hostMemory
+        self._reserved = {}
+        self._cond = threading.Condition()
+
+    def getDevices(self) -> List[Device]:
+        return list(self._devices)
+
+    def acquire(self, jobId: str, hostMemory: Dict[str, int] = None) -> Device:
+        """ Block until a device is free and assign it to the given job.
+        :param jobId: job identifier.
+        :param hostMemory: host memory the job needs depending on the kind of device it runs on, {GPU: bytes,
+        CPU: bytes}. The job waits until it fits in the memory budget left by the running jobs. It is always accepted
+        when no other job is running, so a job larger than the budget runs alone instead of waiting forever.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._pickDevice(hostMemory) is not None)
+            device = self._pickDevice(hostMemory)
+            self._free.remove(device)
+            self._assignments[jobId] = device
+            self._reserved[jobId] = (hostMemory or {}).get(device.kind, 0)
+        logger.info('%s assigned to %s' % (jobId, device))
+        return device
+
+    def release(self, jobId: str):
+        """ Free the device and the memory used by the given job. The assignment is kept. """
+        with self._cond:
+            device = self._assignments[jobId]
+            if device not in self._free:
+                self._free.append(device)
+            self._reserved.pop(jobId, None)
+            # Freeing memory may let more than one job in
+            self._cond.notify_all()
+
+    def _pickDevice(self, hostMemory: Dict[str, int] = None) -> Union[Device, None]:
+        """ First free device, GPUs before CPU workers, where the job fits in the memory budget. """
+        for device in sorted(self._free, key=lambda d: (not d.isGpu(), self._devices.index(d))):
+            if self._fits((hostMemory or {}).get(device.kind, 0)):
+                return device
+        return None
+
+    def _fits(self, memory: int) -> bool:
+        if self._hostMemory is None or not self._reserved:
+            return True
+        return sum(self._reserved.values()) + memory <= self._hostMemory
+
+    @contextmanager
+    def device(self, jobId: str, hostMemory: Dict[str, int] = None):
+        """ Context manager to run a job in the first available device. """
+        device = self.acquire(jobId, hostMemory)
+        try:
+            yield device
+        finally:
+            self.release(jobId)
+
+    def getAssignment(self, jobId: str) -> Union[Device, None]:
+        """ Device that processed (or is processing) the given job, if any. """
+        with self._cond:
+            return self._assignments.get(jobId, None)
+
+    @staticmethod
+    def sortBySize(jobSizes: Dict[str, int]) -> List[str]:
+        """ Return the job ids sorted by decreasing size. Ties keep the original order. """
+        return sorted(jobSizes, key=lambda jobId: -jobSizes[jobId])
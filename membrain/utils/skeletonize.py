@@ -0,0 +1,265 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Multi-core skeletonization of membrane segmentations. It reproduces the 3D non-maximum suppression method of
+'membrain skeletonize' (MemBrain-seg 0.0.10, itself adapted from TomoSegMemTV): the ridges of the distance transform of
+the segmentation are found with the eigen-analysis of its Hessian. All the operations but the distance transform are
+local, so the volume is processed in blocks with a halo wide enough to give exactly the same result as processing it at
+once. The halo is widened for the blocks where the distance transform needs it. The segmentation is read and the
+skeleton written through memory maps, so the whole volume is never loaded in memory.
+
+The ridges are decided by strict comparisons, so the voxels at exact ties (e.g. the center of a flat membrane with an
+even thickness) depend on the rounding of the operations. When PyTorch is installed, the Hessian filter and the
+eigen-decomposition are computed with it as MemBrain-seg does, and the skeletons are identical to its ones. Otherwise,
+they can differ in those voxels.
+"""
+import logging
+import math
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from os.path import dirname, abspath
+from typing import List, Tuple
+
+import mrcfile
+import numpy as np
+from scipy import ndimage
+
+from membrain.utils.blocks import Block, DEFAULT_BLOCK_SIZE, getBlocks, mapBlocks
+from membrain.utils.encoding import uncompressed
+
+logger = logging.getLogger(__name__)
+
+HESSIAN_FILTER_SIZE = 9
+HESSIAN_FILTER_SIGMA = 1.0
+EIGENVALUE_FILTER_SIGMA = 1.0
+INTERPOLATION_FACTOR = 0.71
+# Distance from a voxel to the farthest voxel its result depends on, apart from the distance transform: two centered
+# differences, the Hessian filter, the eigenvalue filter (truncated at 4 sigmas) and the non-maximum suppression
+SUPPORT = 1 + 1 + HESSIAN_FILTER_SIZE // 2 + int(4 * EIGENVALUE_FILTER_SIGMA + 0.5) + 1
+# Initial halo of the blocks. Enough for membranes up to ~16 voxels thick
+DEFAULT_HALO = SUPPORT + 8
+
+
+def skeletonize(segmentation: np.ndarray) -> np.ndarray:
+    """ Skeleton of a whole segmentation (voxels > 0) as an int8 array of 0s and 1s. """
+    labels = segmentation > 0
+    distance = -ndimage.distance_transform_edt(labels)
+    return _ridges(distance, labels)
+
+
+def skeletonizeFile(inFile: str, outFile: str, samplingRate: float = None, nProcs: int = 1,
+                    blockSize: int = DEFAULT_BLOCK_SIZE, executor: ProcessPoolExecutor = None):
+    """ Skeletonize a segmentation file into a new MRC file, processing it by blocks in parallel.
+    :param inFile: MRC file with the segmentation, possibly compressed.
+    :param outFile: MRC file where the skeleton will be written.
+    :param samplingRate: voxel size of the output. If None, the one of the input is used.
+    :param nProcs: number of processes used if no executor is given.
+    :param blockSize: size of the blocks the volume is divided into, without halo.
+    :param executor: pool of processes to use, so it can be shared by several files.
+    """
+    with uncompressed(inFile, dirname(abspath(outFile))) as plainFile:
+        with mrcfile.mmap(plainFile, mode='r', permissive=True) as mrcIn:
+            shape = mrcIn.data.shape
+            voxelSize = mrcIn.voxel_size if samplingRate is None else samplingRate
+            nlabl, label = mrcIn.header.nlabl, mrcIn.header.label.copy()
+
+        with mrcfile.new_mmap(outFile, shape=shape, mrc_mode=0, overwrite=True) as mrcOut:
+            mrcOut.voxel_size = voxelSize
+            mrcOut.header.nlabl = nlabl
+            mrcOut.header.label = label
+
+        mapBlocks(skeletonizeBlock, getBlocks(shape, blockSize), plainFile, outFile, nProcs=nProcs,
+                  executor=executor)
+
+    with mrcfile.open(outFile, mode='r+', permissive=True) as mrcOut:
+        mrcOut.update_header_stats()
+
+
+def skeletonizeBlock(inFile: str, outFile: str, block: Block, halo: int = DEFAULT_HALO):
+    """ Skeletonize a block of a segmentation file and write it in the output file, which must exist. """
+    with mrcfile.mmap(inFile, mode='r', permissive=True) as mrcIn:
+        data = mrcIn.data
+        while True:
+            extBlock = tuple(slice(max(s.start - halo, 0), min(s.stop + halo, size))
+                             for s, size in zip(block, data.shape))
+            labels = data[extBlock] > 0
+            coreInExt = tuple(slice(s.start - e.start, s.stop - e.start) for s, e in zip(block, extBlock))
+            if not labels[_grow(coreInExt, SUPPORT, labels.shape)].any():
+                skeleton = None  # Nothing close to the core
+                break
+            distance = -ndimage.distance_transform_edt(labels)
+            if _isDistanceExact(distance, extBlock, coreInExt, data.shape):
+                skeleton = _ridges(distance, labels)[coreInExt]
+                break
+            halo *= 2
+            logger.debug('Widening the halo of block %s to %d' % (block, halo))
+
+    if skeleton is not None and skeleton.any():
+        with mrcfile.mmap(outFile, mode='r+', permissive=True) as mrcOut:
+            mrcOut.data[block] = skeleton
+
+
+def _grow(region: Block, margin: int, shape: Tuple[int, ...]) -> Block:
+    return tuple(slice(max(s.start - margin, 0), min(s.stop + margin, size)) for s, size in zip(region, shape))
+
+
+def _isDistanceExact(distance: np.ndarray, extBlock: Block, coreInExt: Block, shape: Tuple[int, ...]) -> bool:
+    """ The distance transform of a block is exact for the voxels that influence the core if, for all of them, the
+    nearest background voxel found is closer than the faces where the block cuts the volume. Otherwise, a closer
+    background voxel might be outside the block. """
+    faceDistance = np.inf
+    for e, c, size in zip(extBlock, coreInExt, shape):
+        if e.start > 0:
+            faceDistance = min(faceDistance, c.start - SUPPORT)
+        if e.stop < size:
+            faceDistance = min(faceDistance, (e.stop - e.start) - c.stop - SUPPORT)
+    if faceDistance == np.inf:
+        return True
+    region = _grow(coreInExt, SUPPORT, distance.shape)
+    return faceDistance > 0 and -distance[region].min() <= faceDistance
+
+
+def _derivative(data: np.ndarray, axis: int) -> np.ndarray:
+    """ Centered difference, repeating the values next to the borders (calculate_derivative_3d of MemBrain-seg). """
+    forward = np.zeros(data.shape, dtype=np.float32)
+    backward = np.zeros(data.shape, dtype=np.float32)
+    n = data.shape[axis]
+    sl = lambda start, stop: tuple(slice(start, stop) if i == axis else slice(None) for i in range(data.ndim))
+    forward[sl(0, n - 1)] = data[sl(1, n)]
+    backward[sl(1, n)] = data[sl(0, n - 1)]
+    forward[sl(n - 1, n)] = forward[sl(n - 2, n - 1)]
+    backward[sl(0, 1)] = backward[sl(1, 2)]
+    return (forward - backward) * 0.5
+
+
+def _hessian(distance: np.ndarray) -> List[np.ndarray]:
+    """ Components XX, YY, ZZ, XY, XZ, YZ of the Hessian, as derivatives of the gradients (compute_gradients and
+    compute_hessian of MemBrain-seg). """
+    gradX, gradY, gradZ = (_derivative(distance, axis) for axis in range(3))
+    return [_derivative(gradX, 0), _derivative(gradY, 1), _derivative(gradZ, 2),
+            _derivative(gradX, 1), _derivative(gradX, 2), _derivative(gradY, 2)]
+
+
+@lru_cache(maxsize=1)
+def _importTorch():
+    """ PyTorch, if it is installed, or None. """
+    try:
+        import torch
+    except ImportError:
+        logger.debug('PyTorch is not available: the skeletons may differ from the ones of MemBrain-seg at some ties.')
+        return None
+    return torch
+
+
+def _hessianFilter(data: np.ndarray) -> np.ndarray:
+    """ Filter a component of the Hessian with the normalized Gaussian kernel of HESSIAN_FILTER_SIZE voxels per side,
+    with zero padding (apply_gaussian_filter of MemBrain-seg). The ridges are decided by strict comparisons, so ties
+    depend on the rounding of this filter: when PyTorch is installed, the kernel and the 3D convolution are computed
+    with it exactly as MemBrain-seg does. Otherwise, the equivalent separable filter is used. """
+    torch = _importTorch()
+    if torch is None:
+        grid = np.arange(HESSIAN_FILTER_SIZE) - (HESSIAN_FILTER_SIZE - 1) / 2
+        kernel = np.exp(-grid ** 2 / (2 * HESSIAN_FILTER_SIGMA ** 2))
+        kernel /= kernel.sum()
+        out = data
+        for axis in range(data.ndim):
+            out = ndimage.correlate1d(out, kernel, axis=axis, output=np.float32, mode='constant', cval=0)
+        return out
+
+    with torch.no_grad():
+        grid = torch.arange(HESSIAN_FILTER_SIZE, dtype=torch.float32) - (HESSIAN_FILTER_SIZE - 1) / 2
+        xyz = torch.stack(torch.meshgrid(grid, grid, grid, indexing='ij'), dim=-1)
+        kernel = torch.exp(-torch.sum(xyz ** 2, dim=-1) / (2 * HESSIAN_FILTER_SIGMA ** 2))
+        kernel /= (2 * math.pi * HESSIAN_FILTER_SIGMA ** 2) ** (3 / 2)
+        kernel = kernel / torch.sum(kernel)
+        tensor = torch.from_numpy(np.ascontiguousarray(data, dtype=np.float32))[None, None]
+        return torch.nn.functional.conv3d(tensor, kernel[None, None],
+                                          padding=HESSIAN_FILTER_SIZE // 2).squeeze().numpy()
+
+
+def _firstEigen(hessian: List[np.ndarray], coords: Tuple[np.ndarray, ...]) -> Tuple[np.ndarray, np.ndarray]:
+    """ Eigenvalue of largest magnitude, and its eigenvector, of the Hessian at the given voxels. As
+    batch_mask_eigendecomposition_3d of MemBrain-seg, it uses the general eigensolver (geev), whose choice of
+    eigenvectors for repeated eigenvalues differs from the one of the symmetric solver. """
+    hessianXX, hessianYY, hessianZZ, hessianXY, hessianXZ, hessianYZ = (component[coords] for component in hessian)
+    matrices = np.stack([hessianXX, hessianXY, hessianXZ,
+                         hessianXY, hessianYY, hessianYZ,
+                         hessianXZ, hessianYZ, hessianZZ], axis=-1).reshape(-1, 3, 3)
+    torch = _importTorch()
+    if torch is not None:
+        eigenvalues, eigenvectors = (t.numpy() for t in torch.linalg.eig(torch.from_numpy(matrices)))
+    else:
+        eigenvalues, eigenvectors = np.linalg.eig(matrices)
+    first = np.argmax(np.abs(eigenvalues), axis=-1)
+    idx = np.arange(len(first))
+    return (eigenvalues[idx, first].real.astype(np.float32),
+            eigenvectors[idx, :, first].real.astype(np.float32))
+
+
+def _nonMaxSuppression(image: np.ndarray, vectors: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """ Voxels of the segmentation, apart from the ones next to the borders, whose value is larger than the ones
+    interpolated at both sides along their vector (nonmaxsup of MemBrain-seg). """
+    inner = np.zeros(labels.shape, dtype=bool)
+    inner[1:-1, 1:-1, 1:-1] = True
+    x, y, z = np.nonzero(labels & inner)
+    dx, dy, dz = (np.abs(vectors[x, y, z, k] * INTERPOLATION_FACTOR) for k in range(3))
+    sx, sy, sz = (np.sign(dk).astype(int) for dk in (dx, dy, dz))
+
+    def interpolate(direction: int) -> np.ndarray:
+        """ Trilinear interpolation at the voxel displaced by (dx, dy, dz) in the given direction. """
+        nx, ny, nz = x + direction * sx, y + direction * sy, z + direction * sz
+        im = image
+        return (im[x, y, z] * (1 - dx) * (1 - dy) * (1 - dz)
+                + im[nx, y, z] * dx * (1 - dy) * (1 - dz)
+                + im[x, ny, z] * (1 - dx) * dy * (1 - dz)
+                + im[x, y, nz] * (1 - dx) * (1 - dy) * dz
+                + im[nx, ny, z] * dx * dy * (1 - dz)
+                + im[nx, y, nz] * dx * (1 - dy) * dz
+                + im[x, ny, nz] * (1 - dx) * dy * dz
+                + im[nx, ny, nz] * dx * dy * dz)
+
+    local = image[x, y, z]
+    result = np.zeros(labels.shape, dtype=np.int8)
+    result[x, y, z] = (local > interpolate(1)) & (local > interpolate(-1))
+    return result
+
+
+def _ridges(distance: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """ Non-maximum suppression of the largest eigenvalue of the Hessian of the distance transform along its
+    eigenvector, for the voxels of the segmentation. """
+    # MemBrain-seg works with the axes in x, y, z order. Following it keeps the same rounding of the operations
+    distance = distance.astype(np.float32).T
+    labels = labels.T
+    hessian = [_hessianFilter(component) for component in _hessian(distance)]
+    coords = np.nonzero(labels)
+    firstEigenvalues, firstEigenvectors = _firstEigen(hessian, coords)
+    del hessian
+    eigenvalueImage = np.zeros(labels.shape, dtype=np.float32)
+    eigenvalueImage[coords] = firstEigenvalues
+    eigenvalueImage = ndimage.gaussian_filter(eigenvalueImage, sigma=EIGENVALUE_FILTER_SIGMA)
+    eigenvectorImage = np.zeros(labels.shape + (3,), dtype=np.float32)
+    eigenvectorImage[coords] = firstEigenvectors
+    return _nonMaxSuppression(eigenvalueImage, eigenvectorImage, labels).T
@@ -0,0 +1,162 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Sparse storage of volumes with few non-zero voxels, like the skeletons of the segmentations: the coordinates of the
+non-zero voxels and a label for each of them, in columns of a compressed numpy file (.npz) that numpy reads directly:
+    - z, y, x: coordinates of the voxels (C order of the volume), as the smallest unsigned integers able to hold them.
+    - labels: label of each voxel, e.g. the connected component of the segmentation it belongs to.
+    - shape: shape of the volume (z, y, x).
+    - voxelSize: voxel size, in Å/px.
+They are usually hundreds of times smaller than the volumes and are read at once. They can be converted back to MRC
+files with sparseToDense, also from the command line:
+
+    python -m membrain.utils.sparse skeleton.npz skeleton.mrc
+"""
+import argparse
+import os
+from typing import NamedTuple, Tuple
+
+import mrcfile
+import numpy as np
+
+from membrain.utils.encoding import uncompressed
+
+SPARSE_EXT = '.npz'
+
+# Number of slices read or written at once
+DEFAULT_CHUNK_SLICES = 32
+
+
+class SparseVolume(NamedTuple):
+    coords: np.ndarray  # (n, 3) array of z, y, x
+    labels: np.ndarray
+    shape: Tuple[int, int, int]
+    voxelSize: float
+
+
+def _getCoordType(shape: Tuple[int, ...]) -> np.dtype:
+    return np.uint16 if max(shape) <= np.iinfo(np.uint16).max else np.uint32
+
+
+def writeSparse(inFile: str, outFile: str, labelsFile: str = None, voxelSize: float = None,
+                chunkSlices: int = DEFAULT_CHUNK_SLICES) -> int:
+    """ Store the non-zero voxels of a volume in a sparse file.
+    :param inFile: MRC file with the volume, possibly compressed.
+    :param outFile: sparse file (.npz).
+    :param labelsFile: MRC file of the same shape, possibly compressed, whose values are taken as the labels of the
+    voxels, e.g. the segmentation a skeleton comes from. If None, the values of the volume are the labels.
+    :param voxelSize: voxel size stored. If None, the one of the input is used.
+    :return: the number of voxels stored.
+    """
+    tmpDir = os.path.dirname(os.path.abspath(outFile))
+    coords, labels = [], []
+    with uncompressed(inFile, tmpDir) as plainFile, mrcfile.mmap(plainFile, mode='r', permissive=True) as mrcIn:
+        data = mrcIn.data
+        shape = data.shape
+        voxelSize = float(mrcIn.voxel_size.x) if voxelSize is None else voxelSize
+        coordType = _getCoordType(shape)
+        for start in range(0, shape[0], chunkSlices):
+            chunk = np.asarray(data[start:start + chunkSlices])
+            z, y, x = np.nonzero(chunk)
+            coords.append(np.stack([z + start, y, x], axis=1).astype(coordType))
+            labels.append(chunk[z, y, x])
+    coords = np.concatenate(coords) if coords else np.zeros((0, 3), dtype=coordType)
+    labels = np.concatenate(labels) if labels else np.zeros(0, dtype=np.int8)
+
+    if labelsFile is not None:
+        labels = np.empty(len(coords), dtype=np.int64)
+        with uncompressed(labelsFile, tmpDir) as plainFile, \
+                mrcfile.mmap(plainFile, mode='r', permissive=True) as mrcLabels:
+            chunkIndices = coords[:, 0] // chunkSlices
+            for chunkIndex in np.unique(chunkIndices):
+                inChunk = chunkIndices == chunkIndex
+                start = int(chunkIndex) * chunkSlices
+                chunk = np.asarray(mrcLabels.data[start:start + chunkSlices])
+                z, y, x = coords[inChunk].astype(np.int64).T
+                labels[inChunk] = chunk[z - start, y, x]
+        labels = labels.astype(np.min_scalar_type(int(labels.max())) if len(labels) and labels.min() >= 0
+                               else np.int64)
+
+    tmpFile = outFile + '.part' + SPARSE_EXT
+    np.savez_compressed(tmpFile, z=coords[:, 0], y=coords[:, 1], x=coords[:, 2], labels=labels,
+                        shape=np.array(shape), voxelSize=np.array(voxelSize))
+    os.replace(tmpFile, outFile)
+    return len(coords)
+
+
+def readSparse(fileName: str) -> SparseVolume:
+    with np.load(fileName) as sparse:
+        return SparseVolume(coords=np.stack([sparse['z'], sparse['y'], sparse['x']], axis=1),
+                            labels=sparse['labels'],
+                            shape=tuple(int(n) for n in sparse['shape']),
+                            voxelSize=float(sparse['voxelSize']))
+
+
+def subsample(coords: np.ndarray, spacing: int) -> np.ndarray:
+    """ Indices of the coordinates keeping one for each cube of spacing voxels per side, the first one found. """
+    if spacing <= 1:
+        return np.arange(len(coords))
+    _, indices = np.unique(coords // spacing, axis=0, return_index=True)
+    return np.sort(indices)
+
+
+def sparseToDense(sparseFile: str, outFile: str, chunkSlices: int = DEFAULT_CHUNK_SLICES):
+    """ Write the volume stored in a sparse file as an MRC file. """
+    sparse = readSparse(sparseFile)
+    labels = sparse.labels
+    maxLabel = int(labels.max()) if len(labels) else 0
+    if np.issubdtype(labels.dtype, np.integer) and (not len(labels) or labels.min() >= 0):
+        dtype = next((dtype for dtype in (np.int8, np.int16, np.uint16) if maxLabel <= np.iinfo(dtype).max),
+                     np.float32)
+    else:
+        dtype = np.float32
+    labels = labels.astype(dtype)
+    tmpFile = outFile + '.part'
+    with mrcfile.new_mmap(tmpFile, shape=sparse.shape, mrc_mode=mrcfile.utils.mode_from_dtype(labels.dtype),
+                          overwrite=True) as mrcOut:
+        z = sparse.coords[:, 0]
+        for start in range(0, sparse.shape[0], chunkSlices):
+            chunk = np.zeros((min(chunkSlices, sparse.shape[0] - start),) + sparse.shape[1:], dtype=labels.dtype)
+            inChunk = (z >= start) & (z < start + chunkSlices)
+            cz, cy, cx = sparse.coords[inChunk].astype(np.int64).T
+            chunk[cz - start, cy, cx] = labels[inChunk]
+            mrcOut.data[start:start + len(chunk)] = chunk
+        mrcOut.voxel_size = sparse.voxelSize
+        mrcOut.update_header_stats()
+    os.replace(tmpFile, outFile)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Convert a sparse volume (.npz) written by the MemBrain protocols '
+                                                 'into an MRC file.')
+    parser.add_argument('sparseFile')
+    parser.add_argument('outFile')
+    parsedArgs = parser.parse_args(args)
+    sparseToDense(parsedArgs.sparseFile, parsedArgs.outFile)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from os.path import join, basename, getsize
+from typing import Dict
+
+from membrain.utils.cache import hashFile, HASH_BLOCK_SIZE
+
+logger = logging.getLogger(__name__)
+
+INPUT_DIR = 'in'
+OUTPUT_DIR = 'out'
+PARTIAL_SUFFIX = '.part'
+
+
+def copyVerified(src: str, dst: str):
+    """ Copy a file and check that the copy has the same size and content as the source. The source is read only
+    once, hashing it while it is copied. The copy is written to a temporary file next to the destination and renamed
+    only once verified, so the destination never holds an incomplete file. """
+    partFile = dst + PARTIAL_SUFFIX
+    sha = hashlib.sha256()
+    try:
+        with open(src, 'rb') as fIn, open(partFile, 'wb') as fOut:
+            for block in iter(lambda: fIn.read(HASH_BLOCK_SIZE), b''):
+                sha.update(block)
+                fOut.write(block)
+        if getsize(partFile) != getsize(src) or hashFile(partFile) != sha.hexdigest():
+            raise IOError('Verification of the copy of %s to %s failed.' % (src, dst))
+        os.replace(partFile, dst)
+    finally:
+        if os.path.lexists(partFile):
+            os.remove(partFile)
+
+
+class ScratchStager:
+    """ Stage the input files of a queue of jobs onto a local scratch directory and copy their results back.
+    The inputs are copied in the order the jobs are added, in background, keeping at most maxStaged of them on the
+    local disk (the ones being processed plus the ones prefetched for the next jobs). The results are copied back in
+    background too, so the device that produced them can start the next job meanwhile. """
+
+    def __init__(self, scratchDir: str, maxStaged: int = 2, nThreads: int = 2):
+        """
+        :param scratchDir: local directory. A private subdirectory is created inside and removed by close().
+        :param maxStaged: maximum number of input files simultaneously staged.
+        :param nThreads: number of files copied at the same time.
+        """
+        os.makedirs(scratchDir, exist_ok=True)
+        self._workDir = tempfile.mkdtemp(prefix='membrain-', dir=scratchDir)
+        self._maxStaged = max(maxStaged, 1)
+        self._executor = ThreadPoolExecutor(max_workers=nThreads, thread_name_prefix='ScratchStager')
+        self._pending = []  # Jobs waiting to be staged, in order
+        self._sources = {}
+        self._staged = {}  # Futures of the inputs staged or being staged
+        self._copyBacks = {}
+        self._lock = threading.Lock()
+
+    def add(self, jobId: str, srcFile: str):
+        """ Queue the input file of a job to be staged. """
+        with self._lock:
+            self._sources[jobId] = srcFile
+            self._pending.append(jobId)
+            self._schedule()
+
+    def getInput(self, jobId: str) -> str:
+        """ Local copy of the input of a job. It waits for the copy to be finished, starting it first if the job has
+        not been prefetched yet. """
+        with self._lock:
+            if jobId not in self._staged:
+                if jobId in self._pending:
+                    self._pending.remove(jobId)
+                self._stage(jobId)
+            future = self._staged[jobId]
+        return future.result()
+
+    def getOutputDir(self, jobId: str) -> str:
+        """ Local directory where the job must write its results. """
+        outDir = join(self._workDir, OUTPUT_DIR, jobId)
+        os.makedirs(outDir, exist_ok=True)
+        return outDir
+
+    def releaseInput(self, jobId: str):
+        """ Remove the local copy of the input of a job, making room for the next ones. """
+        with self._lock:
+            future = self._staged.pop(jobId, None)
+            self._schedule()
+        if future is not None:
+            future.exception()  # Wait for an ongoing copy before removing it
+            shutil.rmtree(join(self._workDir, INPUT_DIR, jobId), ignore_errors=True)
+
+    def copyBack(self, jobId: str, files: Dict[str, str]) -> Future:
+        """ Copy back in background the results of a job, dict of {local file: destination}. The local results are
+        removed once all of them have been copied and verified.
+        :return: future to wait for the copy. Its result raises an error if any file could not be copied.
+        """
+        def _copyBack():
+            for localFile, dstFile in files.items():
+                copyVerified(localFile, dstFile)
+            shutil.rmtree(join(self._workDir, OUTPUT_DIR, jobId), ignore_errors=True)
+            logger.info('Results of %s copied back.' % jobId)
+
+        with self._lock:
+            future = self._executor.submit(_copyBack)
+            self._copyBacks[jobId] = future
+        return future
+
+    def waitCopyBack(self, jobId: str):
+        """ Block until the results of a job have been copied back, if they were. """
+        with self._lock:
+            future = self._copyBacks.get(jobId)
+        if future is not None:
+            future.result()
+
+    def close(self):
+        """ Wait for the pending copies and remove the scratch subdirectory. """
+        with self._lock:
+            self._pending.clear()
+        self._executor.shutdown(wait=True)
+        shutil.rmtree(self._workDir, ignore_errors=True)
+
+    def _schedule(self):
+        """ Start staging the next inputs while there is room for them. Called with the lock acquired. """
+        while self._pending and len(self._staged) < self._maxStaged:
+            self._stage(self._pending.pop(0))
+
+    def _stage(self, jobId: str):
+        srcFile = self._sources[jobId]
+        inDir = join(self._workDir, INPUT_DIR, jobId)
+        # The name of the file is kept, as the names of the results depend on it
+        localFile = join(inDir, basename(srcFile))
+
+        def _copy():
+            os.makedirs(inDir, exist_ok=True)
+            copyVerified(srcFile, localFile)
+            logger.info('%s staged in %s' % (jobId, localFile))
+            return localFile
+
+        self._staged[jobId] = self._executor.submit(_copy)
@@ -0,0 +1,149 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Statistics of the MemBrain-seg outputs, cheap enough to be stored in each output item, so the sets can be sorted and
+filtered for quality control without reading the volumes again.
+
+The volumes are read once, by chunks of slices, by scanFile, which feeds each chunk to several scanners: the ones of
+the statistics of this module, or others like the previews of membrain.utils.preview.
+"""
+import abc
+from os.path import dirname, abspath
+from typing import NamedTuple, Tuple, Union, List, Any
+
+import mrcfile
+import numpy as np
+
+from membrain.utils.encoding import uncompressed, getScoresScale
+
+DEFAULT_CHUNK_SLICES = 32
+
+# The scores are logits: the voxels are counted by membrane probability, in bins of 0.1, comparing the scores with the
+# logits of the edges of the bins instead of computing the probability of each voxel
+PROBABILITY_BINS = 10
+_PROBABILITY_EDGES = np.linspace(0, 1, PROBABILITY_BINS + 1)[1:-1]
+_LOGIT_EDGES = np.log(_PROBABILITY_EDGES / (1 - _PROBABILITY_EDGES))
+
+
+class VolumeScanner(abc.ABC):
+    """ Consumer of the chunks of slices of a volume read by scanFile. """
+
+    def begin(self, shape: Tuple[int, int, int], voxelSize: float, scale: float):
+        """ Called before the first chunk.
+        :param scale: factor to convert the values into scores, if they are quantized (see getScoresScale).
+        """
+        pass
+
+    @abc.abstractmethod
+    def add(self, start: int, chunk: np.ndarray):
+        """ Called for each chunk, in order. start is the index of its first slice. """
+
+    def end(self) -> Any:
+        """ Called after the last chunk. Returns the result of the scanner. """
+        pass
+
+
+def scanFile(fileName: str, scanners: List[VolumeScanner], chunkSlices: int = DEFAULT_CHUNK_SLICES,
+             tmpDir: str = None) -> List[Any]:
+    """ Read an MRC file, possibly compressed, once by chunks of slices, feeding them to the given scanners.
+    :param tmpDir: directory where the file is decompressed if needed. The one of the file if None.
+    :return: the result of each scanner.
+    """
+    with uncompressed(fileName, tmpDir or dirname(abspath(fileName))) as plainFile, \
+            mrcfile.mmap(plainFile, mode='r', permissive=True) as mrc:
+        data = mrc.data
+        for scanner in scanners:
+            scanner.begin(data.shape, float(mrc.voxel_size.x), getScoresScale(mrc))
+        for start in range(0, data.shape[0], chunkSlices):
+            chunk = np.asarray(data[start:start + chunkSlices])
+            for scanner in scanners:
+                scanner.add(start, chunk)
+    return [scanner.end() for scanner in scanners]
+
+
+class SegmentationStats(NamedTuple):
+    """ Statistics of a segmentation (voxels > 0). """
+    membraneFraction: float
+    # (x0, y0, z0, x1, y1, z1) of the membrane voxels, inclusive, or None if there are none
+    boundingBox: Union[Tuple[int, int, int, int, int, int], None]
+    # Number of different labels, i.e. the number of components if they are labelled. The components removed for
+    # their size leave gaps in the labels, so this is not the highest label
+    nLabels: int
+
+
+class SegmentationStatsScanner(VolumeScanner):
+    """ Compute the SegmentationStats of a segmentation. """
+
+    def begin(self, shape: Tuple[int, int, int], voxelSize: float, scale: float):
+        self.nVoxels = int(np.prod(shape))
+        self.nMembrane = 0
+        self.labels = set()
+        self.axisAny = [np.zeros(n, dtype=bool) for n in shape]
+
+    def add(self, start: int, chunk: np.ndarray):
+        membrane = chunk > 0
+        self.nMembrane += int(np.count_nonzero(membrane))
+        zAny, yAny, xAny = self.axisAny
+        zAny[start:start + len(chunk)] = membrane.any(axis=(1, 2))
+        yAny |= membrane.any(axis=(0, 2))
+        xAny |= membrane.any(axis=(0, 1))
+        self.labels.update(np.unique(chunk[membrane]).tolist())
+
+    def end(self) -> SegmentationStats:
+        boundingBox = None
+        if self.nMembrane:
+            (z0, z1), (y0, y1), (x0, x1) = ((int(idx[0]), int(idx[-1]))
+                                            for idx in map(np.flatnonzero, self.axisAny))
+            boundingBox = (x0, y0, z0, x1, y1, z1)
+        return SegmentationStats(self.nMembrane / max(self.nVoxels, 1), boundingBox, len(self.labels))
+
+
+class ScoresHistogramScanner(VolumeScanner):
+    """ Number of voxels of a score map in each bin of membrane probability: [0, 0.1), [0.1, 0.2)... [0.9, 1]. """
+
+    def begin(self, shape: Tuple[int, int, int], voxelSize: float, scale: float):
+        self.counts = np.zeros(PROBABILITY_BINS, dtype=np.int64)
+        # Quantized scores are compared with the edges in their own units
+        self.edges = _LOGIT_EDGES / scale
+
+    def add(self, start: int, chunk: np.ndarray):
+        self.counts += np.bincount(np.searchsorted(self.edges, chunk.ravel(), side='right'),
+                                   minlength=PROBABILITY_BINS)
+
+    def end(self) -> List[int]:
+        return self.counts.tolist()
+
+
+def getSegmentationStats(segFile: str, chunkSlices: int = DEFAULT_CHUNK_SLICES,
+                         tmpDir: str = None) -> SegmentationStats:
+    """ Statistics of a segmentation file, possibly compressed. """
+    return scanFile(segFile, [SegmentationStatsScanner()], chunkSlices, tmpDir)[0]
+
+
+def getScoresHistogram(scoresFile: str, chunkSlices: int = DEFAULT_CHUNK_SLICES, tmpDir: str = None) -> List[int]:
+    """ Histogram of membrane probabilities of a score map, in any of the encodings of membrain.utils.encoding (see
+    ScoresHistogramScanner). """
+    return scanFile(scoresFile, [ScoresHistogramScanner()], chunkSlices, tmpDir)[0]
@@ -0,0 +1,128 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Share of the cores allocated to a protocol for each of the jobs it runs at the same time. By default, PyTorch, OpenMP
+and MKL start as many threads as cores the machine has, so several concurrent jobs oversubscribe them. Each job is
+given its number of threads through the usual environment variables and, optionally, pinned to its own cores, taken
+from a single NUMA node when they fit in one.
+"""
+import glob
+import os
+import re
+import shlex
+import sys
+from typing import List, Dict
+
+# Variables read by the thread pools of OpenMP (and so PyTorch), MKL, OpenBLAS, numexpr and Accelerate
+THREAD_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'NUMEXPR_NUM_THREADS',
+               'VECLIB_MAXIMUM_THREADS']
+NUMA_NODES_PATTERN = '/sys/devices/system/node/node*/cpulist'
+
+
+def parseCpuList(cpuList: str) -> List[int]:
+    """ Cores of a list in the format of the kernel and taskset, e.g. '0-3,8,10-11'. """
+    cores = []
+    for item in cpuList.strip().split(','):
+        if item:
+            first, _, last = item.partition('-')
+            cores.extend(range(int(first), int(last or first) + 1))
+    return cores
+
+
+def formatCpuList(cores: List[int]) -> str:
+    """ Inverse of parseCpuList. """
+    ranges = []
+    for core in sorted(set(cores)):
+        if ranges and core == ranges[-1][1] + 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ','.join(str(first) if first == last else '%d-%d' % (first, last) for first, last in ranges)
+
+
+def getNumaNodes() -> List[List[int]]:
+    """ Cores of each NUMA node of the machine, or a single node with all of them if unknown. """
+    nodeFiles = sorted(glob.glob(NUMA_NODES_PATTERN), key=lambda f: int(re.search(r'node(\d+)', f).group(1)))
+    nodes = []
+    for nodeFile in nodeFiles:
+        with open(nodeFile) as f:
+            cores = parseCpuList(f.read())
+        if cores:
+            nodes.append(cores)
+    return nodes or [list(range(os.cpu_count() or 1))]
+
+
+def getAvailableCores() -> List[List[int]]:
+    """ Cores the current process can run on (e.g. those allocated by a queue system), by NUMA node. """
+    try:
+        allowed = os.sched_getaffinity(0)
+    except AttributeError:  # Not available on macOS
+        allowed = set(range(os.cpu_count() or 1))
+    nodes = [[core for core in node if core in allowed] for node in getNumaNodes()]
+    return [node for node in nodes if node] or [sorted(allowed)]
+
+
+def getJobThreads(nThreads: int, nJobs: int) -> int:
+    """ Threads of each of nJobs jobs sharing nThreads, at least 1. """
+    return max(nThreads // max(nJobs, 1), 1)
+
+
+def splitCores(nodes: List[List[int]], nJobs: int, jobThreads: int) -> List[List[int]]:
+    """ Cores each job is pinned to: jobThreads cores within a NUMA node if possible, then the remaining cores of
+    several nodes. If there are not enough cores, the sets are reused by several jobs.
+    :param nodes: available cores by NUMA node, as returned by getAvailableCores.
+    """
+    jobCores = []
+    leftover = []
+    for node in nodes:
+        nFit = len(node) // jobThreads
+        jobCores.extend(node[i * jobThreads:(i + 1) * jobThreads] for i in range(nFit))
+        leftover.extend(node[nFit * jobThreads:])
+    jobCores.extend(leftover[i:i + jobThreads] for i in range(0, len(leftover) - jobThreads + 1, jobThreads))
+    if not jobCores:  # Fewer cores than threads per job
+        jobCores = [[core for node in nodes for core in node]]
+    return [jobCores[i % len(jobCores)] for i in range(nJobs)]
+
+
+def getThreadEnviron(nThreads: int) -> Dict[str, str]:
+    """ Variables that limit the thread pools of a process to the given number of threads. """
+    return {var: str(nThreads) for var in THREAD_VARS}
+
+
+def limitThreads(nThreads: int):
+    """ Limit the thread pools of the current process to the given number of threads. The variables only apply to the
+    libraries loaded afterwards, so it is meant to be the initializer of the processes of a pool. PyTorch is also
+    limited if it is already loaded. """
+    os.environ.update(getThreadEnviron(nThreads))
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        torch.set_num_threads(nThreads)
+
+
+def pinCommand(cmd: str, cores: List[int]) -> str:
+    """ Shell command running the given one, and all the processes it launches, only on the given cores. The arguments
+    appended to it are passed to the given command, so it can be used as a program. """
+    return 'taskset -c %s sh -c %s sh' % (formatCpuList(cores), shlex.quote(cmd + ' "$@"'))
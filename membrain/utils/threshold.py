@@ -0,0 +1,66 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+from os.path import dirname, abspath
+from typing import Dict
+
+import mrcfile
+import numpy as np
+
+from membrain.utils.encoding import uncompressed, getScoresScale
+
+# Number of slices thresholded at once
+DEFAULT_CHUNK_SLICES = 32
+
+
+def thresholdFile(inFile: str, outFiles: Dict[float, str], samplingRate: float = None,
+                  chunkSlices: int = DEFAULT_CHUNK_SLICES):
+    """ Segment a MemBrain-seg score map with several thresholds at once: a voxel belongs to the membrane if its
+    score is higher than the threshold, as 'membrain segment' does. The score map is read only once, by chunks of
+    slices, through a memory map, and each segmentation is written through a memory map too.
+    :param inFile: MRC file with the scores, in any of the encodings of membrain.utils.encoding.
+    :param outFiles: dict of {threshold: MRC file where the corresponding segmentation will be written}.
+    :param samplingRate: voxel size of the outputs. If None, the one of the input is used.
+    :param chunkSlices: number of slices processed at once.
+    """
+    with uncompressed(inFile, dirname(abspath(next(iter(outFiles.values()))))) as plainFile, \
+            mrcfile.mmap(plainFile, mode='r', permissive=True) as mrcIn:
+        scores = mrcIn.data
+        # Quantized scores are compared with the thresholds in their own units
+        scale = getScoresScale(mrcIn)
+        voxelSize = mrcIn.voxel_size if samplingRate is None else samplingRate
+        mrcOuts = {threshold: mrcfile.new_mmap(outFile, shape=scores.shape, mrc_mode=0, overwrite=True)
+                   for threshold, outFile in outFiles.items()}
+        try:
+            for start in range(0, scores.shape[0], chunkSlices):
+                chunk = np.asarray(scores[start:start + chunkSlices])
+                for threshold, mrcOut in mrcOuts.items():
+                    np.greater(chunk, threshold / scale, out=mrcOut.data[start:start + chunkSlices], casting='unsafe')
+            for mrcOut in mrcOuts.values():
+                mrcOut.voxel_size = voxelSize
+                mrcOut.update_header_stats()
+        finally:
+            for mrcOut in mrcOuts.values():
+                mrcOut.close()
@@ -0,0 +1,127 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Segmentation of large tomograms by overlapping tiles, segmented independently and stitched back.
+
+The tiles are cubes of a given size, spread evenly along each axis so that consecutive tiles overlap at least a given
+number of voxels. The score maps of the tiles are blended in the overlaps with weights that are 0 in the outer quarter
+of the overlap of each tile, where the network lacks context, and ramp linearly in the middle half. The weights of two
+neighbouring tiles add up to 1, so the result is the one of the whole tomogram wherever the predictions only depend on
+a neighbourhood smaller than a quarter of the overlap.
+"""
+import os
+from itertools import product
+from math import ceil
+from typing import Tuple, List
+
+import mrcfile
+import numpy as np
+
+from membrain.utils.blocks import Block
+
+# Number of slices stitched at once
+DEFAULT_CHUNK_SLICES = 32
+
+
+def _getAxisTiles(size: int, tileSize: int, overlap: int) -> List[Tuple[int, int]]:
+    """ (start, stop) of the tiles along an axis. """
+    if size <= tileSize:
+        return [(0, size)]
+    nTiles = ceil((size - overlap) / (tileSize - overlap))
+    return [(int(start), int(start) + tileSize) for start in np.round(np.linspace(0, size - tileSize, nTiles))]
+
+
+def _getRamp(size: int) -> np.ndarray:
+    """ Weights of a tile over an overlap of the given size, rising towards its inside. The ramp reversed is the one of
+    the other tile, so they add up to 1. """
+    margin = size // 4
+    ramp = np.zeros(size, dtype=np.float32)
+    ramp[margin:size - margin] = (np.arange(size - 2 * margin) + 0.5) / (size - 2 * margin)
+    ramp[size - margin:] = 1
+    return ramp
+
+
+def getTiles(shape: Tuple[int, ...], tileSize: int, overlap: int) -> List[Block]:
+    """ Tiles of a volume of the given shape, in C order. An axis not longer than the tile size is not split. The
+    overlap must be at most half the tile size, so only consecutive tiles overlap. """
+    if not 0 <= 2 * overlap <= tileSize:
+        raise ValueError('The overlap of the tiles (%d) must be at most half their size (%d).' % (overlap, tileSize))
+    return [tuple(slice(start, stop) for start, stop in axisTiles)
+            for axisTiles in product(*(_getAxisTiles(size, tileSize, overlap) for size in shape))]
+
+
+def countTiles(shape: Tuple[int, ...], tileSize: int, overlap: int) -> int:
+    return len(getTiles(shape, tileSize, overlap))
+
+
+def getTileWeights(shape: Tuple[int, ...], tileSize: int, overlap: int, tile: Block) -> List[np.ndarray]:
+    """ Blending weights of a tile along each axis. Those of the tile are their outer product. """
+    weights = []
+    for size, tileSlice in zip(shape, tile):
+        axisTiles = _getAxisTiles(size, tileSize, overlap)
+        index = axisTiles.index((tileSlice.start, tileSlice.stop))
+        axisWeights = np.ones(tileSlice.stop - tileSlice.start, dtype=np.float32)
+        if index > 0:
+            axisWeights[:axisTiles[index - 1][1] - tileSlice.start] = _getRamp(axisTiles[index - 1][1] - tileSlice.start)
+        if index < len(axisTiles) - 1:
+            nextOverlap = tileSlice.stop - axisTiles[index + 1][0]
+            axisWeights[-nextOverlap:] *= _getRamp(nextOverlap)[::-1]
+        weights.append(axisWeights)
+    return weights
+
+
+def stitchTiles(tileFiles: List[str], shape: Tuple[int, ...], tileSize: int, overlap: int, outFile: str,
+                samplingRate: float, chunkSlices: int = DEFAULT_CHUNK_SLICES):
+    """ Blend the score maps of the tiles of a volume, in the order of getTiles, into a float32 MRC file. The output
+    is written by chunks of slices, reading only the part of each tile overlapping them.
+    :param shape: shape of the whole volume.
+    :param samplingRate: voxel size of the output, in Å/px.
+    """
+    tiles = getTiles(shape, tileSize, overlap)
+    if len(tileFiles) != len(tiles):
+        raise ValueError('%d tile files given for a volume with %d tiles.' % (len(tileFiles), len(tiles)))
+    weights = [getTileWeights(shape, tileSize, overlap, tile) for tile in tiles]
+    tmpFile = outFile + '.part'
+    with mrcfile.new_mmap(tmpFile, shape=shape, mrc_mode=2, overwrite=True) as mrcOut:
+        for start in range(0, shape[0], chunkSlices):
+            stop = min(start + chunkSlices, shape[0])
+            scores = np.zeros((stop - start,) + tuple(shape[1:]), dtype=np.float32)
+            totalWeights = np.zeros_like(scores)
+            for tileFile, (zTile, yTile, xTile), (zWeights, yWeights, xWeights) in zip(tileFiles, tiles, weights):
+                tileStart, tileStop = max(start, zTile.start), min(stop, zTile.stop)
+                if tileStart >= tileStop:
+                    continue
+                with mrcfile.mmap(tileFile, mode='r', permissive=True) as mrcTile:
+                    tileScores = np.asarray(mrcTile.data[tileStart - zTile.start:tileStop - zTile.start],
+                                            dtype=np.float32)
+                tileWeights = zWeights[tileStart - zTile.start:tileStop - zTile.start, None, None] * \
+                    yWeights[None, :, None] * xWeights[None, None, :]
+                scores[tileStart - start:tileStop - start, yTile, xTile] += tileWeights * tileScores
+                totalWeights[tileStart - start:tileStop - start, yTile, xTile] += tileWeights
+            mrcOut.data[start:stop] = scores / totalWeights
+        mrcOut.voxel_size = samplingRate
+        mrcOut.update_header_stats()
+    os.replace(tmpFile, outFile)
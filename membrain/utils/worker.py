@@ -0,0 +1,142 @@
+# **************************************************************************
+# *
+# * Authors:     Scipion Team
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import logging
+import os
+import shlex
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client
+from os.path import join
+from typing import Tuple
+
+from membrain.scripts.membrain_seg_worker import AUTHKEY_VAR, CMD_RUN, CMD_PING, CMD_STOP
+
+logger = logging.getLogger(__name__)
+
+
+class MemBrainSegWorker:
+    """ Client side of a persistent MemBrain-seg inference worker (see membrain/scripts/membrain_seg_worker.py).
+    The worker process is launched on the first job and then reused, so the environment activation, the torch
+    import and the model loading are paid only once. Jobs are sent one at a time."""
+
+    def __init__(self, launchCmd: str, logFile: str, startTimeout: int = 900, env: dict = None):
+        """
+        :param launchCmd: shell command that runs the worker script inside the MemBrain-seg environment.
+        :param logFile: file where the worker stdout and stderr will be written.
+        :param startTimeout: maximum time (in seconds) waited for the worker to be ready.
+        :param env: variables the launch command is run with. If None, the ones of the current process.
+        """
+        self._launchCmd = launchCmd
+        self._logFile = logFile
+        self._env = env
+        self._startTimeout = startTimeout
+        self._authkey = os.urandom(16)
+        self._socketDir = None
+        self._address = None
+        self._process = None
+        self._lock = threading.RLock()
+
+    def isAlive(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def start(self):
+        """ Launch the worker process and wait until it accepts connections. """
+        # Unix socket paths are limited to ~100 characters, so the protocol dir may be too deep to host it
+        self._socketDir = tempfile.mkdtemp(prefix='membrain-')
+        self._address = join(self._socketDir, 'worker.sock')
+        cmd = '%s --address %s --parent-pid %d' % (self._launchCmd, self._address, os.getpid())
+        env = dict(os.environ if self._env is None else self._env)
+        env[AUTHKEY_VAR] = self._authkey.hex()
+        logger.info('Launching MemBrain-seg worker: %s' % cmd)
+        with open(self._logFile, 'a') as log:
+            self._process = subprocess.Popen(cmd, shell=True, stdout=log, stderr=subprocess.STDOUT, env=env,
+                                             start_new_session=True)
+
+        t0 = time.time()
+        while True:
+            if not self.isAlive():
+                raise RuntimeError('The MemBrain-seg worker finished unexpectedly. See %s' % self._logFile)
+            try:
+                self._request({'cmd': CMD_PING})
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() - t0 > self._startTimeout:
+                    self.stop()
+                    raise TimeoutError('The MemBrain-seg worker was not ready after %d s. See %s'
+                                       % (self._startTimeout, self._logFile))
+                time.sleep(1)
+
+    def run(self, args: str, backend: str = None) -> Tuple[str, dict]:
+        """ Run a membrain job in the worker, launching it if needed.
+        :param args: membrain command line arguments, as they would be passed to the membrain executable.
+        :param backend: inference backend used if the job runs on CPU (see membrain_seg_worker.py). None for the
+        PyTorch model, as the membrain executable.
+        :return: the output of the job and the resources it used, as measured by the worker (wallTime, cpuTime,
+        peakRss, bytesRead, bytesWritten and modelLoadTime), plus the time taken to launch the worker (startTime), if
+        it was launched for this job.
+        """
+        with self._lock:
+            startTime = None
+            if not self.isAlive():
+                t0 = time.time()
+                self.start()
+                startTime = time.time() - t0
+            try:
+                reply = self._request({'cmd': CMD_RUN, 'args': shlex.split(args), 'backend': backend})
+            except (EOFError, ConnectionError) as e:
+                # Killed during the job (e.g. out of memory): the next job launches it again
+                self.stop()
+                raise RuntimeError('The MemBrain-seg worker finished unexpectedly. See %s' % self._logFile) from e
+        if not reply['ok']:
+            raise RuntimeError('MemBrain-seg worker job failed:\n%s' % reply['output'])
+        stats = dict(reply.get('stats', {}))
+        if startTime is not None:
+            stats['startTime'] = startTime
+        return reply['output'], stats
+
+    def stop(self):
+        """ Ask the worker to finish and clean its socket. """
+        with self._lock:
+            if self.isAlive():
+                try:
+                    self._request({'cmd': CMD_STOP})
+                    self._process.wait(timeout=60)
+                except Exception as e:
+                    logger.warning('MemBrain-seg worker did not stop cleanly (%s). Killing it.' % e)
+                    os.killpg(self._process.pid, signal.SIGKILL)
+            self._process = None
+            if self._socketDir:
+                shutil.rmtree(self._socketDir, ignore_errors=True)
+                self._socketDir = None
+
+    def _request(self, request: dict) -> dict:
+        with Client(self._address, family='AF_UNIX', authkey=self._authkey) as conn:
+            conn.send(request)
+            return conn.recv()